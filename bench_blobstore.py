@@ -0,0 +1,80 @@
+#!/usr/bin/python
+"""
+Compare the version 1 (chained) and version 2 (minimal perfect hash) blobstore
+layouts for a synthetic set of boards: index size in bytes, metablock probes
+per lookup and lookup time through BlobStoreReader.
+
+Usage: bench_blobstore.py [number of devices]
+"""
+
+import shutil
+import tempfile
+import time
+
+from blobstore import *
+
+BTYPES = (BLOB_TYPE_DTB, BLOB_TYPE_OEMVARS, BLOB_TYPE_BOOTVARS)
+
+def make_store(tmpdir, num_devices):
+    db = BlobStore(os.path.join(tmpdir, 'blobstore.bin'))
+    for btype in BTYPES:
+        path = os.path.join(tmpdir, 'blob-%d' % btype)
+        with open(path, 'w') as fp:
+            fp.write('blob data for type %d' % btype)
+
+    for i in xrange(num_devices):
+        key = 'brand%d/product%d/device%d' % (i % 7, i % 31, i)
+        for btype in BTYPES:
+            db.add(key, btype, os.path.join(tmpdir, 'blob-%d' % btype))
+    return db
+
+def bench(db, version):
+    start = time.time()
+    db.commit(version)
+    build_time = time.time() - start
+
+    with BlobStoreReader(db.path) as reader:
+        index_size = reader.hash_start - s_blobstore.size + \
+                reader.hash_sz * s_hashitem.size
+
+        probes = []
+        start = time.time()
+        for key, btype in db.items:
+            mb, count = reader.lookup(key, btype)
+            assert mb is not None
+            probes.append(count)
+        lookup_time = time.time() - start
+
+        # Misses cost a probe for every metablock in the chain too
+        miss_probes = []
+        for key, btype in db.items:
+            mb, count = reader.lookup(key, btype + len(BTYPES))
+            assert mb is None
+            miss_probes.append(count)
+
+    print "version %d:" % version
+    print "  index bytes:     %d" % index_size
+    print "  hit probes:      avg %.3f max %d" % (
+            float(sum(probes)) / len(probes), max(probes))
+    print "  miss probes:     avg %.3f max %d" % (
+            float(sum(miss_probes)) / len(miss_probes), max(miss_probes))
+    print "  build time:      %.3fs" % build_time
+    print "  lookup time:     %.2fus/key" % (
+            lookup_time * 1000000 / len(probes))
+
+def main(argv):
+    num_devices = 1000
+    if argv:
+        num_devices = int(argv[0])
+
+    tmpdir = tempfile.mkdtemp(prefix='bench_blobstore')
+    try:
+        db = make_store(tmpdir, num_devices)
+        print "%d entries" % len(db.items)
+        for version in SUPPORTED_VERSIONS:
+            bench(db, version)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
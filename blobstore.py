@@ -1,3 +1,4 @@
+#!/usr/bin/python
 """
 A blobstore is essentially a serialized hash table which maps board
 identification values to blobs of data. This hash table is stored inside
@@ -86,45 +87,414 @@ is in the meta block. Return the data and size if there is a match. Otherwise
 the item isn't found.
 
 No heap allocation or additional state variables are needed to do these lookups.
+
+Version 2 of the format replaces the chained hash table with a minimal perfect
+hash built with the CHD (compress, hash and displace) algorithm, so that
+every lookup touches exactly one metablock and the table holds one slot per
+entry. Only the index between the header and the metablocks changes:
+
++----------------------+
+| Blobstore Header     |  hashmap_sz is the number of slots (== entries)
++----------------------+
+| V2 Header            |
++----------------------+
+| Displacement Table   |
++----------------------+
+| Slot Table           |
++----------------------+
+| Meta Blocks          |  next_item_offset is always 0
++----------------------+
+| Blobs Data           |
++----------------------+
+
+struct blobstore_v2 {
+    unsigned int num_buckets;
+    unsigned int flags;
+} __attribute__((packed));
+
+struct displacement {
+    unsigned int d0;
+    unsigned int d1;
+} __attribute__((packed));
+
+The slot table is an array of hashmap_sz metablock offsets. A v2 lookup:
+1) h1, h2, h3 = hash_blob_key_v2(key, type), three polynomial hashes of the
+key and type like the v1 one, using the multipliers 31, 37 and 41, each
+passed through the MurmurHash3 32-bit finalizer (mix_hash)
+2) bucket = h1 % num_buckets
+3) slot = (uint32)(h2 + d0 * h3 + d1) % hashmap_sz, using the displacement
+pair stored for the bucket
+4) compare the key/type in the metablock at slot_table[slot]; if it doesn't
+match, the item isn't found.
+
+If BLOBSTORE_FLAG_CODECS is set in the v2 flags, blobs may be compressed and
+every metablock carries two more fields after the v1 ones:
+
+struct metablock_codec {
+    struct metablock mb;
+    unsigned int codec;         /* CODEC_NONE, CODEC_LZ4 or CODEC_ZLIB */
+    unsigned int raw_size;      /* size of the blob once decompressed */
+} __attribute__((packed));
+
+data_size is then the size of the stored, possibly compressed, data. LZ4
+blobs are raw LZ4 blocks, zlib blobs are zlib streams (RFC 1950). The builder
+picks whichever encoding is the smallest for each blob.
+
+Loaders which only know about VERSION 1 must be given a version 1 store, which
+is still what BlobStore.commit() produces by default.
+
+BlobStoreReader implements the same lookup in Python against a memory-mapped
+blobstore file, so that build-time validation tools can query large stores
+without reading them into memory or copying the blob data.
+
+Run as a script, this module inspects a blobstore:
+
+    blobstore.py [--json] FILE list
+    blobstore.py FILE get KEY TYPE [--output PATH]
+    blobstore.py [--json] FILE stats
+    blobstore.py [--json] FILE verify
+
+With --json, list and verify print one JSON object per line so that the
+output for two builds can be compared with diff.
 """
 
 import sys
 import os
 import struct
+import mmap
+import hashlib
+import array
+import shutil
+import tempfile
+import json
+import zlib
+import collections
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
 
 BLOB_KEY_LENGTH = 64
 MAGIC = "BLOBSTOR"
 VERSION = 1
+VERSION_MPH = 2
+SUPPORTED_VERSIONS = (VERSION, VERSION_MPH)
 
 s_metablock = struct.Struct("< %ds I I I I" % BLOB_KEY_LENGTH)
+s_metablock_codec = struct.Struct("< %ds I I I I I I" % BLOB_KEY_LENGTH)
 s_blobstore = struct.Struct("< 8s I I I")
+s_blobstore_v2 = struct.Struct("< I I")
+s_displacement = struct.Struct("< I I")
 s_hashitem = struct.Struct("< I")
 
 BLOB_TYPE_DTB = 0
 BLOB_TYPE_OEMVARS = 1
 BLOB_TYPE_BOOTVARS = 2
 
+BLOB_TYPES = {
+    "dtb" : BLOB_TYPE_DTB,
+    "oemvars" : BLOB_TYPE_OEMVARS,
+    "bootvars" : BLOB_TYPE_BOOTVARS
+    }
+
+# Flags of the version 2 header
+BLOBSTORE_FLAG_CODECS = 1
+
+CODEC_NONE = 0
+CODEC_LZ4 = 1
+CODEC_ZLIB = 2
+
+CODEC_NAMES = {
+    CODEC_NONE : "none",
+    CODEC_LZ4 : "lz4",
+    CODEC_ZLIB : "zlib"
+    }
+
+# Number of decompressed blobs kept around by BlobStoreReader
+DECODE_CACHE_SIZE = 16
+
 # We modulo this in hashing since the value is stored in an unsigned
 # 32-bit type
 MAXINT = 2 ** 32
 
-def hash_blob_key(key, btype, sz):
+def hash_blob_key_raw(key, btype):
+    """Return the 32-bit hash of a key and type, before reducing it modulo
+    the size of the hash table"""
+    # Reducing modulo 2^32 once at the end gives the same result as the
+    # loader's wrapping unsigned arithmetic on every step
     hash_val = 0
     for c in key:
-        hash_val = (hash_val * 31 + ord(c)) % MAXINT
-    hash_val = (hash_val * 31 + btype) % MAXINT
-    return hash_val % sz
+        hash_val = hash_val * 31 + ord(c)
+    return (hash_val * 31 + btype) % MAXINT
+
+def hash_blob_key(key, btype, sz):
+    return hash_blob_key_raw(key, btype) % sz
+
+def hash_blob_keys(keys):
+    """Return the 32-bit hashes of a list of (key, btype) tuples, like
+    hash_blob_key_raw(). Keys typically share their leading path components
+    ("brand/product/") and come with several blob types, so the hash of
+    everything up to the last '/' is only computed once per prefix.
+
+    The results can be reduced against any number of table sizes with
+    reduce_hashes() without hashing the keys again."""
+    prefixes = {}
+    hashes = []
+    for key, btype in keys:
+        split = key.rfind("/") + 1
+        prefix = key[:split]
+        hash_val = prefixes.get(prefix)
+        if hash_val is None:
+            hash_val = 0
+            for c in prefix:
+                hash_val = hash_val * 31 + ord(c)
+            hash_val = hash_val % MAXINT
+            prefixes[prefix] = hash_val
+        for c in key[split:]:
+            hash_val = hash_val * 31 + ord(c)
+        hashes.append((hash_val * 31 + btype) % MAXINT)
+    return hashes
+
+def reduce_hashes(hashes, sz):
+    """Map 32-bit hashes onto the indexes of a table of sz entries"""
+    return [h % sz for h in hashes]
+
+def chain_histogram(hashes, sz):
+    """Return a dictionary mapping chain lengths to the number of hash table
+    entries with a chain of that length, for a table of sz entries. Empty
+    table entries are counted under length 0."""
+    counts = [0] * sz
+    for h in hashes:
+        counts[h % sz] += 1
+    hist = {}
+    for c in counts:
+        hist[c] = hist.get(c, 0) + 1
+    return hist
+
+def format_histogram(hist):
+    width = max(hist.values())
+    lines = []
+    for length in sorted(hist):
+        bar = "#" * max(1, hist[length] * 40 / width)
+        lines.append("%6d %-40s %d" % (length, bar, hist[length]))
+    return "\n".join(lines)
+
+# Maximum number of table sizes tried by choose_hash_size()
+MAX_SIZE_CANDIDATES = 256
+
+def choose_hash_size(hashes, budget):
+    """Pick the version 1 hash table size with the shortest worst-case
+    collision chain, among sizes whose table fits in budget bytes.
+    Ties go to the smaller table. Returns (size, longest chain)."""
+    max_sz = budget / s_hashitem.size
+    if max_sz < 1:
+        raise Exception("Hash table budget of %d bytes is too small" % budget)
+    min_sz = min(max(len(hashes), 1), max_sz)
+
+    # Odd sizes spread the hashes better than even ones
+    step = max(1, (max_sz - min_sz) / MAX_SIZE_CANDIDATES)
+    candidates = range(max_sz, min_sz - 1, -step)
+    if len(hashes) * 2 + 1 <= max_sz:
+        candidates.append(len(hashes) * 2 + 1)
+
+    best = None
+    for sz in sorted(set(candidates)):
+        if sz % 2 == 0 and sz < max_sz:
+            sz = sz + 1
+        counts = [0] * sz
+        longest = 0
+        for h in hashes:
+            i = h % sz
+            counts[i] += 1
+            if counts[i] > longest:
+                longest = counts[i]
+                if best and longest >= best[1]:
+                    break
+        if best is None or longest < best[1]:
+            best = (sz, longest)
+            if longest <= 1:
+                break
+    return best
+
+def mix_hash(h):
+    """32-bit finalizer from MurmurHash3, spreads polynomial hashes of
+    similar keys over the whole 32-bit range"""
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) % MAXINT
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) % MAXINT
+    h ^= h >> 16
+    return h
+
+def hash_blob_key_v2(key, btype):
+    """Return the three mixed 32-bit hashes (h1, h2, h3) used by version 2
+    lookups. They are computed in a single pass with the multipliers 31, 37
+    and 41."""
+    h1 = 0
+    h2 = 0
+    h3 = 0
+    for c in key:
+        o = ord(c)
+        h1 = h1 * 31 + o
+        h2 = h2 * 37 + o
+        h3 = h3 * 41 + o
+    h1 = (h1 * 31 + btype) % MAXINT
+    h2 = (h2 * 37 + btype) % MAXINT
+    h3 = (h3 * 41 + btype) % MAXINT
+    return mix_hash(h1), mix_hash(h2), mix_hash(h3)
+
+def mph_slot(h2, h3, d0, d1, sz):
+    return ((h2 + d0 * h3 + d1) % MAXINT) % sz
+
+# Average number of keys per CHD bucket. Larger values make the displacement
+# table smaller but the search for displacements slower.
+MPH_BUCKET_SIZE = 4
+
+# Suffix and format version of the manifest kept next to the blobstore by
+# incremental commits
+MANIFEST_SUFFIX = ".manifest"
+MANIFEST_VERSION = 2
+
+# Chunk size used when reading blob files
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# array typecode for unsigned 32-bit values
+if array.array("I").itemsize == 4:
+    U32_TYPECODE = "I"
+else:
+    U32_TYPECODE = "L"
+
+def pack_u32_array(values):
+    """Serialize an array of unsigned 32-bit values as little-endian"""
+    if sys.byteorder != "little":
+        values = array.array(U32_TYPECODE, values)
+        values.byteswap()
+    return values.tostring()
+
+def hash_blob_file(path):
+    """Return the SHA-1 hex digest of a blob file's content"""
+    h = hashlib.sha1()
+    with open(path, "rb") as fp:
+        while True:
+            data = fp.read(COPY_CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def available_codecs():
+    codecs = [CODEC_ZLIB]
+    if lz4_block:
+        codecs.append(CODEC_LZ4)
+    return codecs
+
+def encode_blob(data, codec):
+    if codec == CODEC_NONE:
+        return data
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, 9)
+    if codec == CODEC_LZ4 and lz4_block:
+        return lz4_block.compress(data, mode="high_compression",
+                                  store_size=False)
+    raise Exception("Unsupported blob codec %d" % codec)
+
+def decode_blob(data, codec, raw_size):
+    if codec == CODEC_ZLIB:
+        data = zlib.decompress(str(data))
+    elif codec == CODEC_LZ4 and lz4_block:
+        data = lz4_block.decompress(str(data), uncompressed_size=raw_size)
+    elif codec != CODEC_NONE:
+        raise Exception("Unsupported blob codec %d" % codec)
+    if len(data) != raw_size:
+        raise Exception("Blob decompressed to %d bytes, expected %d" %
+                        (len(data), raw_size))
+    return data
+
+def encode_blob_chunks(chunks, codec):
+    """Generate the encoded data of a blob given as a sequence of chunks.
+    zlib streams the chunks, LZ4 block compression needs the whole blob in
+    memory."""
+    if codec == CODEC_NONE:
+        for data in chunks:
+            yield data
+    elif codec == CODEC_ZLIB:
+        compressor = zlib.compressobj(9)
+        for data in chunks:
+            yield compressor.compress(data)
+        yield compressor.flush()
+    else:
+        yield encode_blob("".join(chunks), codec)
+
+# Upper bound on the d0 displacement tried for each bucket, d1 always covers
+# the whole slot table.
+MPH_MAX_D0 = 64
+
+def build_mph(keys):
+    """Build a minimal perfect hash over a list of (key, btype) tuples.
+
+    Returns (num_buckets, displacements, slots) where displacements is a list
+    of (d0, d1) tuples indexed by bucket and slots lists the keys in slot
+    order."""
+    num_entries = len(keys)
+    sz = max(num_entries, 1)
+    num_buckets = max((num_entries + MPH_BUCKET_SIZE - 1) / MPH_BUCKET_SIZE, 1)
+
+    while True:
+        buckets = [[] for i in xrange(num_buckets)]
+        for k in keys:
+            h1, h2, h3 = hash_blob_key_v2(k[0], k[1])
+            buckets[h1 % num_buckets].append((k, (h2, h3)))
+
+        displacements = [(0, 0)] * num_buckets
+        slots = [None] * sz
+
+        # Place the largest buckets first while the table is mostly empty
+        order = sorted([b for b in xrange(num_buckets) if buckets[b]],
+                       key=lambda b: -len(buckets[b]))
+        for b in order:
+            placed = _place_bucket(buckets[b], slots, sz)
+            if placed is None:
+                break
+            displacements[b] = placed
+        else:
+            return num_buckets, displacements, slots
+
+        # Couldn't place some bucket, try again with smaller buckets
+        if num_buckets >= num_entries:
+            raise Exception("Unable to build a perfect hash for the blobstore")
+        num_buckets = min(num_buckets * 2, num_entries)
+
+def _place_bucket(bucket, slots, sz):
+    for d0 in xrange(MPH_MAX_D0):
+        for d1 in xrange(sz):
+            taken = set()
+            for k, h in bucket:
+                slot = mph_slot(h[0], h[1], d0, d1, sz)
+                if slots[slot] is not None or slot in taken:
+                    break
+                taken.add(slot)
+            else:
+                for k, h in bucket:
+                    slots[mph_slot(h[0], h[1], d0, d1, sz)] = k
+                return (d0, d1)
+    return None
 
 
 class MetaBlock:
 
-    def __init__(self, key, btype, mb_offset, data_offset, data_size):
+    def __init__(self, key, btype, mb_offset, data_offset, data_size,
+                 codec=CODEC_NONE, raw_size=None):
         self.key = key
         self.btype = btype
         self.next_offset = 0
         self.data_offset = data_offset
         self.data_size = data_size
         self.mb_offset = mb_offset
+        self.codec = codec
+        if raw_size is None:
+            raw_size = data_size
+        self.raw_size = raw_size
 
     def __repr__(self):
         return "<%s-%d: (%d %d %d %d)>" % (self.key, self.btype, self.mb_offset,
@@ -136,7 +506,26 @@ class BlobStore:
         self.items = {}
         self.path = path
 
-    def add(self, key, btype, path):
+        # (size, mtime) of blob files, as passed to add()
+        self.stats = {}
+
+        # Number of data bytes not written thanks to deduplication, updated
+        # by commit()
+        self.bytes_saved = 0
+
+        # Chain length histogram of the committed hash table
+        self.histogram = {}
+
+        # Number of bytes written by the last commit()
+        self.written = 0
+
+        # Number of data bytes saved by compression, updated by commit()
+        self.bytes_compressed = 0
+
+    def add(self, key, btype, path, realpath=None, size=None, mtime=None):
+        """Add a blob file to the store. Callers which already know the
+        realpath, size and mtime of the file can pass them so they don't get
+        looked up again."""
         if len(key) >= BLOB_KEY_LENGTH:
             raise Exception("Key is too long");
 
@@ -144,22 +533,76 @@ class BlobStore:
         dk = (key, btype)
         if dk in self.items:
             raise Exception("Duplicate entry in the database: "+ str(dk))
-        self.items[dk] = os.path.realpath(path)
+        if realpath is None:
+            realpath = os.path.realpath(path)
+        self.items[dk] = realpath
+        if size is not None and mtime is not None:
+            self.stats[realpath] = (size, mtime)
+
+    def commit(self, version=VERSION, table_budget=None, incremental=False,
+               compress=False):
+        """Write out the blobstore. For version 1 stores, if table_budget is
+        set, the hash table size is searched for the shortest worst-case
+        collision chain within that many bytes instead of using the fixed
+        heuristic. The resulting chain length histogram is kept in
+        self.histogram.
+
+        If incremental is set, a manifest of the inputs and of the layout is
+        kept next to the blobstore. Inputs whose size and mtime didn't change
+        aren't hashed again, and if the layout is the same as the one of the
+        existing blobstore only the blobs whose content changed are
+        rewritten, in place. self.written is set to the number of bytes
+        actually written.
+
+        If compress is set, every blob is stored with whichever of the
+        available codecs makes it the smallest. Only version 2 stores
+        support compression."""
+        if version not in SUPPORTED_VERSIONS:
+            raise Exception("Unsupported blobstore version %d" % version)
+        if compress and version != VERSION_MPH:
+            raise Exception("Blob compression needs blobstore version %d" %
+                            VERSION_MPH)
+
+        manifest = None
+        if incremental:
+            manifest = self.load_manifest()
 
-    def commit(self):
         num_entries = len(self.items)
 
-        # Seems like a reasonable heuristic for a modulo array-based table
-        hash_sz = num_entries * 2 + 1
+        if version == VERSION:
+            mb_order = self.items.keys()
+            rawhashes = hash_blob_keys(mb_order)
+            if table_budget:
+                hash_sz, longest = choose_hash_size(rawhashes, table_budget)
+            else:
+                # Seems like a reasonable heuristic for a modulo array-based
+                # table
+                hash_sz = num_entries * 2 + 1
+            index_size = s_hashitem.size * hash_sz
+            hashvals = dict(zip(mb_order, reduce_hashes(rawhashes, hash_sz)))
+            self.histogram = chain_histogram(rawhashes, hash_sz)
+        else:
+            # Metablocks are laid out in slot order, one per slot
+            num_buckets, displacements, mb_order = build_mph(self.items.keys())
+            hash_sz = len(mb_order)
+            index_size = (s_blobstore_v2.size +
+                          s_displacement.size * num_buckets +
+                          s_hashitem.size * hash_sz)
+            self.histogram = {1: num_entries} if num_entries else {}
 
         # Offset from the beginning where metablocks are stored, after the
         # hash table array
-        mb_start = s_blobstore.size + (s_hashitem.size * hash_sz)
+        mb_start = s_blobstore.size + index_size
         mb_pos = mb_start
 
+        if compress:
+            mb_struct = s_metablock_codec
+        else:
+            mb_struct = s_metablock
+
         # Offset from the beginning where data will be stored. Every
         # entry in the table has 1 metablock associates with it
-        data_start = mb_start + (s_metablock.size * num_entries)
+        data_start = mb_start + (mb_struct.size * num_entries)
         data_pos = data_start
 
         # Map hash values to a list of metablocks for that hash.
@@ -173,70 +616,597 @@ class BlobStore:
         # MetaBlock objects.
         mblist = []
 
-        # Order in which data blobs need to be written out, a list of file paths
+        # Order in which data blobs need to be written out, a list of
+        # (path, offset, stored size, digest, codec) tuples
         datalist = []
 
-        # Map paths to offsets. Used to filter duplicates so we can efficiently
-        # support many-to-one mapping
+        # Map content digests to (offset, stored size, codec). Used to filter
+        # duplicates so we can efficiently support many-to-one mapping, even
+        # when identical blobs live at different paths
         datadict = {}
 
+        # Size, mtime and content digest of every distinct path
+        inputs = {}
+        self.bytes_saved = 0
+
+        # (codec, stored size) of every distinct blob
+        encodings = {}
+        self.bytes_compressed = 0
+
         # Compute hashes for all the items. Duplicates are filtered
         # Also determine the total size of all the blobs. The blobs need to
         # be serialized in the same order they are in datalist.
         total_dsize = 0
-        for k, path in self.items.iteritems():
+        for k in mb_order:
+            if k is None:
+                # Empty slot of a v2 store with no entries at all
+                continue
             key, btype = k
-            hashval = hash_blob_key(key, btype, hash_sz)
-            dsize = os.stat(path).st_size
-
-            if hashval not in mbs:
-                mbs[hashval] = []
-
-            if path not in datadict:
-                mb = MetaBlock(key, btype, mb_pos, data_pos, dsize)
-                total_dsize = total_dsize + dsize
-                datalist.append(path)
-                datadict[path] = data_pos
-                data_pos = data_pos + dsize
+            path = self.items[k]
+            if path not in inputs:
+                inputs[path] = self.stat_input(path, manifest)
+            dsize, mtime, digest = inputs[path]
+
+            if digest not in datadict:
+                if compress:
+                    codec, stored = self.encode_input(path, digest, manifest)
+                else:
+                    codec, stored = CODEC_NONE, dsize
+                encodings[digest] = [codec, stored]
+                self.bytes_compressed = self.bytes_compressed + dsize - stored
+
+                mb = MetaBlock(key, btype, mb_pos, data_pos, stored, codec,
+                               dsize)
+                total_dsize = total_dsize + stored
+                datalist.append((path, data_pos, stored, digest, codec))
+                datadict[digest] = (data_pos, stored, codec)
+                data_pos = data_pos + stored
             else:
-                mb = MetaBlock(key, btype, mb_pos, datadict[path], dsize)
+                offset, stored, codec = datadict[digest]
+                mb = MetaBlock(key, btype, mb_pos, offset, stored, codec, dsize)
+                self.bytes_saved = self.bytes_saved + stored
 
-            mbs[hashval].append(mb)
             mblist.append(mb)
 
-            # Update the next pointer if we had a collision
-            if len(mbs[hashval]) > 1:
-                prev = mbs[hashval][-2]
-                prev.next_offset = mb_pos
+            if version == VERSION:
+                hashval = hashvals[k]
+                if hashval not in mbs:
+                    mbs[hashval] = []
+                mbs[hashval].append(mb)
 
-            mb_pos = mb_pos + s_metablock.size
+                # Update the next pointer if we had a collision
+                if len(mbs[hashval]) > 1:
+                    prev = mbs[hashval][-2]
+                    prev.next_offset = mb_pos
+
+            mb_pos = mb_pos + mb_struct.size
 
         assert mb_pos == data_start
         total_size = data_start + total_dsize
         assert data_pos == total_size
 
-        # Write the superblock
-        fp = open(self.path, "wb")
-        fp.write(s_blobstore.pack(MAGIC, VERSION, total_size, hash_sz))
-
-        # Write the hash table: create an empty array, populate nonzero entries,
+        # Build the index in memory and write it with a few bulk writes.
+        # The hash table: create an empty array, populate nonzero entries,
         # serialize it
-        hlist = [0 for i in range(hash_sz)]
-        for index, buckets in mbs.iteritems():
-            hlist[index] = buckets[0].mb_offset
+        hlist = array.array(U32_TYPECODE, [0]) * hash_sz
+        if version == VERSION:
+            for index, buckets in mbs.iteritems():
+                hlist[index] = buckets[0].mb_offset
+            index_data = [pack_u32_array(hlist)]
+        else:
+            for index, mb in enumerate(mblist):
+                hlist[index] = mb.mb_offset
+            disp = array.array(U32_TYPECODE, [0]) * (2 * num_buckets)
+            for b, (d0, d1) in enumerate(displacements):
+                disp[2 * b] = d0
+                disp[2 * b + 1] = d1
+            flags = 0
+            if compress:
+                flags = flags | BLOBSTORE_FLAG_CODECS
+            index_data = [s_blobstore_v2.pack(num_buckets, flags),
+                          pack_u32_array(disp), pack_u32_array(hlist)]
+
+        # Everything before the blob data
+        if compress:
+            mbdata = [s_metablock_codec.pack(mb.key, mb.btype, mb.next_offset,
+                              mb.data_offset, mb.data_size, mb.codec,
+                              mb.raw_size)
+                      for mb in mblist]
+        else:
+            mbdata = [s_metablock.pack(mb.key, mb.btype, mb.next_offset,
+                              mb.data_offset, mb.data_size)
+                      for mb in mblist]
+        meta = "".join([s_blobstore.pack(MAGIC, version, total_size, hash_sz)] +
+                index_data + mbdata)
+        assert len(meta) == data_start
+        layout = hashlib.sha1(meta).hexdigest()
+
+        if not (manifest and self.update_in_place(manifest, layout, datalist)):
+            self.write_full(meta, datalist, total_size)
+
+        if incremental:
+            st = os.stat(self.path)
+            self.save_manifest({
+                "version": MANIFEST_VERSION,
+                "output": [st.st_size, st.st_mtime, st.st_ino],
+                "layout": layout,
+                "inputs": inputs,
+                "encodings": encodings,
+                "data": [[d[1], d[3]] for d in datalist],
+                })
+
+    def manifest_path(self):
+        return self.path + MANIFEST_SUFFIX
+
+    def load_manifest(self):
+        """Return the manifest of the existing blobstore, or None if there's
+        no usable one"""
+        try:
+            with open(self.manifest_path()) as fp:
+                manifest = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if manifest.get("version") != MANIFEST_VERSION:
+            return None
+        return manifest
+
+    def save_manifest(self, manifest):
+        tmp_path = self.manifest_path() + ".tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(manifest, fp, sort_keys=True)
+        os.rename(tmp_path, self.manifest_path())
+
+    def stat_input(self, path, manifest):
+        """Return (size, mtime, digest) for a blob file, reusing the digest
+        recorded in the manifest if the size and mtime didn't change"""
+        if path in self.stats:
+            size, mtime = self.stats[path]
+        else:
+            st = os.stat(path)
+            size, mtime = st.st_size, st.st_mtime
+        if manifest:
+            old = manifest["inputs"].get(path)
+            if old and old[0] == size and old[1] == mtime:
+                return size, mtime, old[2]
+        return size, mtime, hash_blob_file(path)
+
+    def encode_input(self, path, digest, manifest):
+        """Return (codec, stored size) for a blob file: its smallest
+        encoding, which may be no compression at all. The encoding recorded
+        in the manifest for the same content is reused if its codec is still
+        available. The file is read once, in COPY_CHUNK_SIZE chunks, but
+        LZ4 needs the whole blob in memory when it is available."""
+        if manifest:
+            old = manifest.get("encodings", {}).get(digest)
+            if old and old[0] in [CODEC_NONE] + available_codecs():
+                return old[0], old[1]
+
+        sizes = {CODEC_NONE: 0, CODEC_ZLIB: 0}
+        compressor = zlib.compressobj(9)
+        chunks = []
+        with open(path, "rb") as fp:
+            for data in iter(lambda: fp.read(COPY_CHUNK_SIZE), ""):
+                sizes[CODEC_NONE] += len(data)
+                sizes[CODEC_ZLIB] += len(compressor.compress(data))
+                if lz4_block:
+                    chunks.append(data)
+        sizes[CODEC_ZLIB] += len(compressor.flush())
+        if lz4_block:
+            sizes[CODEC_LZ4] = len(encode_blob("".join(chunks), CODEC_LZ4))
+
+        codec = min([CODEC_NONE] + available_codecs(), key=sizes.get)
+        return codec, sizes[codec]
+
+    def write_blob(self, fp, entry):
+        """Write the encoded data of a blob, streamed in COPY_CHUNK_SIZE
+        chunks except for LZ4"""
+        path, offset, dsize, digest, codec = entry
+        size = 0
+        with open(path, "rb") as dfp:
+            chunks = iter(lambda: dfp.read(COPY_CHUNK_SIZE), "")
+            for data in encode_blob_chunks(chunks, codec):
+                fp.write(data)
+                size += len(data)
+        if size != dsize:
+            raise Exception("%s changed while building the blobstore" % path)
+
+    def update_in_place(self, manifest, layout, datalist):
+        """Bring the existing blobstore up to date by rewriting only the
+        blobs whose content changed. Returns False if that isn't possible
+        because the layout changed or the blobstore was modified behind our
+        back."""
+        self.written = 0
+        if manifest["layout"] != layout:
+            return False
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        if [st.st_size, st.st_mtime, st.st_ino] != manifest["output"]:
+            return False
+
+        old_data = dict((offset, digest)
+                        for offset, digest in manifest["data"])
+        changed = [d for d in datalist if old_data.get(d[1]) != d[3]]
+
+        if changed:
+            # The blobstore is inconsistent until all the blobs are written,
+            # don't let an interrupted update pass for a complete one
+            os.unlink(self.manifest_path())
+            with open(self.path, "r+b") as fp:
+                for entry in changed:
+                    fp.seek(entry[1])
+                    self.write_blob(fp, entry)
+                    self.written = self.written + entry[2]
+        else:
+            # Nothing to write, but the output must still look newer than
+            # its inputs
+            os.utime(self.path, None)
+        return True
+
+    def write_full(self, meta, datalist, total_size):
+        # Write into a temporary file which gets renamed over the output
+        # once complete, so an interrupted build never leaves a truncated
+        # blobstore behind
+        outdir = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".blobstore-", dir=outdir)
+        try:
+            with os.fdopen(fd, "wb", COPY_CHUNK_SIZE) as fp:
+                # The superblock, the index and all the metablocks
+                fp.write(meta)
+
+                # Finally, all the data
+                for entry in datalist:
+                    self.write_blob(fp, entry)
+
+                assert fp.tell() == total_size
+
+            # mkstemp() creates the file with 0600 permissions
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0666 & ~umask)
+            os.rename(tmp_path, self.path)
+        except:
+            os.unlink(tmp_path)
+            raise
+        self.written = total_size
+
+
+class BlobStoreReader:
+    """Read-only view of a committed blobstore.
+
+    The file is memory-mapped and lookups walk the hash table and metablock
+    chains in place, exactly like the bootloader does. Blob data is returned
+    as a zero-copy slice of the mapping, which stays valid until close().
+    Compressed blobs are decompressed on demand, the most recently used
+    ones are cached.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, "rb")
+        try:
+            self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.fp.close()
+            raise Exception("Empty blobstore file: " + path)
+
+        if len(self.mm) < s_blobstore.size:
+            self.close()
+            raise Exception("Truncated blobstore header: " + path)
+
+        magic, version, total_size, hash_sz = s_blobstore.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise Exception("Bad blobstore magic: " + path)
+        if version not in SUPPORTED_VERSIONS:
+            self.close()
+            raise Exception("Unsupported blobstore version %d: %s" %
+                            (version, path))
+        if total_size > len(self.mm) or hash_sz == 0:
+            self.close()
+            raise Exception("Corrupt blobstore header: " + path)
+
+        self.version = version
+        self.total_size = total_size
+        self.hash_sz = hash_sz
+        self.num_buckets = 0
+        self.flags = 0
+        self.disp_start = 0
+        self.hash_start = s_blobstore.size
+        self.mb_struct = s_metablock
+        self.cache = collections.OrderedDict()
+
+        if version == VERSION_MPH:
+            self.num_buckets, self.flags = s_blobstore_v2.unpack_from(self.mm,
+                    s_blobstore.size)
+            if self.flags & BLOBSTORE_FLAG_CODECS:
+                self.mb_struct = s_metablock_codec
+            self.disp_start = s_blobstore.size + s_blobstore_v2.size
+            self.hash_start = (self.disp_start +
+                               s_displacement.size * self.num_buckets)
+            if (self.num_buckets == 0 or self.hash_start +
+                    s_hashitem.size * hash_sz > total_size):
+                self.close()
+                raise Exception("Corrupt blobstore header: " + path)
+
+        # Python 2 mmap objects only implement the old buffer interface
+        try:
+            self.view = memoryview(self.mm)
+        except TypeError:
+            self.view = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.view = None
+        self.cache = None
+        if self.mm:
+            self.mm.close()
+            self.mm = None
+        self.fp.close()
+
+    def _slice(self, offset, size):
+        if offset + size > self.total_size:
+            raise Exception("Blob data out of bounds at offset %d" % offset)
+        if self.view is not None:
+            return self.view[offset:offset + size]
+        return buffer(self.mm, offset, size)
+
+    def _bucket(self, index):
+        return s_hashitem.unpack_from(self.mm,
+                self.hash_start + index * s_hashitem.size)[0]
+
+    def _metablock(self, offset):
+        if offset + self.mb_struct.size > self.total_size:
+            raise Exception("Metablock out of bounds at offset %d" % offset)
+        return self.mb_struct.unpack_from(self.mm, offset)
+
+    def _first_offset(self, key, btype):
+        if self.version == VERSION:
+            return self._bucket(hash_blob_key(key, btype, self.hash_sz))
+
+        h1, h2, h3 = hash_blob_key_v2(key, btype)
+        d0, d1 = s_displacement.unpack_from(self.mm,
+                self.disp_start + (h1 % self.num_buckets) * s_displacement.size)
+        return self._bucket(mph_slot(h2, h3, d0, d1, self.hash_sz))
+
+    def lookup(self, key, btype):
+        """Reference lookup, as performed by the bootloader.
+
+        Returns a (metablock, probes) tuple where metablock is the unpacked
+        metablock for (key, btype) or None if not found, and probes is the
+        number of metablocks that had to be compared."""
+        probes = 0
+        if len(key) >= BLOB_KEY_LENGTH:
+            return None, probes
+
+        packed_key = key.ljust(BLOB_KEY_LENGTH, "\0")
+        offset = self._first_offset(key, btype)
+        while offset:
+            probes = probes + 1
+            mb = self._metablock(offset)
+            if mb[1] == btype and mb[0] == packed_key:
+                return mb, probes
+            offset = mb[2]
+        return None, probes
+
+    def get(self, key, btype):
+        """Return a read-only buffer with the blob data for (key, btype),
+        or None if the blobstore has no such entry."""
+        mb, probes = self.lookup(key, btype)
+        if mb is None:
+            return None
+        if len(mb) == 5 or mb[5] == CODEC_NONE:
+            return self._slice(mb[3], mb[4])
+        return self._decode(mb[3], mb[4], mb[5], mb[6])
+
+    def _decode(self, offset, size, codec, raw_size):
+        # Deduplicated blobs share the same data offset
+        data = self.cache.pop(offset, None)
+        if data is None:
+            data = decode_blob(self._slice(offset, size), codec, raw_size)
+            if len(self.cache) >= DECODE_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        self.cache[offset] = data
+        return data
+
+    def metablocks(self):
+        """Generate a MetaBlock for every entry, in hash table order."""
+        for i in xrange(self.hash_sz):
+            offset = self._bucket(i)
+            while offset:
+                fields = self._metablock(offset)
+                mkey, mtype, next_offset, data_offset, data_size = fields[:5]
+                mb = MetaBlock(mkey.rstrip("\0"), mtype, offset, data_offset,
+                               data_size, *fields[5:])
+                mb.next_offset = next_offset
+                yield mb
+                offset = next_offset
+
+    def __iter__(self):
+        for mb in self.metablocks():
+            yield (mb.key, mb.btype)
+
+    def chain_lengths(self):
+        """Generate the length of the metablock chain of every hash table
+        entry"""
+        for i in xrange(self.hash_sz):
+            length = 0
+            offset = self._bucket(i)
+            while offset:
+                length = length + 1
+                offset = self._metablock(offset)[2]
+            yield length
+
+    def data(self, mb):
+        """Return the decoded data for a MetaBlock from metablocks()"""
+        if mb.codec == CODEC_NONE:
+            return self._slice(mb.data_offset, mb.data_size)
+        return self._decode(mb.data_offset, mb.data_size, mb.codec,
+                            mb.raw_size)
+
+
+def type_name(btype):
+    for name, value in BLOB_TYPES.iteritems():
+        if value == btype:
+            return name
+    return str(btype)
+
+def parse_type(name):
+    if name in BLOB_TYPES:
+        return BLOB_TYPES[name]
+    try:
+        return int(name)
+    except ValueError:
+        raise Exception("Unknown blob type: " + name)
+
+def output(record, as_json, text):
+    if as_json:
+        sys.stdout.write(json.dumps(record, sort_keys=True) + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+def cmd_list(reader, args):
+    for mb in reader.metablocks():
+        digest = hashlib.sha1(reader.data(mb)).hexdigest()
+        record = {
+            "key": mb.key,
+            "type": type_name(mb.btype),
+            "offset": mb.data_offset,
+            "size": mb.data_size,
+            "raw_size": mb.raw_size,
+            "codec": CODEC_NAMES.get(mb.codec, str(mb.codec)),
+            "sha1": digest,
+            }
+        output(record, args.json, "%-40s %-8s %8d %-4s %s" %
+               (mb.key, record["type"], mb.raw_size, record["codec"], digest))
+    return 0
+
+def cmd_get(reader, args):
+    data = reader.get(args.key, parse_type(args.type))
+    if data is None:
+        sys.stderr.write("%s/%s not found\n" % (args.key, args.type))
+        return 1
+    if args.output:
+        with open(args.output, "wb") as fp:
+            fp.write(data)
+    else:
+        sys.stdout.write(data)
+    return 0
+
+def cmd_stats(reader, args):
+    hist = {}
+    for length in reader.chain_lengths():
+        hist[length] = hist.get(length, 0) + 1
+    entries = sum(l * n for l, n in hist.iteritems())
+
+    # Data reuse: how many entries point at each distinct blob
+    refs = {}
+    sizes = {}
+    raw_bytes = 0
+    for mb in reader.metablocks():
+        refs[mb.data_offset] = refs.get(mb.data_offset, 0) + 1
+        sizes[mb.data_offset] = mb.data_size
+        raw_bytes = raw_bytes + mb.raw_size
+    stored_bytes = sum(sizes.values())
+
+    record = {
+        "version": reader.version,
+        "flags": reader.flags,
+        "total_size": reader.total_size,
+        "hash_size": reader.hash_sz,
+        "num_buckets": reader.num_buckets,
+        "entries": entries,
+        "longest_chain": max(hist) if hist else 0,
+        "chain_histogram": dict((str(l), n) for l, n in hist.iteritems()),
+        "distinct_blobs": len(refs),
+        "shared_blobs": len([r for r in refs.values() if r > 1]),
+        "blob_bytes": raw_bytes,
+        "stored_bytes": stored_bytes,
+        }
+    if args.json:
+        output(record, True, None)
+        return 0
+
+    for k in ("version", "flags", "total_size", "hash_size", "num_buckets",
+              "entries", "longest_chain", "distinct_blobs", "shared_blobs",
+              "blob_bytes", "stored_bytes"):
+        print "%-16s %d" % (k + ":", record[k])
+    if hist:
+        print "chain lengths:"
+        print format_histogram(hist)
+    return 0
+
+def cmd_verify(reader, args):
+    errors = 0
+    count = 0
+    try:
+        for mb in reader.metablocks():
+            count = count + 1
+            problem = None
+            found, probes = reader.lookup(mb.key, mb.btype)
+            if found is None or found[3] != mb.data_offset:
+                problem = "unreachable through the hash table"
+            else:
+                try:
+                    reader.data(mb)
+                except Exception as e:
+                    problem = str(e)
+            if problem:
+                errors = errors + 1
+                output({"key": mb.key, "type": type_name(mb.btype),
+                        "error": problem}, args.json,
+                       "%s/%s: %s" % (mb.key, type_name(mb.btype), problem))
+    except Exception as e:
+        errors = errors + 1
+        output({"error": str(e)}, args.json, str(e))
+
+    if not args.json:
+        print "%d entries, %d errors" % (count, errors)
+    return 1 if errors else 0
 
-        for offset in hlist:
-            fp.write(s_hashitem.pack(offset))
+def main(argv):
+    import argparse
+    import signal
 
-        # Write all the metablocks
-        for mb in mblist:
-            fp.write(s_metablock.pack(mb.key, mb.btype, mb.next_offset,
-                     mb.data_offset, mb.data_size))
+    # Exit quietly when piped into head and the like
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-        # Finally, write all the data
-        for path in datalist:
-            with open(path) as dfp:
-                fp.write(dfp.read())
+    parser = argparse.ArgumentParser(description="Inspect a blobstore")
+    parser.add_argument("--json", action="store_true",
+                        help="print JSON lines instead of text")
+    parser.add_argument("blobstore", help="blobstore file")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("list", help="list all the entries")
+    p = sub.add_parser("get", help="print the blob for a key and type")
+    p.add_argument("key")
+    p.add_argument("type", help="one of %s or a number" %
+                   ", ".join(sorted(BLOB_TYPES)))
+    p.add_argument("--output", help="write the blob to this file")
+    sub.add_parser("stats", help="print chain length and data reuse "
+                   "statistics")
+    sub.add_parser("verify", help="check every entry can be looked up and "
+                   "its data read")
+    args = parser.parse_args(argv)
 
-        fp.close()
+    commands = {
+        "list": cmd_list,
+        "get": cmd_get,
+        "stats": cmd_stats,
+        "verify": cmd_verify,
+        }
+    try:
+        reader = BlobStoreReader(args.blobstore)
+    except Exception as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 2
+    with reader:
+        return commands[args.command](reader, args)
 
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
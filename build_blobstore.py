@@ -70,14 +70,43 @@ import os
 import sys, getopt
 import json
 import argparse
+from multiprocessing.pool import ThreadPool
 sys.path.append("device/intel/build/releasetools")
 import intel_common
 
-btypes = {
-    "oemvars" : blobstore.BLOB_TYPE_OEMVARS,
-    "dtb" : blobstore.BLOB_TYPE_DTB,
-    "bootvars" : blobstore.BLOB_TYPE_BOOTVARS
-    }
+btypes = blobstore.BLOB_TYPES
+
+def stat_blob(path):
+    """Return (path, realpath, size, mtime) for a candidate blob file, or
+    None if it doesn't exist"""
+    realpath = os.path.realpath(path)
+    try:
+        st = os.stat(realpath)
+    except OSError:
+        return None
+    return (path, realpath, st.st_size, st.st_mtime)
+
+def discover_blobs(paths, jobs):
+    """Stat all the candidate blob files at once. On network filesystems
+    the metadata round trips dominate, so they are issued from a pool of
+    threads. Returns a dictionary mapping the paths which exist to their
+    (realpath, size, mtime)."""
+    paths = list(set(paths))
+    if jobs > 1 and len(paths) > 1:
+        pool = ThreadPool(min(jobs, len(paths)))
+        try:
+            results = pool.map(stat_blob, paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(stat_blob, paths)
+
+    found = {}
+    for r in results:
+        if r:
+            found[r[0]] = r[1:]
+    return found
 
 def main(argv):
     args = None
@@ -93,6 +122,31 @@ def main(argv):
                         help="blobstore output file path. If omitted, just list dependencies")
         parser.add_argument("--device-map",required=False,
                         help="device mapping database")
+        parser.add_argument("--format-version", required=False, type=int,
+                        default=blobstore.VERSION,
+                        choices=blobstore.SUPPORTED_VERSIONS,
+                        help="blobstore format version to generate. Version 2 "
+                        "uses a minimal perfect hash and needs a loader which "
+                        "supports it")
+        parser.add_argument("--table-budget", required=False, type=int,
+                        help="maximum size in bytes of a version 1 hash table. "
+                        "If set, table sizes up to this budget are tried and "
+                        "the one with the shortest worst-case collision chain "
+                        "is used")
+        parser.add_argument("--incremental", action="store_true",
+                        help="keep a manifest of the inputs next to the output "
+                        "and only rewrite the blobs which changed since the "
+                        "last build")
+        parser.add_argument("--compress", action="store_true",
+                        help="store each blob with the smallest of the "
+                        "available codecs (zlib, LZ4 if the lz4 module is "
+                        "installed). Needs --format-version 2")
+        parser.add_argument("--stats", action="store_true",
+                        help="print the chain lengths of the hash table, "
+                        "which --table-budget always does")
+        parser.add_argument("--jobs", required=False, type=int, default=16,
+                        help="number of threads used to look up the blob "
+                        "files [default: 16]")
         args = parser.parse_args()
     except argparse.ArgumentError:
         sys.exit(1)
@@ -149,22 +203,42 @@ def main(argv):
         sys.stderr.write("No device mapping or 'devices' in JSON configuration")
         sys.exit(2)
 
+    found = discover_blobs(blobs.values(), args.jobs)
+
     if not args.output:
-        for v in set(blobs.values()):
-            if os.path.exists(v):
-                print v,
+        for v in found:
+            print v,
         sys.exit(0)
 
     #populate datastore
     db = blobstore.BlobStore(args.output)
     for k, v in blobs.iteritems():
         device_id, blobtype = k
-        if not os.path.exists(v):
+        if v not in found:
             sys.stderr.write(v + " doesn't exist, skipping\n");
             continue
 
-        db.add(device_id, blobtype, v)
-    db.commit()
+        realpath, size, mtime = found[v]
+        db.add(device_id, blobtype, v, realpath=realpath, size=size,
+               mtime=mtime)
+    if args.compress and args.format_version != blobstore.VERSION_MPH:
+        sys.stderr.write("Error: --compress needs --format-version %d\n" %
+                         blobstore.VERSION_MPH)
+        sys.exit(2)
+
+    db.commit(args.format_version, table_budget=args.table_budget,
+              incremental=args.incremental, compress=args.compress)
+    if not db.written:
+        print "Blobstore is up to date"
+    elif db.written < os.path.getsize(args.output):
+        print "Blobstore updated in place, %d bytes written" % db.written
+    if db.histogram and (args.stats or args.table_budget):
+        print "Blobstore hash table chain lengths:"
+        print blobstore.format_histogram(db.histogram)
+    if db.bytes_saved:
+        print "Deduplicated blob data, %d bytes saved" % db.bytes_saved
+    if db.bytes_compressed:
+        print "Compressed blob data, %d bytes saved" % db.bytes_compressed
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -25,15 +25,29 @@ if version_info < (2, 7, 3):
 from logging import (debug, info, error, DEBUG, INFO, getLogger,
                      basicConfig)
 from argparse import ArgumentParser
-from os import remove, stat
-from os.path import isfile, normcase, normpath, realpath
-from struct import unpack, pack
+from os import (remove, rename, stat, fstat, lseek, write, utime, makedirs,
+                getpid, fsync, SEEK_SET)
+from os.path import isdir, isfile, normcase, normpath, realpath
+from struct import unpack, pack, calcsize, error as StructError
 from uuid import UUID, uuid4
 from binascii import crc32
-from re import compile as re_compile
-from collections import namedtuple
-from ConfigParser import SafeConfigParser, ParsingError, NoOptionError
+from collections import namedtuple, OrderedDict
 from math import floor, log
+from operator import attrgetter
+from itertools import chain
+from cStringIO import StringIO
+from subprocess import Popen, PIPE
+from distutils.spawn import find_executable
+from errno import (EINVAL, ENOSYS, ENOTTY, EOPNOTSUPP, EXDEV, EBADF, EPERM,
+                   ENXIO)
+from fcntl import ioctl
+from time import time
+from io import FileIO
+from multiprocessing.pool import ThreadPool
+from hashlib import sha1
+import json
+import ctypes
+import ctypes.util
 
 
 class MBRInfos(object):
@@ -122,15 +136,21 @@ class MBRInfos(object):
             self.dummy_2, self.dummy_3, self.sign \
             = unpack(MBRInfos._FMT, self.raw)
 
-    def write(self, img_file, offset=0):
+    def pack(self):
         """
-        Used to write MBR in an image file
+        Used to build the raw MBR
         """
         self.raw = pack(MBRInfos._FMT, self.boot, self.os_type,
                         self.lba_start, self.lba_size, '',
                         MBRInfos._PART_ENTRY, '', self.sign)
+        return self.raw
+
+    def write(self, img_file, offset=0):
+        """
+        Used to write MBR in an image file
+        """
         img_file.seek(offset)
-        img_file.write(self.raw)
+        img_file.write(self.pack())
 
 
 class GPTHeaderInfos(object):
@@ -272,42 +292,17 @@ class GPTHeaderInfos(object):
             self.lba_start, self.table_length, self.entry_size, \
             self.table_crc = unpack(GPTHeaderInfos._FMT, self.raw)
 
-    def write(self, img_file, offset, block_size):
+    def pack(self, lba_current, lba_backup, lba_start, table_crc):
         """
-        Used to write GPT header and backup in an image file
+        Used to build a raw GPT header, or its backup, with its CRC32
         """
-        self.raw = pack(GPTHeaderInfos._FMT, self.sign, self.rev,
-                        self.size, 0, 1, self.lba_backup,
-                        self.lba_first, self.lba_last, self.uuid,
-                        2, self.table_length, self.entry_size, 0)
-
-        backup_raw = pack(GPTHeaderInfos._FMT, self.sign, self.rev,
-                          self.size, 0, self.lba_backup, 1,
-                          self.lba_first, self.lba_last, self.uuid,
-                          self.lba_start, self.table_length,
-                          self.entry_size, 0)
-
-        # writes a new GPT header
-        img_file.seek(offset)
-        img_file.write(self.raw)
-
-        # writes zero on unused blocks of GPT header
-        raw_stuffing = '\x00' * (block_size - len(self.raw))
-        img_file.write(raw_stuffing)
-
-        # saves the end of the GPT header
-        gpt_header_end = img_file.tell()
-
-        # writes a new GPT backup
-        backup_position = self.lba_backup * block_size
-        img_file.seek(backup_position)
-        img_file.write(backup_raw)
-
-        # writes zero on unused blocks of GPT backup
-        img_file.write(raw_stuffing)
+        raw = pack(GPTHeaderInfos._FMT, self.sign, self.rev, self.size, 0,
+                   lba_current, lba_backup, self.lba_first, self.lba_last,
+                   self.uuid, lba_start, self.table_length, self.entry_size,
+                   table_crc)
+        crc = crc32(raw[:self.size]) & 0xffffffff
 
-        # sets the read pointer at the end of GPT header wrote
-        img_file.seek(gpt_header_end)
+        return '{0}{1}{2}'.format(raw[:16], pack('<I', crc), raw[20:])
 
 
 class PartTableInfos(list):
@@ -337,37 +332,16 @@ class PartTableInfos(list):
         img_file.seek(offset)
         self.raw = img_file.read(length * entry_size)
 
-        # reads each entry of partition table
+        # reads each used entry of partition table, the type of unused ones
+        # is zero
+        unused = '\x00' * 16
         for i in xrange(length):
+            if self.raw[i * entry_size:i * entry_size + 16] == unused:
+                continue
             entry = TableEntryInfos(i, entry_size)
             entry.read(self.raw)
             self.append(entry)
 
-    def write(self, img_file, offset, entry_size, tlb_infos, last_usable):
-        """
-        Used to write GPT partitions tables in an image file
-        """
-        # erases the partition table entries
-        self = []
-
-        # writes all new partition entries in GPT header
-        current_offset = offset
-        for pos, part_info in enumerate(tlb_infos):
-            entry = TableEntryInfos(pos, entry_size)
-            entry.write(img_file, current_offset, part_info)
-            current_offset += entry_size
-            self.append(entry)
-
-        # copies all partition entries wrote from GPT header to
-        # the GPT backup
-        img_file.seek(offset)
-        raw_entries_size = current_offset - offset
-        raw_entries = img_file.read(raw_entries_size)
-        img_file.seek(last_usable + 1)
-        img_file.write(raw_entries)
-
-        img_file.seek(current_offset)
-
 
 class TableEntryInfos(object):
     """
@@ -437,9 +411,9 @@ class TableEntryInfos(object):
         self.type, self.uuid, self.lba_first, self.lba_last, self.attr, \
             self.name = unpack(TableEntryInfos._FMT, self.raw)
 
-    def write(self, img_file, offset, entry_info):
+    def pack(self, entry_info):
         """
-        Use to write a partition table entries in an image file
+        Used to build a raw partition table entry
         """
         types = {
             'Unused': '00000000-0000-0000-0000-000000000000',
@@ -479,9 +453,974 @@ class TableEntryInfos(object):
         self.raw = pack(TableEntryInfos._FMT, tuuid, puuid,
                         int(entry_info.begin), last, 0,
                         entry_info.label.encode('utf-16le'))
+        self.type, self.uuid, self.lba_first, self.lba_last, self.attr, \
+            self.name = unpack(TableEntryInfos._FMT, self.raw)
 
+        return self.raw
+
+    def write(self, img_file, offset, entry_info):
+        """
+        Use to write a partition table entries in an image file
+        """
         img_file.seek(offset)
-        img_file.write(self.raw)
+        img_file.write(self.pack(entry_info))
+
+
+class GPTLayout(object):
+    """
+    In memory layout of the GPT/UEFI metadata of an image: the MBR, the GPT
+    header, the partition table and their backups, with their CRC32. It's
+    serialized without any file access, each structure is written once:
+
+    +------------------------+---------------------------------------------+
+    | offset                 | raw data                                    |
+    +========================+=============================================+
+    | 0                      | primary: MBR, GPT header and partition      |
+    |                        | table, in whole blocks                      |
+    +------------------------+---------------------------------------------+
+    | lba_start * block size | backup: partition table and GPT header, in  |
+    |                        | whole blocks, up to the end of the image    |
+    +------------------------+---------------------------------------------+
+    """
+    __slots__ = ('block_size', 'table', 'table_crc', 'primary', 'backup',
+                 'backup_offset')
+
+    def __init__(self, mbr, gpt_header, tlb_infos, block_size):
+        self.block_size = block_size
+
+        # packs the partition table entries
+        self.table = PartTableInfos()
+        for pos, part_info in enumerate(tlb_infos):
+            entry = TableEntryInfos(pos, gpt_header.entry_size)
+            entry.pack(part_info)
+            self.table.append(entry)
+
+        self.table.raw = ''.join(entry.raw for entry in self.table) \
+            .ljust(gpt_header.table_length * gpt_header.entry_size, '\x00')
+        self.table_crc = crc32(self.table.raw) & 0xffffffff
+
+        # the partition table is stored in whole blocks
+        raw_table = self.table.raw.ljust(self.blocks(len(self.table.raw)) *
+                                         block_size, '\x00')
+
+        raw_header = gpt_header.pack(1, gpt_header.lba_backup, 2,
+                                     self.table_crc)
+        raw_backup = gpt_header.pack(gpt_header.lba_backup, 1,
+                                     gpt_header.lba_start, self.table_crc)
+
+        self.primary = '{0}{1}{2}'.format(
+            mbr.pack().ljust(block_size, '\x00'),
+            raw_header.ljust(block_size, '\x00'), raw_table)
+        self.backup = '{0}{1}'.format(raw_table,
+                                      raw_backup.ljust(block_size, '\x00'))
+        self.backup_offset = gpt_header.lba_start * block_size
+
+    def blocks(self, size):
+        """
+        Number of blocks needed to store size Bytes
+        """
+        return -(-size // self.block_size)
+
+    def serialize(self):
+        """
+        Returns the (offset, raw data) tuples of the layout
+        """
+        return [(0, self.primary), (self.backup_offset, self.backup)]
+
+    def write(self, img_file):
+        """
+        Used to write the layout in an image file, the blocks of zeros are
+        left as holes
+        """
+        for offset, data in self.serialize():
+            for start, end in FileCopier.nonzero_runs(data):
+                img_file.seek(offset + start)
+                img_file.write(buffer(data, start, end - start))
+
+
+class SparseImageWriter(object):
+    """
+    Writer of Android sparse images
+
+    Data is given with increasing offsets of the expanded image. Blocks of
+    data are stored as RAW chunks, blocks filled with a repeated 32 bits
+    value (usually zero) as FILL chunks and ranges which are never written
+    as DONT_CARE chunks.
+
+    Sparse image format:
+    +-----------------+-------------------------------------------------------+
+    | file header     | magic, version, header sizes, block size, total       |
+    | (28 bytes)      | blocks, total chunks, checksum                        |
+    +-----------------+-------------------------------------------------------+
+    | chunk header    | type (RAW 0xCAC1, FILL 0xCAC2, DONT_CARE 0xCAC3),     |
+    | (12 bytes)      | reserved, size in blocks, total size in bytes         |
+    +-----------------+-------------------------------------------------------+
+    | chunk data      | RAW: the blocks, FILL: the 32 bits value,             |
+    |                 | DONT_CARE: nothing                                    |
+    +-----------------+-------------------------------------------------------+
+    | ...             |                                                       |
+    +-----------------+-------------------------------------------------------+
+    """
+    __slots__ = ('img_file', 'size', 'blk_sz', 'blocks', 'partial',
+                 'chunk_type', 'chunk_blocks', 'chunk_data', 'fill_value',
+                 'total_chunks', 'zero_block')
+
+    MAGIC = 0xed26ff3a
+
+    _HEADER_FMT = '<IHHHHIIII'
+    _CHUNK_FMT = '<HHII'
+
+    CHUNK_RAW = 0xcac1
+    CHUNK_FILL = 0xcac2
+    CHUNK_DONT_CARE = 0xcac3
+
+    # maximum size of a RAW chunk kept in memory before being written
+    _MAX_RAW_CHUNK = 16 * 1024 * 1024
+
+    def __init__(self, img_file, size, blk_sz=4096):
+        if size % blk_sz:
+            error('Image size {0} is not a multiple of the sparse block size'
+                  ' {1}'.format(size, blk_sz))
+            exit(-1)
+
+        self.img_file = img_file
+        self.size = size
+        self.blk_sz = blk_sz
+
+        # number of blocks emitted so far and data of the next block, when it
+        # is only partially known
+        self.blocks = 0
+        self.partial = ''
+
+        # the chunk being accumulated
+        self.chunk_type = None
+        self.chunk_blocks = 0
+        self.chunk_data = []
+        self.fill_value = 0
+
+        self.total_chunks = 0
+        self.zero_block = '\x00' * blk_sz
+
+        # the header is written again with the right counts by close()
+        self.img_file.seek(0)
+        self._write_header()
+
+    def _write_header(self):
+        self.img_file.write(pack(SparseImageWriter._HEADER_FMT,
+                                 SparseImageWriter.MAGIC, 1, 0,
+                                 calcsize(SparseImageWriter._HEADER_FMT),
+                                 calcsize(SparseImageWriter._CHUNK_FMT),
+                                 self.blk_sz, self.size / self.blk_sz,
+                                 self.total_chunks, 0))
+
+    def _flush_chunk(self):
+        """
+        Write the chunk being accumulated
+        """
+        if not self.chunk_blocks:
+            return
+
+        if self.chunk_type == SparseImageWriter.CHUNK_RAW:
+            data = ''.join(self.chunk_data)
+        elif self.chunk_type == SparseImageWriter.CHUNK_FILL:
+            data = pack('<I', self.fill_value)
+        else:
+            data = ''
+
+        self.img_file.write(pack(SparseImageWriter._CHUNK_FMT,
+                                 self.chunk_type, 0, self.chunk_blocks,
+                                 calcsize(SparseImageWriter._CHUNK_FMT) +
+                                 len(data)))
+        self.img_file.write(data)
+
+        self.total_chunks += 1
+        self.chunk_type = None
+        self.chunk_blocks = 0
+        self.chunk_data = []
+
+    def _add_chunk_blocks(self, chunk_type, count, data=None, fill_value=0):
+        if (self.chunk_type != chunk_type or
+                (chunk_type == SparseImageWriter.CHUNK_FILL and
+                 self.fill_value != fill_value) or
+                (chunk_type == SparseImageWriter.CHUNK_RAW and
+                 self.chunk_blocks * self.blk_sz >=
+                 SparseImageWriter._MAX_RAW_CHUNK)):
+            self._flush_chunk()
+            self.chunk_type = chunk_type
+            self.fill_value = fill_value
+
+        self.chunk_blocks += count
+        if data is not None:
+            self.chunk_data.append(data)
+        self.blocks += count
+
+    def _add_block(self, block):
+        """
+        Add a complete block of data
+        """
+        if block == self.zero_block:
+            self._add_chunk_blocks(SparseImageWriter.CHUNK_FILL, 1)
+        elif block[:4] * (self.blk_sz / 4) == block:
+            self._add_chunk_blocks(SparseImageWriter.CHUNK_FILL, 1,
+                                   fill_value=unpack('<I', block[:4])[0])
+        else:
+            self._add_chunk_blocks(SparseImageWriter.CHUNK_RAW, 1, data=block)
+
+    def _skip_to(self, offset):
+        """
+        Leave the range up to offset unwritten
+        """
+        current = self.blocks * self.blk_sz + len(self.partial)
+        if offset < current:
+            error('Overlapping writes in sparse image at offset {0}'
+                  .format(offset))
+            exit(-1)
+
+        if self.partial:
+            block_end = (self.blocks + 1) * self.blk_sz
+            if offset < block_end:
+                self.partial += '\x00' * (offset - current)
+                return
+            self._add_block(self.partial.ljust(self.blk_sz, '\x00'))
+            self.partial = ''
+            current = block_end
+
+        skipped = (offset - current) / self.blk_sz
+        if skipped:
+            self._add_chunk_blocks(SparseImageWriter.CHUNK_DONT_CARE, skipped)
+        self.partial = '\x00' * ((offset - current) % self.blk_sz)
+
+    def write(self, offset, data):
+        """
+        Write data at the given offset of the expanded image, offsets must
+        be increasing
+        """
+        self._skip_to(offset)
+
+        if self.partial:
+            needed = self.blk_sz - len(self.partial)
+            self.partial += data[:needed]
+            data = data[needed:]
+            if len(self.partial) < self.blk_sz:
+                return
+            self._add_block(self.partial)
+            self.partial = ''
+
+        end = len(data) - len(data) % self.blk_sz
+        for start in xrange(0, end, self.blk_sz):
+            self._add_block(data[start:start + self.blk_sz])
+        self.partial = data[end:]
+
+    def close(self):
+        """
+        Complete the image up to its size and update the header
+        """
+        self._skip_to(self.size)
+        self._flush_chunk()
+
+        self.img_file.seek(0)
+        self._write_header()
+
+
+class StreamImageWriter(object):
+    """
+    Writer of raw images in a stream, like the input of a compressor
+
+    Data is given with increasing offsets of the image, the ranges which are
+    never written are generated as zeros.
+    """
+    __slots__ = ('out_file', 'size', 'position')
+
+    _ZERO = '\x00' * (1024 * 1024)
+
+    def __init__(self, out_file, size):
+        self.out_file = out_file
+        self.size = size
+        self.position = 0
+
+    def _fill_to(self, offset):
+        """
+        Write zeros up to offset
+        """
+        if offset < self.position:
+            error('Overlapping writes in streamed image at offset {0}'
+                  .format(offset))
+            exit(-1)
+
+        while self.position < offset:
+            zero = StreamImageWriter._ZERO[:offset - self.position]
+            self.out_file.write(zero)
+            self.position += len(zero)
+
+    def write(self, offset, data):
+        """
+        Write data at the given offset of the image, offsets must be
+        increasing
+        """
+        self._fill_to(offset)
+        self.out_file.write(data)
+        self.position += len(data)
+
+    def close(self):
+        """
+        Complete the image up to its size
+        """
+        self._fill_to(self.size)
+
+
+class SparseImageReader(object):
+    """
+    Reader of Android sparse images, see SparseImageWriter for the format
+    """
+    __slots__ = ('bin_file', 'blk_sz', 'total_blks', 'total_chunks',
+                 'chunk_hdr_sz')
+
+    _CHUNK_CRC32 = 0xcac4
+
+    def __init__(self, bin_file):
+        self.bin_file = bin_file
+
+        header_size = calcsize(SparseImageWriter._HEADER_FMT)
+        raw = bin_file.read(header_size)
+        magic, major, _, file_hdr_sz, self.chunk_hdr_sz, self.blk_sz, \
+            self.total_blks, self.total_chunks, _ \
+            = unpack(SparseImageWriter._HEADER_FMT, raw)
+
+        if magic != SparseImageWriter.MAGIC or major != 1:
+            error('Invalid sparse image: {0}'.format(bin_file.name))
+            exit(-1)
+
+        # skips the end of the header, if the header is bigger than expected
+        bin_file.seek(file_hdr_sz)
+
+    @classmethod
+    def is_sparse(cls, bin_path):
+        """
+        Checks if a file is an Android sparse image
+        """
+        with open(bin_path, 'rb') as bin_file:
+            magic = bin_file.read(4)
+
+        return magic == pack('<I', SparseImageWriter.MAGIC)
+
+    @property
+    def size(self):
+        """
+        Size of the expanded image in Bytes
+        """
+        return self.total_blks * self.blk_sz
+
+    def chunks(self, chunk_size):
+        """
+        Generates (offset, data) tuples with the content of the expanded
+        image. Data of RAW chunks are read and data of FILL chunks are
+        generated by pieces of chunk_size Bytes at most, DONT_CARE chunks
+        produce nothing.
+        """
+        chunk_fmt = SparseImageWriter._CHUNK_FMT
+        offset = 0
+        for _ in xrange(self.total_chunks):
+            chunk_type, _, chunk_blocks, total_sz \
+                = unpack(chunk_fmt, self.bin_file.read(calcsize(chunk_fmt)))
+            self.bin_file.seek(self.chunk_hdr_sz - calcsize(chunk_fmt), 1)
+            length = chunk_blocks * self.blk_sz
+
+            if chunk_type == SparseImageWriter.CHUNK_RAW:
+                remaining = length
+                while remaining:
+                    data = self.bin_file.read(min(chunk_size, remaining))
+                    if not data:
+                        error('Truncated sparse image: {0}'
+                              .format(self.bin_file.name))
+                        exit(-1)
+                    yield offset + length - remaining, data
+                    remaining -= len(data)
+
+            elif chunk_type == SparseImageWriter.CHUNK_FILL:
+                value = self.bin_file.read(4)
+                # piece size is a multiple of the 4 bytes pattern
+                piece = value * (min(chunk_size, length) / 4)
+                for start in xrange(0, length, len(piece)):
+                    yield offset + start, piece[:length - start]
+
+            elif chunk_type == SparseImageReader._CHUNK_CRC32:
+                self.bin_file.seek(total_sz - self.chunk_hdr_sz, 1)
+
+            elif chunk_type != SparseImageWriter.CHUNK_DONT_CARE:
+                error('Unknown chunk type 0x{0:04x} in sparse image: {1}'
+                      .format(chunk_type, self.bin_file.name))
+                exit(-1)
+
+            offset += length
+
+
+class FileCopier(object):
+    """
+    Copies binary files in an image at a given offset. The copy is done by
+    the kernel when it's possible, the methods are tried in this order:
+
+        +-----------------+-------------------------------------------------+
+        | reflink         | FICLONERANGE ioctl, shares the file system      |
+        |                 | blocks, only the block aligned part of the file |
+        +-----------------+-------------------------------------------------+
+        | copy_file_range | in kernel copy, Linux 4.5 and glibc 2.27        |
+        +-----------------+-------------------------------------------------+
+        | sendfile        | in kernel copy, Linux 2.6.33                    |
+        +-----------------+-------------------------------------------------+
+        | readinto        | copy through a big user space buffer            |
+        +-----------------+-------------------------------------------------+
+
+    Python 2 exposes neither copy_file_range nor sendfile, they are called
+    from the libc with ctypes. A method failing because the kernel, the libc
+    or the file system doesn't support it is disabled for the next copies,
+    the next method copies what remains.
+
+    Only the data extents of the source file, found with SEEK_DATA and
+    SEEK_HOLE, are copied and the readinto method seeks over the zero
+    blocks, so the image stays sparse on disk.
+    """
+    __slots__ = ('disabled',)
+
+    METHODS = ('reflink', 'copy_file_range', 'sendfile', 'readinto')
+
+    # _IOW(0x94, 13, struct file_clone_range)
+    _FICLONERANGE = 0x4020940d
+
+    # errors meaning the copy method is unusable for these files
+    _UNSUPPORTED = (EINVAL, ENOSYS, ENOTTY, EOPNOTSUPP, EXDEV, EBADF, EPERM)
+
+    # larger chunks are truncated by the kernel
+    _KERNEL_CHUNK = 1024 * 1024 * 1024
+
+    _BUFFER_SIZE = 8 * 1024 * 1024
+
+    # blocks of zeros smaller than this are written
+    HOLE_BLOCK_SIZE = 4096
+
+    # lseek whence values of Linux, not defined by Python 2
+    _SEEK_DATA = 3
+    _SEEK_HOLE = 4
+
+    _libc = None
+
+    def __init__(self):
+        self.disabled = set()
+
+    @classmethod
+    def _get_libc(cls):
+        """
+        Loads the libc on first use
+        """
+        if cls._libc is None:
+            cls._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                    use_errno=True)
+        return cls._libc
+
+    @classmethod
+    def _check(cls, ret):
+        """
+        Raises an OSError if a libc call failed
+        """
+        if ret < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'libc call failed')
+        return ret
+
+    @classmethod
+    def nonzero_runs(cls, data, start=0, end=None):
+        """
+        Generates (start, end) tuples of the runs of data between start and
+        end which are not made of zero blocks
+        """
+        if end is None:
+            end = len(data)
+        if data.count('\0', start, end) == end - start:
+            return
+
+        run_start = None
+        for pos in xrange(start, end, cls.HOLE_BLOCK_SIZE):
+            blk_end = min(pos + cls.HOLE_BLOCK_SIZE, end)
+            if data.count('\0', pos, blk_end) == blk_end - pos:
+                if run_start is not None:
+                    yield run_start, pos
+                    run_start = None
+            elif run_start is None:
+                run_start = pos
+
+        if run_start is not None:
+            yield run_start, end
+
+    @classmethod
+    def _data_extents(cls, src_fd, pos, length):
+        """
+        Generates (start, end) tuples of the data extents of a file between
+        pos and length, the whole range if the file system can't tell
+        """
+        while pos < length:
+            try:
+                start = lseek(src_fd, pos, cls._SEEK_DATA)
+            except OSError as err:
+                # no more data, the end of the file is a hole
+                if err.errno == ENXIO:
+                    return
+                if err.errno != EINVAL:
+                    raise
+                yield pos, length
+                return
+
+            if start >= length:
+                return
+            end = min(lseek(src_fd, start, cls._SEEK_HOLE), length)
+            yield start, end
+            pos = end
+
+    def _reflink(self, src_fd, src_offset, dst_fd, dst_offset, length):
+        """
+        Shares the block aligned part of the source file with the image
+        """
+        blk_size = fstat(dst_fd).st_blksize
+        length -= length % blk_size
+        if not length or dst_offset % blk_size or src_offset % blk_size:
+            return 0
+
+        ioctl(dst_fd, FileCopier._FICLONERANGE,
+              pack('=qQQQ', src_fd, src_offset, length, dst_offset))
+        return length
+
+    def _copy_file_range(self, src_fd, src_offset, dst_fd, dst_offset,
+                         length):
+        """
+        Copies with the copy_file_range syscall
+        """
+        copy_file_range = getattr(self._get_libc(), 'copy_file_range', None)
+        if copy_file_range is None:
+            raise OSError(ENOSYS, 'copy_file_range not in the libc')
+
+        off_in = ctypes.c_int64(src_offset)
+        off_out = ctypes.c_int64(dst_offset)
+        done = 0
+        while done < length:
+            count = self._check(copy_file_range(
+                src_fd, ctypes.byref(off_in), dst_fd, ctypes.byref(off_out),
+                ctypes.c_size_t(min(length - done, self._KERNEL_CHUNK)), 0))
+            if not count:
+                break
+            done += count
+
+        return done
+
+    def _sendfile(self, src_fd, src_offset, dst_fd, dst_offset, length):
+        """
+        Copies with the sendfile syscall, it writes at the current position
+        of the image
+        """
+        sendfile = self._get_libc().sendfile64
+        offset = ctypes.c_int64(src_offset)
+        lseek(dst_fd, dst_offset, SEEK_SET)
+        done = 0
+        while done < length:
+            count = self._check(sendfile(
+                dst_fd, src_fd, ctypes.byref(offset),
+                ctypes.c_size_t(min(length - done, self._KERNEL_CHUNK))))
+            if not count:
+                break
+            done += count
+
+        return done
+
+    def _readinto(self, src_fd, src_offset, dst_fd, dst_offset, length):
+        """
+        Copies through a big buffer, the zero blocks are seeked over
+        """
+        data = bytearray(self._BUFFER_SIZE)
+        view = memoryview(data)
+        src_file = FileIO(src_fd, 'rb', closefd=False)
+        src_file.seek(src_offset)
+        done = 0
+        while done < length:
+            count = src_file.readinto(view[:min(length - done, len(view))])
+            if not count:
+                break
+            for start, end in self.nonzero_runs(data, 0, count):
+                lseek(dst_fd, dst_offset + done + start, SEEK_SET)
+                while start < end:
+                    start += write(dst_fd, view[start:end])
+            done += count
+
+        return done
+
+    @classmethod
+    def clear(cls, dst_file, offset, length):
+        """
+        Zeroes a range of a file, by punching a hole if the file system
+        supports it
+        """
+        dst_file.flush()
+        fallocate = getattr(cls._get_libc(), 'fallocate64', None)
+        if fallocate is not None:
+            # FALLOC_FL_KEEP_SIZE | FALLOC_FL_PUNCH_HOLE
+            ret = fallocate(dst_file.fileno(), 0x01 | 0x02,
+                            ctypes.c_int64(offset), ctypes.c_int64(length))
+            if ret == 0:
+                return
+            debug('Punching a hole failed: errno {0}'
+                  .format(ctypes.get_errno()))
+
+        zero = '\x00' * min(length, cls._BUFFER_SIZE)
+        dst_file.seek(offset)
+        while length > 0:
+            dst_file.write(zero[:length])
+            length -= len(zero)
+
+    def copy(self, src_file, dst_file, dst_offset, length, src_offset=0):
+        """
+        Copies length Bytes of the source file from src_offset in the
+        destination file at the given offset. Returns the list of methods
+        used.
+        """
+        # the Python buffers are not seen by the kernel
+        dst_file.flush()
+        src_fd = src_file.fileno()
+        dst_fd = dst_file.fileno()
+
+        used = []
+        for start, end in self._data_extents(src_fd, src_offset,
+                                             src_offset + length):
+            self._copy_range(src_fd, start, dst_fd,
+                             dst_offset + start - src_offset, end - start,
+                             used)
+
+        return used
+
+    def _copy_range(self, src_fd, src_offset, dst_fd, dst_offset, length,
+                    used):
+        """
+        Copies a range of the source file with the first methods which work,
+        the methods used are added to the used list
+        """
+        done = 0
+        for method in FileCopier.METHODS:
+            if done >= length:
+                break
+            if method in self.disabled:
+                continue
+
+            try:
+                count = getattr(self, '_' + method)(
+                    src_fd, src_offset + done, dst_fd, dst_offset + done,
+                    length - done)
+
+            except (OSError, IOError) as err:
+                if err.errno not in FileCopier._UNSUPPORTED or \
+                   method == 'readinto':
+                    raise
+                debug('Copy method {0} unsupported: {1}'
+                      .format(method, err.strerror))
+                self.disabled.add(method)
+                continue
+
+            if count:
+                if method not in used:
+                    used.append(method)
+                done += count
+
+        if done < length:
+            error('Short copy: {0} Bytes of {1}, file truncated?'
+                  .format(done, length))
+            exit(-1)
+
+
+class ImageDelta(object):
+    """
+    Block level delta between two images, to patch the old image into the
+    new one
+
+    Delta format, little-endian:
+    +-----------------+-------------------------------------------------------+
+    | header          | magic 'GPTDELTA', version, block size, old and new    |
+    | (72 bytes)      | image sizes, SHA-1 of the old and of the new data of  |
+    |                 | the ranges, number of ranges                          |
+    +-----------------+-------------------------------------------------------+
+    | range header    | offset and length in Bytes of the range               |
+    | (16 bytes)      |                                                       |
+    +-----------------+-------------------------------------------------------+
+    | range data      | the data of the new image                             |
+    +-----------------+-------------------------------------------------------+
+    | ...             |                                                       |
+    +-----------------+-------------------------------------------------------+
+
+    A range is made of consecutive blocks which differ between the images.
+    The old data SHA-1 checks the delta is applied to the right image, the
+    new data SHA-1 checks the patched image.
+
+    Before patching, the old data of the ranges is saved in a journal next
+    to the image, in the same format. An interrupted patch leaves the
+    journal behind: the next apply restores the old data from it first.
+    """
+    __slots__ = ('blk_size', 'ranges')
+
+    MAGIC = 'GPTDELTA'
+    VERSION = 1
+
+    _HEADER_FMT = '<8sIIQQ20s20sI'
+    _RANGE_FMT = '<QQ'
+
+    # the images are compared by segments of SEGMENT_SIZE Bytes in parallel
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    _CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, blk_size=4096):
+        self.blk_size = blk_size
+        self.ranges = []
+
+    def _compare_segment(self, task):
+        """
+        Returns the (offset, length) ranges of the blocks which differ in a
+        segment of the images
+        """
+        old_path, new_path, start, end = task
+        ranges = []
+        with open(old_path, 'rb') as old_file, open(new_path, 'rb') as new_file:
+            old_file.seek(start)
+            new_file.seek(start)
+            for offset in xrange(start, end, self._CHUNK_SIZE):
+                size = min(self._CHUNK_SIZE, end - offset)
+                old_data = old_file.read(size)
+                new_data = new_file.read(size)
+                if old_data == new_data:
+                    continue
+
+                for pos in xrange(0, len(new_data), self.blk_size):
+                    if old_data[pos:pos + self.blk_size] == \
+                            new_data[pos:pos + self.blk_size]:
+                        continue
+                    length = min(self.blk_size, len(new_data) - pos)
+                    if ranges and sum(ranges[-1]) == offset + pos:
+                        ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+                    else:
+                        ranges.append((offset + pos, length))
+
+        return ranges
+
+    def compare(self, old_path, new_path, jobs=1):
+        """
+        Finds the ranges of blocks of the new image which differ from the old
+        image, the segments of the images are compared by jobs threads
+        """
+        new_size = stat(new_path).st_size
+        tasks = [(old_path, new_path, start,
+                  min(start + ImageDelta.SEGMENT_SIZE, new_size))
+                 for start in xrange(0, new_size, ImageDelta.SEGMENT_SIZE)]
+
+        if jobs > 1 and len(tasks) > 1:
+            pool = ThreadPool(min(jobs, len(tasks)))
+            try:
+                results = pool.map(self._compare_segment, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._compare_segment(task) for task in tasks]
+
+        # merges the ranges spanning several segments
+        self.ranges = []
+        for offset, length in chain.from_iterable(results):
+            if self.ranges and sum(self.ranges[-1]) == offset:
+                self.ranges[-1] = (self.ranges[-1][0],
+                                   self.ranges[-1][1] + length)
+            else:
+                self.ranges.append((offset, length))
+
+        return self.ranges
+
+    @classmethod
+    def _copy_range(cls, src_file, offset, length, digest, dst_file=None):
+        """
+        Reads a range of a file, hashes it and writes it in dst_file if given
+        """
+        src_file.seek(offset)
+        while length > 0:
+            data = src_file.read(min(length, cls._CHUNK_SIZE))
+            if not data:
+                break
+            digest.update(data)
+            if dst_file is not None:
+                dst_file.write(data)
+            length -= len(data)
+
+    def write(self, old_path, new_path, delta_path):
+        """
+        Writes the delta of the ranges found by compare
+        """
+        old_digest = sha1()
+        new_digest = sha1()
+        header_size = calcsize(ImageDelta._HEADER_FMT)
+
+        with open(old_path, 'rb') as old_file, \
+                open(new_path, 'rb') as new_file, \
+                open(delta_path, 'wb') as delta_file:
+            delta_file.seek(header_size)
+            for offset, length in self.ranges:
+                delta_file.write(pack(ImageDelta._RANGE_FMT, offset, length))
+                self._copy_range(old_file, offset, length, old_digest)
+                self._copy_range(new_file, offset, length, new_digest,
+                                 delta_file)
+
+            delta_file.seek(0)
+            delta_file.write(pack(ImageDelta._HEADER_FMT, ImageDelta.MAGIC,
+                                  ImageDelta.VERSION, self.blk_size,
+                                  stat(old_path).st_size,
+                                  stat(new_path).st_size,
+                                  old_digest.digest(), new_digest.digest(),
+                                  len(self.ranges)))
+
+    @classmethod
+    def _read_ranges(cls, delta_file, count):
+        """
+        Generates the (offset, length) of the ranges of a delta, the delta
+        file is positioned on the data of each range
+        """
+        range_size = calcsize(cls._RANGE_FMT)
+        position = calcsize(cls._HEADER_FMT)
+        for _ in xrange(count):
+            delta_file.seek(position)
+            offset, length = unpack(cls._RANGE_FMT,
+                                    delta_file.read(range_size))
+            yield offset, length
+            position += range_size + length
+
+    @classmethod
+    def journal_path(cls, img_path):
+        """
+        Path of the journal of the patch of an image
+        """
+        return '{0}.journal'.format(img_path)
+
+    @classmethod
+    def _write_journal(cls, img_file, delta_file, header, journal_path):
+        """
+        Saves the data of the image overwritten by a delta, the journal
+        only exists once complete
+        """
+        _, _, blk_size, old_size, new_size, _, _, count = header
+        header_size = calcsize(cls._HEADER_FMT)
+        digest = sha1()
+        saved = 0
+
+        tmp_path = '{0}.tmp'.format(journal_path)
+        with open(tmp_path, 'wb') as journal_file:
+            journal_file.seek(header_size)
+            for offset, length in cls._read_ranges(delta_file, count):
+                # the data beyond the old image is dropped by the truncate
+                length = min(length, old_size - offset)
+                if length <= 0:
+                    continue
+                journal_file.write(pack(cls._RANGE_FMT, offset, length))
+                cls._copy_range(img_file, offset, length, digest,
+                                journal_file)
+                saved += 1
+
+            # the journal is the delta from the new image to the old one,
+            # only the SHA-1 of the saved data is known
+            journal_file.seek(0)
+            journal_file.write(pack(cls._HEADER_FMT, cls.MAGIC, cls.VERSION,
+                                    blk_size, new_size, old_size, '\0' * 20,
+                                    digest.digest(), saved))
+            journal_file.flush()
+            fsync(journal_file.fileno())
+        rename(tmp_path, journal_path)
+
+    @classmethod
+    def _rollback(cls, img_path, journal_path):
+        """
+        Restores the data of an image saved in its journal then removes the
+        journal
+        """
+        with open(journal_path, 'rb') as journal_file, \
+                open(img_path, 'r+b') as img_file:
+            header = journal_file.read(calcsize(cls._HEADER_FMT))
+            try:
+                magic, version, _, _, old_size, _, old_sha1, count = \
+                    unpack(cls._HEADER_FMT, header)
+            except StructError:
+                magic = version = None
+
+            digest = sha1()
+            if magic == cls.MAGIC and version == cls.VERSION:
+                for offset, length in cls._read_ranges(journal_file, count):
+                    img_file.seek(offset)
+                    cls._copy_range(journal_file, journal_file.tell(), length,
+                                    digest, img_file)
+            if magic != cls.MAGIC or version != cls.VERSION or \
+                    digest.digest() != old_sha1:
+                error('The journal {0} is corrupted, the image {1} can\'t be '
+                      'restored'.format(journal_path, img_path))
+                exit(-1)
+
+            img_file.truncate(old_size)
+            img_file.flush()
+            fsync(img_file.fileno())
+
+        remove(journal_path)
+
+    @classmethod
+    def apply(cls, img_path, delta_path):
+        """
+        Patches in place an image with a delta, returns the number of ranges
+        written
+        """
+        journal_path = cls.journal_path(img_path)
+
+        with open(delta_path, 'rb') as delta_file:
+            header = delta_file.read(calcsize(cls._HEADER_FMT))
+            try:
+                header = unpack(cls._HEADER_FMT, header)
+                magic, version, _, old_size, new_size, old_sha1, new_sha1, \
+                    count = header
+            except StructError:
+                magic = version = None
+
+            if magic != cls.MAGIC or version != cls.VERSION:
+                error('Invalid image delta: {0}'.format(delta_path))
+                exit(-1)
+
+            # undoes the patch which was interrupted
+            if isfile(journal_path):
+                info('Restoring {0} from the journal {1}'
+                     .format(img_path, journal_path))
+                cls._rollback(img_path, journal_path)
+
+            with open(img_path, 'r+b') as img_file:
+                # checks the delta applies to this image before writing
+                digest = sha1()
+                if fstat(img_file.fileno()).st_size == old_size:
+                    for offset, length in cls._read_ranges(delta_file, count):
+                        cls._copy_range(img_file, offset, length, digest)
+                if digest.digest() != old_sha1 or \
+                        fstat(img_file.fileno()).st_size != old_size:
+                    error('The delta {0} doesn\'t apply to the image {1}'
+                          .format(delta_path, img_path))
+                    exit(-1)
+
+                cls._write_journal(img_file, delta_file, header, journal_path)
+
+                digest = sha1()
+                for offset, length in cls._read_ranges(delta_file, count):
+                    img_file.seek(offset)
+                    cls._copy_range(delta_file, delta_file.tell(), length,
+                                    digest, img_file)
+                img_file.truncate(new_size)
+                img_file.flush()
+                fsync(img_file.fileno())
+
+        if digest.digest() != new_sha1:
+            cls._rollback(img_path, journal_path)
+            error('The delta {0} is corrupted, the image {1} is restored'
+                  .format(delta_path, img_path))
+            exit(-1)
+
+        remove(journal_path)
+        return count
 
 
 TLB_INFO = namedtuple('TLB_INFO', ('begin', 'size', 'type', 'uuid', 'label'))
@@ -490,126 +1429,221 @@ TLB_INFO = namedtuple('TLB_INFO', ('begin', 'size', 'type', 'uuid', 'label'))
 class TLBInfos(list):
     """
     TLB information extracted from the TLB partition file
+
+    The file is read in a single pass by a tokenizer which understands both
+    dialects:
+    - tbl: a "partition_table=gpt" line then one
+      "add -b <begin> -s <size> -t <type> -u <uuid> -l <label>" line by
+      partition
+    - INI: a [base] section with the partitions list, which is extended by
+      the non standard "partitions += ..." lines, and the start_lba, then a
+      [partition.<name>] section by partition with its label, len in MiB,
+      type and guid. Comments, continuation lines, the DEFAULT section and
+      the "%(option)s" references follow SafeConfigParser.
     """
     __slots__ = ('path', 'format')
 
+    # version of the layouts stored in the cache
+    CACHE_VERSION = 2
+
+    # maximum depth of the "%(option)s" references of INI values, as
+    # SafeConfigParser
+    MAX_INTERPOLATION_DEPTH = 10
+
+    # options of the tbl "add" lines
+    _TBL_OPTIONS = {'-b': 'begin', '-s': 'size', '-t': 'type', '-u': 'uuid',
+                    '-l': 'label'}
+
     def __init__(self, path):
         super(TLBInfos, self).__init__()
         self.path = path
-        self._set_format()
+        self.format = None
 
     def __repr__(self):
-        result = ''
-
-        for item in self:
-            line = ('add -b {0} -s {1} -t {2} -u {3} -l {4}'
-                    '\n').format(item.begin, item.size, item.type, item.uuid,
-                                 item.label)
-            result = '{0}{1}'.format(result, line)
+        return ''.join('add -b {0} -s {1} -t {2} -u {3} -l {4}\n'
+                       .format(item.begin, item.size, item.type, item.uuid,
+                               item.label) for item in self)
 
-        return result
-
-    def _set_format(self):
+    def _invalid(self, message):
         """
-        Identify the format of the TLB partition file
+        Reports an invalid TLB partition file and exits
         """
-        self.format = 'ini'
-
-        with open(self.path, 'r') as tlb_file:
-            for line in tlb_file:
-                # determines the type of partition table file
-                # If file contains "partition_table=gpt" pattern then
-                # it's a JSON TLB partition file,
-                # else it's probably an INI TLB partition file.
-                # Parser will then check if the file is correct.
-                tlb_file_type_found = line.find("partition_table=gpt")
-
-                if tlb_file_type_found != -1:
-                    self.format = 'tbl'
-                    break
-
-        debug('Partition table format: {0}'.format(self.format))
+        error('Invalid TLB partition file {0}: {1}'.format(self.path, message))
+        exit(-1)
 
-    def _read_json(self, block_size):
+    def _tokenize(self, data):
         """
-        Used to read a JSON TLB partition file
+        Splits the TLB partition file in the "add" lines of the tbl dialect
+        and the sections of the INI dialect, in a single pass. The INI lines
+        are split as SafeConfigParser does. Returns the list of "add" lines
+        options, the sections, the partitions added by "partitions +=" lines
+        and the invalid INI lines.
         """
-        with open(self.path, 'r') as tlb_file:
-            re_parser = re_compile(r'^add\s-b\s(?P<begin>\w+)\s-s\s'
-                                   '(?P<size>[\w$()-]+)\s-t\s'
-                                   '(?P<type>\w+)\s-u\s'
-                                   '(?P<uuid>[\w-]+)\s'
-                                   '-l\s(?P<label>\w+)'
-                                   )
-            # reads the JSON TLB file to instantiate a the TLBInfos
-            for line in tlb_file:
+        verbose = getLogger().isEnabledFor(DEBUG)
+        adds = []
+        sections = {}
+        extra_partitions = []
+        invalid = []
+        section = None
+        key = None
+
+        for line in data.splitlines():
+            if verbose:
                 debug('TLB reading line: {0}'.format(line))
-                parsed_line = re_parser.match(line)
 
-                if parsed_line:
-                    debug('TLB parsed line: {0}'.format(line))
-                    debug('\t begin: {0}'
-                          .format(parsed_line.group('begin')))
-                    debug('\t size: {0}'.format(parsed_line.group('size')))
-                    debug('\t type: {0}'.format(parsed_line.group('type')))
-                    debug('\t uuid: {0}'.format(parsed_line.group('uuid')))
-                    debug('\t label: {0}'
-                          .format(parsed_line.group('label')))
+            if 'partition_table=gpt' in line:
+                self.format = 'tbl'
 
-                    self.append(TLB_INFO(*parsed_line.groups()))
+            # "partitions += ..." extends the partitions list, wherever it is
+            words = self._strip_comment(line).split()
+            if len(words) > 2 and words[0] == 'partitions' and \
+                    words[1] == '+=':
+                extra_partitions.extend(words[2:])
+                key = None
+                continue
 
-                else:
+            stripped = line.strip()
+            if not stripped or line[0] in '#;' or \
+                    (line[0] in 'rR' and words[0].lower() == 'rem'):
+                continue
+
+            # continuation of the previous INI value
+            if line[0].isspace() and key is not None:
+                section[key] = '{0}\n{1}'.format(section[key], stripped)
+                continue
+
+            key = None
+            if stripped.startswith('add '):
+                words = stripped.split()
+                adds.append(dict((TLBInfos._TBL_OPTIONS.get(option), value)
+                                 for option, value
+                                 in zip(words[1::2], words[2::2])))
+
+            elif line[0] == '[' and line.find(']') > 1:
+                section = sections.setdefault(line[1:line.find(']')], {})
+
+            elif section is not None and not line[0].isspace() and \
+                    line[0] not in ':=' and \
+                    (':' in line or '=' in line):
+                sep = min(pos for pos in (line.find('='), line.find(':'))
+                          if pos >= 0)
+                key = line[:sep].strip().lower()
+                value = self._strip_comment(line[sep + 1:]).strip()
+                section[key] = '' if value == '""' else value
+
+            else:
+                invalid.append(stripped)
+                if verbose:
                     debug('TLB not parsed line: {0}'.format(line))
 
-    def _preparse_partitions(self, cfg):
+        return adds, sections, extra_partitions, invalid
+
+    @classmethod
+    def _strip_comment(cls, value):
         """
-        Taken from gpt_ini2bin.py
+        Removes an inline comment from an INI value, it starts with a ";"
+        preceded by a space
         """
-        with open(self.path, 'r') as f:
-            data = f.read()
-
-            partitions = cfg.get('base', 'partitions').split()
+        pos = value.find(';')
+        if pos > 0 and value[pos - 1].isspace():
+            return value[:pos]
+        return value
 
-            for l in data.split('\n'):
-                words = l.split()
-                if len(words) > 2:
-                    if words[0] == 'partitions' and words[1] == '+=':
-                        partitions += words[2:]
+    def _ini_get(self, sections, name, key, depth=0):
+        """
+        Value of an option of an INI section, or of the DEFAULT section,
+        with its "%(option)s" references replaced as SafeConfigParser does
+        """
+        if key in sections.get(name, {}):
+            value = sections[name][key]
+        else:
+            value = sections.get('DEFAULT', {})[key]
+
+        if depth > TLBInfos.MAX_INTERPOLATION_DEPTH:
+            self._invalid('interpolation loop in [{0}] {1}'.format(name, key))
+
+        result = []
+        while '%' in value:
+            pos = value.find('%')
+            result.append(value[:pos])
+            end = value.find(')', pos)
+            if value[pos + 1:pos + 2] == '%':
+                result.append('%')
+                value = value[pos + 2:]
+            elif value[pos + 1:pos + 2] == '(' and end > 0 and \
+                    value[end + 1:end + 2] == 's':
+                ref = value[pos + 2:end].lower()
+                try:
+                    result.append(self._ini_get(sections, name, ref,
+                                                depth + 1))
+                except KeyError:
+                    self._invalid('unknown option {0} referenced in [{1}] {2}'
+                                  .format(ref, name, key))
+                value = value[end + 2:]
+            else:
+                self._invalid('"%" must be followed by "%" or "(" in [{0}] '
+                              '{1}'.format(name, key))
+        result.append(value)
 
-        return partitions
+        return ''.join(result)
 
-    def _read_ini(self, block_size):
+    def _read_tbl(self, adds):
         """
-        Used to read a INI TLB partition file
+        Used to read the partitions of a tbl TLB partition file
         """
-        # sets a parser to read the INI TLB partition file
-        cfg = SafeConfigParser()
-        try:
-            cfg.read(self.path)
-
-        except ParsingError:
-            error('Invalid TLB partition file: {0}'.format(self.path))
-            exit(-1)
+        for options in adds:
+            try:
+                self.append(TLB_INFO(int(options['begin']),
+                                     int(options['size']), options['type'],
+                                     options['uuid'], options['label']))
+            except (KeyError, ValueError):
+                self._invalid('add line with options {0}'.format(
+                    ' '.join(sorted(key for key in options if key))))
+
+    def _read_ini(self, sections, extra_partitions, invalid, block_size):
+        """
+        Used to read the partitions of an INI TLB partition file
+        """
+        if invalid:
+            self._invalid('line "{0}"'.format(invalid[0]))
+        if 'base' not in sections:
+            self._invalid('no [base] section')
 
-        # gpt.ini is not a "standard" ini file because keys are not uniques
-        partitionList = self._preparse_partitions(cfg)
+        try:
+            partitions = self._ini_get(sections, 'base', 'partitions').split()
+        except KeyError:
+            self._invalid('no partitions in [base]')
+        partitions += extra_partitions
 
         # sets the start lba value which the read value or uses the default
         # value
         try:
-            start_lba_prev = cfg.getint('base', 'start_lba')
+            start_lba_prev = int(self._ini_get(sections, 'base', 'start_lba'))
             debug('The start_lab value read in the TLB partition file')
 
-        except NoOptionError:
+        except KeyError:
             start_lba_prev = 2048
             info('The start_lab value is undefined in the TLB partition file,'
                  ' the default value is used: {0}'.format(start_lba_prev))
 
+        except ValueError:
+            self._invalid('start_lba of [base]')
+
         # contructs the TLB info
-        for part in partitionList:
+        for part in partitions:
             begin = start_lba_prev
             partname = 'partition.{0}'.format(part)
-            readlen = cfg.getint(partname, 'len')
+            if partname not in sections:
+                self._invalid('no [{0}] section'.format(partname))
+            try:
+                readlen = int(self._ini_get(sections, partname, 'len'))
+                ptype = self._ini_get(sections, partname, 'type')
+                uuid = self._ini_get(sections, partname, 'guid')
+                label = self._ini_get(sections, partname, 'label')
+            except KeyError as err:
+                self._invalid('{0} missing in [{1}]'.format(err, partname))
+            except ValueError:
+                self._invalid('len of [{0}]'.format(partname))
 
             if readlen > 0:
                 size = (readlen * 1024 * 1024) / block_size
@@ -617,22 +1651,80 @@ class TLBInfos(list):
             else:
                 size = readlen
 
-            ptype = cfg.get(partname, 'type')
-            uuid = cfg.get(partname, 'guid')
-            label = cfg.get(partname, 'label')
             self.append(TLB_INFO(begin, size, ptype, uuid, label))
 
     def read(self, block_size):
         """
         Read a TLB file
         """
-        # reads the JSON TLB partition file
-        if self.format == 'tbl':
-            self._read_json(block_size)
+        with open(self.path, 'r') as tlb_file:
+            data = tlb_file.read()
+
+        # If file contains "partition_table=gpt" pattern then it's a tbl TLB
+        # partition file, else it's probably an INI TLB partition file.
+        self.format = 'ini'
+        adds, sections, extra_partitions, invalid = self._tokenize(data)
+        debug('Partition table format: {0}'.format(self.format))
 
-        # reads the INI TLB partition file
+        if self.format == 'tbl':
+            self._read_tbl(adds)
         else:
-            self._read_ini(block_size)
+            self._read_ini(sections, extra_partitions, invalid, block_size)
+
+    def read_layout(self, img_size, block_size, entry_size, table_length,
+                    cache_dir=None):
+        """
+        Read a TLB file and compute the size of its last entry. The resolved
+        layout is kept in cache_dir, keyed on the content of the TLB file,
+        the image size and the block size, so the next reads of the same
+        layout skip the parsing.
+        """
+        cache_path = None
+        if cache_dir:
+            with open(self.path, 'rb') as tlb_file:
+                key = sha1(tlb_file.read())
+            key.update(repr((TLBInfos.CACHE_VERSION, img_size, block_size,
+                             entry_size, table_length)))
+            cache_path = '{0}/{1}.json'.format(cache_dir, key.hexdigest())
+
+            try:
+                with open(cache_path) as cache_file:
+                    cached = json.load(cache_file)
+                self.format = str(cached['format'])
+                if not isinstance(cached['partitions'], list):
+                    raise TypeError('partitions is not a list')
+                self.extend(TLB_INFO(begin, size, str(ptype), str(uuid),
+                                     str(label))
+                            for begin, size, ptype, uuid, label
+                            in cached['partitions'])
+                for entry in self:
+                    if not isinstance(entry.begin, (int, long)) or \
+                            not isinstance(entry.size, (int, long)):
+                        raise TypeError('{0} is not a partition'
+                                        .format(entry))
+                debug('Layout read from the cache: {0}'.format(cache_path))
+                return
+            except IOError:
+                del self[:]
+            except (ValueError, KeyError, TypeError) as exc:
+                # a corrupted entry is parsed again and replaced
+                debug('Invalid layout cache entry {0}: {1}'
+                      .format(cache_path, exc))
+                del self[:]
+
+        self.read(block_size)
+        self.compute_last_size_entry(img_size, block_size, entry_size,
+                                     table_length)
+
+        if cache_path:
+            if not isdir(cache_dir):
+                makedirs(cache_dir)
+            tmp_path = '{0}.{1}.tmp'.format(cache_path, getpid())
+            with open(tmp_path, 'w') as cache_file:
+                json.dump({'format': self.format,
+                           'partitions': [list(entry) for entry in self]},
+                          cache_file)
+            rename(tmp_path, cache_path)
 
     def _recompute_partition_begin(self):
         """
@@ -705,6 +1797,22 @@ class GPTImage(object):
         'config',
         ]
 
+    # largest range of a binary file written by a task
+    TASK_SIZE = 64 * 1024 * 1024
+
+    # commands compressing their standard input to their standard output,
+    # by order of preference
+    COMPRESSORS = {
+        'gzip': (['pigz', '-c'], ['gzip', '-c']),
+        'xz': (['xz', '-T0', '-c'],),
+        'zstd': (['zstd', '-T0', '-q', '-c'],),
+        }
+
+    # suffix and format version of the manifest kept next to raw images to
+    # update them in place
+    MANIFEST_SUFFIX = '.manifest'
+    MANIFEST_VERSION = 1
+
     def __init__(self, path, size='5G', block_size=512, gpt_header_size=92):
 
         self.path = path
@@ -783,67 +1891,60 @@ class GPTImage(object):
             self.table.read(img_file, offset, self.gpt_header.table_length,
                             self.gpt_header.entry_size)
 
-    def _write_crc(self, img_file):
+    @classmethod
+    def _binary_size(cls, bin_path):
         """
-        Calculate and write CRC32 of GPT partition table, header and backup
+        Size in Bytes of the data of a binary file, once expanded if it's an
+        Android sparse image
         """
-        # reads partition tables
-        img_file.seek(2 * self.block_size)
-        raw_table = img_file.read(self.gpt_header.table_length *
-                                  self.gpt_header.entry_size)
-        img_file.seek((self.gpt_header.lba_backup - 32) * self.block_size)
-        raw_backup_table = img_file.read(self.gpt_header.table_length *
-                                         self.gpt_header.entry_size)
-
-        # computes CRC 32 partition tables
-        table_crc = crc32(raw_table) & 0xffffffff
-        backup_table_crc = crc32(raw_backup_table) & 0xffffffff
-
-        # creates raw with the calculated CRC32 of partition tables
-        raw_table_crc = pack('<I', table_crc)
-        raw_backup_table_crc = pack('<I', backup_table_crc)
-
-        # writes the calculated CRC 32 of partition table in GPT header
-        img_file.seek(self.block_size + 88)
-        img_file.write(raw_table_crc)
-
-        # writes the calculated CRC 32 of partition table in GPT backup
-        img_file.seek(self.size - self.block_size + 88)
-        img_file.write(raw_backup_table_crc)
-
-        # reads the GPT header
-        img_file.seek(self.block_size)
-        raw_header = img_file.read(self.gpt_header.size)
-
-        # calcultates the CRC 32 of GPT header
-        header_crc = crc32(raw_header) & 0xffffffff
-
-        # creates a raw with the calculated CRC32 of GPT header
-        raw_header_crc = pack('<I', header_crc)
-
-        # writes calculated CRC 32 of GPT header
-        img_file.seek(self.block_size + 16)
-        img_file.write(raw_header_crc)
+        if SparseImageReader.is_sparse(bin_path):
+            with open(bin_path, 'rb') as bin_file:
+                return SparseImageReader(bin_file).size
 
-        # reads the GPT backup
-        img_file.seek(self.size - self.block_size)
-        raw_backup = img_file.read(self.gpt_header.size)
+        return stat(bin_path).st_size
 
-        # calcultates CRC 32 of GPT backup
-        backup_crc = crc32(raw_backup) & 0xffffffff
+    @classmethod
+    def _read_binary(cls, bin_path, chunk_size):
+        """
+        Generates (offset, data) tuples with the content of a binary file.
+        Android sparse images are expanded on the fly, their DONT_CARE chunks
+        are skipped.
+        """
+        with open(bin_path, 'rb') as bin_file:
+            if SparseImageReader.is_sparse(bin_path):
+                for chunk in SparseImageReader(bin_file).chunks(chunk_size):
+                    yield chunk
+                return
 
-        # creates a raw with the calculated CRC32 of GPT backup
-        raw_backup_crc = pack('<I', backup_crc)
+            offset = 0
+            while True:
+                data = bin_file.read(chunk_size)
+                if not data:
+                    break
+                yield offset, data
+                offset += len(data)
 
-        # writes the calculated CRC 32 of GPT backup
-        img_file.seek(self.size - self.block_size + 16)
-        img_file.write(raw_backup_crc)
+    def _check_binary_size(self, tlb_part, bin_path):
+        """
+        Checks if partition size is greather or equal to the binary file
+        """
+        bin_size = self._binary_size(bin_path) / self.block_size
+        if tlb_part.size < bin_size:
+            error('Size of binary file {0} ({1} Bytes) is greather than '
+                  '{2} partition size ({3} Bytes)'.format(bin_path,
+                                                          bin_size,
+                                                          tlb_part.label,
+                                                          tlb_part.size))
+            exit(-1)
 
-    def _write_partitions(self, img_file, tlb_infos, binaries_path):
+    def _partition_tasks(self, tlb_infos, binaries_path):
         """
-        Used to write partitions of image with binary files given. Call by
-        write method
+        Splits the write of the partitions in tasks writing disjoint ranges of
+        the image: (label, binary path, partition offset, binary offset,
+        length) tuples. Android sparse images are written by a single task,
+        the other binary files by tasks of TASK_SIZE Bytes at most.
         """
+        tasks = []
         for tlb_part in tlb_infos:
             # removes the prefix "android_"
             truncated_label = tlb_part.label[8:]
@@ -854,88 +1955,604 @@ class GPTImage(object):
             # computes the partition offset
             offset = int(tlb_part.begin) * self.block_size
 
-            # no binary file used to build the partition
+            # no binary file used to build the partition, left as a hole
             if bin_path == 'none':
-                line = '\0x00'
-                img_file.seek(offset)
-                img_file.write(line)
-                bin_size = 0
                 continue
 
             # checks if partition size is greather or equal to the binary file
-            bin_size = stat(bin_path).st_size / self.block_size
-            if tlb_part.size < bin_size:
-                error('Size of binary file {0} ({1} Bytes) is greather than '
-                      '{2} partition size ({3} Bytes)'.format(bin_path,
-                                                              bin_size,
-                                                              tlb_part.label,
-                                                              tlb_part.size))
-                exit(-1)
+            self._check_binary_size(tlb_part, bin_path)
 
-            # opens and reads the binary file to write the partition
+            if SparseImageReader.is_sparse(bin_path):
+                tasks.append((tlb_part.label, bin_path, offset, 0, None))
+                continue
+
+            length = stat(bin_path).st_size
+            for bin_offset in xrange(0, length, GPTImage.TASK_SIZE):
+                tasks.append((tlb_part.label, bin_path, offset, bin_offset,
+                              min(GPTImage.TASK_SIZE, length - bin_offset)))
+
+        return tasks
+
+    def _write_task(self, img_file, copier, task):
+        """
+        Writes a range of a partition, returns the number of Bytes written,
+        the methods used and the time spent
+        """
+        label, bin_path, offset, bin_offset, length = task
+        debug('Writing partition {0} from {1} Bytes'
+              .format(label, bin_offset))
+        start_time = time()
+
+        # Android sparse images are expanded directly in the partition
+        if length is None:
+            methods = ['sparse']
+            length = 0
+            for bin_offset, data in self._read_binary(bin_path, 1024 * 1024):
+                for start, end in FileCopier.nonzero_runs(data):
+                    img_file.seek(offset + bin_offset + start)
+                    img_file.write(buffer(data, start, end - start))
+                length += len(data)
+            # the data is written when the task ends
+            img_file.flush()
+
+        # the other binary files are copied by the kernel if possible
+        else:
             with open(bin_path, 'rb') as bin_file:
+                methods = copier.copy(bin_file, img_file, offset + bin_offset,
+                                      length, bin_offset)
+
+        return label, length, methods, time() - start_time
+
+    def _write_partitions(self, img_file, tlb_infos, binaries_path, jobs=1):
+        """
+        Used to write partitions of image with binary files given. Call by
+        write method. With several jobs, the tasks are run by a thread pool,
+        each thread writes through its own file descriptors.
+        """
+        copier = FileCopier()
+        tasks = self._partition_tasks(tlb_infos, binaries_path)
+
+        if jobs > 1 and len(tasks) > 1:
+            # the Python buffers of the image are not seen by the threads
+            img_file.flush()
+
+            def run_task(task):
+                with open(self.path, 'r+b') as task_file:
+                    return self._write_task(task_file, copier, task)
+
+            pool = ThreadPool(min(jobs, len(tasks)))
+            try:
+                results = pool.map(run_task, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._write_task(img_file, copier, task)
+                       for task in tasks]
+
+        # sums the results of the tasks by partition
+        partitions = OrderedDict()
+        for label, length, methods, elapsed in results:
+            total = partitions.setdefault(label, [0, [], 0])
+            total[0] += length
+            total[1].extend(method for method in methods
+                            if method not in total[1])
+            total[2] += elapsed
+
+        for label, (length, methods, elapsed) in partitions.iteritems():
+            elapsed = max(elapsed, 1e-6)
+            info('Partition {0}: {1} Bytes written with {2} in {3:.3f}s'
+                 ' ({4:.1f} MiB/s)'
+                 .format(label, length, '+'.join(methods) or 'none',
+                         elapsed, length / elapsed / (1024 * 1024)))
+
+        return sum(length for length, _, _ in partitions.itervalues())
+
+    def manifest_path(self):
+        """
+        Path of the manifest of the image
+        """
+        return self.path + GPTImage.MANIFEST_SUFFIX
+
+    def _load_manifest(self):
+        """
+        Returns the manifest of the image, or None if there's no usable one
+        """
+        try:
+            with open(self.manifest_path()) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, ValueError):
+            return None
+
+        if manifest.get('version') != GPTImage.MANIFEST_VERSION:
+            return None
+
+        return manifest
+
+    def _save_manifest(self, inputs):
+        """
+        Writes the manifest of the image: its signature and the signatures of
+        the binaries of its partitions
+        """
+        img_stat = stat(self.path)
+        manifest = {
+            'version': GPTImage.MANIFEST_VERSION,
+            'image': [img_stat.st_size, img_stat.st_mtime, img_stat.st_ino],
+            'block_size': self.block_size,
+            'partitions': inputs,
+            }
+
+        tmp_path = '{0}.tmp'.format(self.manifest_path())
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, sort_keys=True)
+        rename(tmp_path, self.manifest_path())
+
+    def _remove_manifest(self):
+        """
+        Removes the manifest, the image doesn't match it anymore
+        """
+        if isfile(self.manifest_path()):
+            remove(self.manifest_path())
+
+    @classmethod
+    def _input_signature(cls, bin_path, old=None):
+        """
+        Signature of a binary file: its size, mtime, SHA-1 and the length of
+        its data. The signature recorded in the manifest is reused if the
+        size and mtime of the file didn't change.
+        """
+        bin_stat = stat(bin_path)
+        if old and old['size'] == bin_stat.st_size and \
+           old['mtime'] == bin_stat.st_mtime:
+            return old
+
+        digest = sha1()
+        with open(bin_path, 'rb') as bin_file:
+            while True:
+                data = bin_file.read(1024 * 1024)
+                if not data:
+                    break
+                digest.update(data)
+
+        signature = {'size': bin_stat.st_size, 'mtime': bin_stat.st_mtime,
+                     'sha1': digest.hexdigest(),
+                     'length': cls._binary_size(bin_path)}
+
+        # the partition of an Android sparse image holds its expanded data
+        if SparseImageReader.is_sparse(bin_path):
+            signature['data_sha1'] = cls._data_digest(bin_path,
+                                                      signature['length'])
+
+        return signature
+
+    @classmethod
+    def _data_digest(cls, bin_path, length):
+        """
+        SHA-1 of the data of a binary file once written in a partition, the
+        DONT_CARE chunks of Android sparse images are read as zeros
+        """
+        digest = sha1()
+        zero = '\x00' * (1024 * 1024)
+        pos = 0
+        for offset, data in chain(cls._read_binary(bin_path, len(zero)),
+                                  [(length, '')]):
+            while pos < offset:
+                digest.update(zero[:offset - pos])
+                pos += min(len(zero), offset - pos)
+            digest.update(data)
+            pos += len(data)
+
+        return digest.hexdigest()
+
+    def _input_signatures(self, tlb_infos, binaries_path, manifest=None,
+                          jobs=1):
+        """
+        Signatures of the binary files of the partitions, by partition label
+        """
+        old_inputs = manifest['partitions'] if manifest else {}
+        parts = [(tlb_part.label, binaries_path[tlb_part.label[8:]])
+                 for tlb_part in tlb_infos
+                 if binaries_path[tlb_part.label[8:]] != 'none']
+
+        def signature(part):
+            label, bin_path = part
+            return self._input_signature(bin_path, old_inputs.get(label))
+
+        if jobs > 1 and len(parts) > 1:
+            pool = ThreadPool(min(jobs, len(parts)))
+            try:
+                signatures = pool.map(signature, parts)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            signatures = [signature(part) for part in parts]
+
+        return dict((label, sig) for (label, _), sig in zip(parts, signatures))
+
+    @classmethod
+    def _partition_ranges(cls, table):
+        """
+        LBA ranges of the used entries of a partition table
+        """
+        unused = '\x00' * 16
+        return [(entry.lba_first, entry.lba_last) for entry in table
+                if entry.type != unused]
+
+    def update(self, tlb_infos, binaries_path, jobs=1):
+        """
+        Used to update in place an existing GPT/UEFI image. Only the
+        partitions whose binary changed, according to the manifest of the
+        image, are rewritten, and the GPT headers and partition tables only
+        if they changed. Returns False if that isn't possible because there
+        is no manifest, the image was modified behind our back or the
+        partitions moved.
+        """
+        manifest = self._load_manifest()
+        if manifest is None:
+            info('No manifest for the GPT/UEFI image: {0}'.format(self.path))
+            return False
+
+        try:
+            img_stat = stat(self.path)
+        except OSError:
+            return False
+
+        if [img_stat.st_size, img_stat.st_mtime, img_stat.st_ino] \
+                != manifest['image'] or img_stat.st_size != self.size or \
+                manifest['block_size'] != self.block_size:
+            info('The GPT/UEFI image doesn\'t match its manifest: {0}'
+                 .format(self.path))
+            return False
+
+        with open(self.path, 'r+b') as img_file:
+            # keeps the disk GUID of the image
+            header = GPTHeaderInfos(self.size, self.block_size,
+                                    self.gpt_header.size)
+            header.read(img_file, self.block_size)
+            self.gpt_header.uuid = header.uuid
+            layout = self.layout(tlb_infos)
+
+            # checks the partitions didn't move
+            table = PartTableInfos()
+            table.read(img_file, 2 * self.block_size, header.table_length,
+                       header.entry_size)
+            if self._partition_ranges(table) != \
+                    self._partition_ranges(layout.table):
+                info('The partitions of the GPT/UEFI image moved: {0}'
+                     .format(self.path))
+                return False
+
+            inputs = self._input_signatures(tlb_infos, binaries_path,
+                                            manifest, jobs)
+            old_inputs = manifest['partitions']
+            changed = [tlb_part for tlb_part in tlb_infos
+                       if self._signature_key(inputs.get(tlb_part.label)) !=
+                       self._signature_key(old_inputs.get(tlb_part.label))]
+
+            stale = []
+            for offset, data in layout.serialize():
                 img_file.seek(offset)
-                # Doesn't work if image size exceed the largest integer on that
-                # machine, image size is intepreted as a negative size by
-                # Python interpeter
-                # for line in bin_file:
-                #     img_file.write(line)
-                while True:
-                    data = bin_file.read(8192)
-                    if not data:
-                        break
+                if img_file.read(len(data)) != data:
+                    stale.append((offset, data))
+
+            if not changed and not stale:
+                info('The GPT/UEFI image is up to date: {0}'
+                     .format(self.path))
+            else:
+                # the image is inconsistent until all the partitions are
+                # written, don't let an interrupted update pass for a
+                # complete one
+                self._remove_manifest()
+
+                # the GPT headers and partition tables are only rewritten
+                # with their CRC32 if the partition file changed
+                for offset, data in stale:
+                    info('Refreshing the GPT/UEFI metadata at {0}'
+                         .format(offset))
+                    img_file.seek(offset)
                     img_file.write(data)
 
-    def write(self, tlb_infos, binaries_path):
+                # the previous data of the changed partitions is cleared,
+                # the new binaries don't write their zero blocks
+                for tlb_part in changed:
+                    old = old_inputs.get(tlb_part.label)
+                    if old:
+                        FileCopier.clear(img_file,
+                                         int(tlb_part.begin) * self.block_size,
+                                         old['length'])
+
+                written = self._write_partitions(img_file, changed,
+                                                 binaries_path, jobs)
+                info('{0} partitions updated, {1} Bytes written'
+                     .format(len(changed), written))
+
+        # the image must look newer than its binaries even if nothing changed
+        utime(self.path, None)
+        self._save_manifest(inputs)
+        return True
+
+    @classmethod
+    def _signature_key(cls, signature):
         """
-        Used to write a new GPT/UEFI image with values read in TLB file and the
-        binaries
+        Part of a binary signature telling if its content changed
         """
-        with open(self.path, 'wb+') as img_file:
-            info('Launch the write of GPT/UEFI image: {0}'.format(self.path))
+        if signature is None:
+            return None
+        return signature['size'], signature['sha1']
 
-            # fill output image header with 0x00: MBR size + GPT header size +
-            # (partition table length * entry size)
-            zero = '\x00' * (2 * self.block_size +
-                             self.gpt_header.table_length *
-                             self.gpt_header.entry_size)
-            img_file.seek(0)
-            img_file.write(zero)
+    def _read_metadata(self, img_file, lba, name, errors):
+        """
+        Reads a GPT header and its partition table, checks their CRC32.
+        Returns the header and the raw table, or None if the header is
+        unusable.
+        """
+        header = GPTHeaderInfos(self.size, self.block_size,
+                                self.gpt_header.size)
+        header.read(img_file, lba * self.block_size)
+
+        if len(header.raw) < header.size or header.sign != 'EFI PART':
+            errors.append('No {0} GPT header at LBA {1}'.format(name, lba))
+            return None
+
+        raw_header = '{0}\x00\x00\x00\x00{1}'.format(header.raw[:16],
+                                                     header.raw[20:])
+        if crc32(raw_header) & 0xffffffff != header.crc:
+            errors.append('Invalid CRC32 of the {0} GPT header'.format(name))
+
+        table_size = header.table_length * header.entry_size
+        if header.entry_size < 128 or table_size > 1024 * 1024:
+            errors.append('Invalid {0} partition table size: {1} entries of '
+                          '{2} Bytes'.format(name, header.table_length,
+                                             header.entry_size))
+            return None
+
+        img_file.seek(header.lba_start * self.block_size)
+        raw_table = img_file.read(table_size)
+        if crc32(raw_table) & 0xffffffff != header.table_crc:
+            errors.append('Invalid CRC32 of the {0} partition table'
+                          .format(name))
+
+        return header, raw_table
+
+    def _hash_partition(self, task):
+        """
+        SHA-1 of a range of the image
+        """
+        label, offset, length, _ = task
+        digest = sha1()
+        with open(self.path, 'rb') as img_file:
+            img_file.seek(offset)
+            while length > 0:
+                data = img_file.read(min(length, 1024 * 1024))
+                if not data:
+                    break
+                digest.update(data)
+                length -= len(data)
 
-            info('Writing the MBR of the GPT/UEFI image: {0}'
-                 .format(self.path))
-            offset = 0
-            self.mbr.write(img_file, offset)
+        return digest.hexdigest()
 
-            info('Writing the GPT Header of the GPT/UEFI image: {0}'
-                 .format(self.path))
-            offset = self.block_size
-            self.gpt_header.write(img_file, offset, self.block_size)
+    def verify(self, check_partitions=False, jobs=1):
+        """
+        Used to check a GPT/UEFI image. Only the metadata is read: the CRC32
+        of both GPT headers and partition tables are checked and the backups
+        are compared to the primary ones. With check_partitions, the data of
+        the partitions is also hashed by jobs threads and compared to the
+        manifest of the image. Returns the list of errors found.
+        """
+        errors = []
+        with open(self.path, 'rb') as img_file:
+            img_blocks = fstat(img_file.fileno()).st_size / self.block_size
+
+            primary = self._read_metadata(img_file, 1, 'primary', errors)
+            if primary is None:
+                return errors
+            header, raw_table = primary
+
+            if header.lba_current != 1:
+                errors.append('The primary GPT header is at LBA {0}'
+                              .format(header.lba_current))
+            if header.lba_backup != img_blocks - 1:
+                errors.append('The backup GPT header is at LBA {0}, not at '
+                              'the end of the image'.format(header.lba_backup))
+
+            backup = self._read_metadata(img_file, header.lba_backup,
+                                         'backup', errors)
+
+        if backup is not None:
+            backup_header, backup_table = backup
+            for field in ('lba_first', 'lba_last', 'uuid', 'table_length',
+                          'entry_size', 'table_crc'):
+                if getattr(header, field) != getattr(backup_header, field):
+                    errors.append('The {0} of the backup GPT header differs '
+                                  'from the primary one'.format(field))
+            if (backup_header.lba_current, backup_header.lba_backup) != \
+                    (header.lba_backup, header.lba_current):
+                errors.append('The LBAs of the backup GPT header are '
+                              'swapped')
+            if backup_table != raw_table:
+                errors.append('The backup partition table differs from the '
+                              'primary one')
+
+        if check_partitions:
+            errors.extend(self._verify_partitions(header, raw_table, jobs))
+
+        return errors
+
+    def _verify_partitions(self, header, raw_table, jobs):
+        """
+        Compares the data of the partitions to the manifest of the image
+        """
+        manifest = self._load_manifest()
+        if manifest is None:
+            return ['No manifest to check the partitions of the GPT/UEFI '
+                    'image']
+
+        table = PartTableInfos()
+        table.read(StringIO(raw_table), 0, header.table_length,
+                   header.entry_size)
+        offsets = dict((entry.name.decode('utf-16le').rstrip('\x00'),
+                        entry.lba_first * self.block_size) for entry in table)
+
+        errors = []
+        tasks = []
+        for label, signature in sorted(manifest['partitions'].iteritems()):
+            if label not in offsets:
+                errors.append('Partition {0} not found'.format(label))
+                continue
+            tasks.append((label, offsets[label], signature['length'],
+                          signature.get('data_sha1', signature['sha1'])))
+
+        if jobs > 1 and len(tasks) > 1:
+            pool = ThreadPool(min(jobs, len(tasks)))
+            try:
+                digests = pool.map(self._hash_partition, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            digests = [self._hash_partition(task) for task in tasks]
 
-            info('Writing the primary partition table of the GPT/UEFI'
-                 ' image: {0}'
-                 .format(self.path))
-            offset = 2 * self.block_size
-            self.table.write(img_file, offset, self.gpt_header.entry_size,
-                             tlb_infos, self.gpt_header.lba_last)
+        for (label, _, _, expected), digest in zip(tasks, digests):
+            if digest != expected:
+                errors.append('The data of partition {0} differs from its '
+                              'binary'.format(label))
+            else:
+                debug('Partition {0} matches its binary'.format(label))
 
-            info('Writing the secondary partition table of the'
-                 ' GPT/UEFI image: {0}'
-                 .format(self.path))
-            offset = (self.gpt_header.lba_backup - 32) * self.block_size
-            self.table.write(img_file, offset, self.gpt_header.entry_size,
-                             tlb_infos, self.gpt_header.lba_last)
+        return errors
+
+    def layout(self, tlb_infos):
+        """
+        Builds in memory the GPT/UEFI metadata of the image
+        """
+        return GPTLayout(self.mbr, self.gpt_header, tlb_infos,
+                         self.block_size)
+
+    def _write_forward(self, writer, tlb_infos, binaries_path):
+        """
+        Used to write the image through a writer taking data with increasing
+        offsets: MBR, primary GPT header and partition table, partitions in
+        LBA order, backup partition table and GPT header
+        """
+        layout = self.layout(tlb_infos)
+
+        info('Writing the MBR, GPT header and primary partition table')
+        writer.write(0, layout.primary)
+
+        for tlb_part in sorted(tlb_infos, key=attrgetter('begin')):
+            bin_path = binaries_path[tlb_part.label[8:]]
+            if bin_path == 'none':
+                continue
+
+            self._check_binary_size(tlb_part, bin_path)
+
+            info('Writing partition {0}'.format(tlb_part.label))
+            offset = int(tlb_part.begin) * self.block_size
+            for bin_offset, data in self._read_binary(bin_path, 1024 * 1024):
+                writer.write(offset + bin_offset, data)
+
+        info('Writing the backup partition table and GPT header')
+        writer.write(layout.backup_offset, layout.backup)
+        writer.close()
+
+    def _write_sparse(self, img_file, tlb_infos, binaries_path):
+        """
+        Used to write the image in the Android sparse format. Call by write
+        method
+        """
+        # sparse block size, 4 KiB is what fastboot and simg2img expect
+        blk_sz = 4096
+        if self.size % blk_sz:
+            blk_sz = self.block_size
+        sparse = SparseImageWriter(img_file, self.size, blk_sz)
+
+        self._write_forward(sparse, tlb_infos, binaries_path)
+
+        info('Sparse image: {0} chunks of {1} Bytes blocks'
+             .format(sparse.total_chunks, blk_sz))
+
+    def _write_compressed(self, img_file, tlb_infos, binaries_path,
+                          compress):
+        """
+        Used to stream the raw image in a compressor writing the image file.
+        Call by write method
+        """
+        for cmd in GPTImage.COMPRESSORS[compress]:
+            if find_executable(cmd[0]):
+                break
+        else:
+            error('No {0} compressor found'.format(compress))
+            exit(-1)
+
+        info('Compressing with: {0}'.format(' '.join(cmd)))
+        compressor = Popen(cmd, stdin=PIPE, stdout=img_file)
+        try:
+            self._write_forward(StreamImageWriter(compressor.stdin, self.size),
+                                tlb_infos, binaries_path)
+        finally:
+            compressor.stdin.close()
+            status = compressor.wait()
+
+        if status:
+            error('{0} failed with status {1}'.format(cmd[0], status))
+            exit(-1)
+
+    def write(self, tlb_infos, binaries_path, sparse=False, jobs=1,
+              compress=None, manifest=False):
+        """
+        Used to write a new GPT/UEFI image with values read in TLB file and the
+        binaries. The partitions of raw images are written by jobs threads.
+        Raw images can be streamed in a compressor instead. If manifest is
+        set, the manifest needed to update a raw image in place is written
+        too, which reads all the binaries once more.
+        """
+        self._remove_manifest()
+
+        if compress:
+            with open(self.path, 'wb') as img_file:
+                info('Launch the write of {0} compressed GPT/UEFI image: {1}'
+                     .format(compress, self.path))
+                self._write_compressed(img_file, tlb_infos, binaries_path,
+                                       compress)
+                info('GPT/UEFI Image {0} created successfully !!!'
+                     .format(self.path))
+            return
+
+        if sparse:
+            with open(self.path, 'wb') as img_file:
+                info('Launch the write of sparse GPT/UEFI image: {0}'
+                     .format(self.path))
+                self._write_sparse(img_file, tlb_infos, binaries_path)
+                info('GPT/UEFI Image {0} created successfully !!!'
+                     .format(self.path))
+            return
+
+        with open(self.path, 'wb') as img_file:
+            info('Launch the write of GPT/UEFI image: {0}'.format(self.path))
+
+            # only the data is written, the rest of the image is left as holes
+            # which are read as zeros
+            info('Writing the MBR, GPT headers and partition tables of the'
+                 ' GPT/UEFI image: {0}'.format(self.path))
+            self.layout(tlb_infos).write(img_file)
 
             info('Writing partitions of the GPT/UEFI image {0}'
                  .format(self.path))
-            self._write_partitions(img_file, tlb_infos, binaries_path)
+            self._write_partitions(img_file, tlb_infos, binaries_path, jobs)
 
-            info('Calculating the GPT/UEFI image CRCs and write them')
-            self._write_crc(img_file)
+            # the image ends with holes if its last blocks are not written
+            img_file.truncate(self.size)
 
             info('GPT/UEFI Image {0} created successfully !!!'
                  .format(self.path))
 
+        # records the binaries used, to update the image in place later
+        if manifest:
+            self._save_manifest(self._input_signatures(tlb_infos,
+                                                       binaries_path,
+                                                       jobs=jobs))
+
 
 def usage():
     """
@@ -958,7 +2575,44 @@ def usage():
     # command line option used to create a GPT/UEFI image
     cmds_group.add_argument('--create', action='store_true',
                             help='Command to create a new GPT/UEFI image.')
+    # command line option used to update an existing GPT/UEFI image
+    cmds_group.add_argument('--update', action='store_true',
+                            help=('Command to update in place the partitions '
+                                  'of a GPT/UEFI image whose binary changed, '
+                                  'it is created if it can\'t be updated.'))
+    # command line option used to check a GPT/UEFI image
+    cmds_group.add_argument('--verify', action='store_true',
+                            help=('Command to check the CRC32 and the backups '
+                                  'of the GPT headers and partition tables.'))
+    # command line option used to compute the delta between two images
+    cmds_group.add_argument('--diff', action='store', metavar='OLD',
+                            help=('Command to write in the file given by '
+                                  '--delta the delta from the OLD GPT/UEFI '
+                                  'image to FILE.'))
+
+    # command line option used to apply a delta to an image
+    cmds_group.add_argument('--patch', action='store', metavar='DELTA',
+                            help='Command to apply a delta to FILE in place, '
+                            'an interrupted patch is undone by the next one.')
     create_group = cmdparser.add_argument_group('create')
+    verify_group = cmdparser.add_argument_group('verify')
+
+    # command line option used to specify the delta written
+    delta_group = cmdparser.add_argument_group('diff')
+    delta_group.add_argument('--delta', action='store',
+                             help='The path of the delta written by --diff.')
+
+    # command line option used to write the manifest of a new raw image
+    create_group.add_argument('--manifest', action='store_true',
+                              help=('Also write the manifest needed to '
+                                    'update the image in place or to verify '
+                                    'its partitions. Always done by '
+                                    '--update.'))
+
+    # command line option used to also check the data of the partitions
+    verify_group.add_argument('--partitions', action='store_true',
+                              help=('Also compare the data of the partitions '
+                                    'to the manifest of the image.'))
 
     # command line option to print debug information
     cmdparser.add_argument('-g', '--debug', action='store_true',
@@ -973,6 +2627,30 @@ def usage():
                               default=512, help=('The size of a block in Bytes'
                                                  ' [default=512].'))
 
+    # command line option used to write an Android sparse image
+    create_group.add_argument('--sparse', action='store_true',
+                              help=('Write the image in the Android sparse '
+                                    'format.'))
+
+    # command line option used to keep the layouts read in a cache
+    create_group.add_argument('--layout-cache', action='store',
+                              metavar='DIR',
+                              help=('The directory where the layouts read in '
+                                    'partition files are cached.'))
+
+    # command line option used to stream the image in a compressor
+    create_group.add_argument('--compress', action='store',
+                              choices=sorted(GPTImage.COMPRESSORS),
+                              help=('Stream the raw image in a compressor, '
+                                    'multi-threaded for xz and zstd.'))
+
+    # command line option used to write the partitions in parallel
+    create_group.add_argument('--jobs', action='store', type=int, default=1,
+                              help=('The number of partition ranges written, '
+                                    'partitions verified or image segments '
+                                    'compared, in parallel, raw images only '
+                                    '[default=1].'))
+
     # command line option used to specify the size of image wrote
     create_group.add_argument('--size', action='store', type=str, default='5G',
                               help=('the size of the GPT/UEFI image in Bytes '
@@ -1015,6 +2693,11 @@ def main():
         error('Invalid block size value: {0} Octets'.format(block_size))
         exit(-1)
 
+    # checks if the number of jobs is valid
+    if cmdargs.jobs <= 0:
+        error('Invalid number of jobs: {0}'.format(cmdargs.jobs))
+        exit(-1)
+
     # normalizes the path of GPT/UEFI image
     img_path = realpath(normpath(normcase(cmdargs.FILE)))
 
@@ -1027,7 +2710,7 @@ def main():
 
     # processes the command to create and to write GPT/UEFI image through a TBL
     # partition file and binary filenames
-    if cmdargs.create:
+    if cmdargs.create or cmdargs.update:
 
         info('The GPT/UEFI image size: {0}'.format(img_size))
 
@@ -1038,18 +2721,15 @@ def main():
                   .format(tlb_path))
             exit(-1)
 
-        # reads the TLB partition file
+        # reads the TLB partition file and computes the size of last entry,
+        # its size may be undefined
         tlb_infos = TLBInfos(tlb_path)
-        info('Reading the partition file {0} of type {1}'
+        tlb_infos.read_layout(gpt_img.size, gpt_img.block_size,
+                              gpt_img.gpt_header.entry_size,
+                              gpt_img.gpt_header.table_length,
+                              cmdargs.layout_cache)
+        info('Read the partition file {0} of type {1}'
              .format(tlb_infos.path, tlb_infos.format))
-        tlb_infos.read(gpt_img.block_size)
-
-        # computes the size of last entry, its size may be undefined
-        tlb_infos.compute_last_size_entry(gpt_img.size,
-                                          gpt_img.block_size,
-                                          gpt_img.gpt_header.entry_size,
-                                          gpt_img.gpt_header.table_length
-                                          )
 
         # checks if the TLB partition file read contains valid information
         if not tlb_infos:
@@ -1082,21 +2762,77 @@ def main():
                   .format(label, norm_bin_path))
             binaries_path[label] = norm_bin_path
 
-        # removes the GTP image, if it already exists
-        if isfile(img_path):
-            info('Deleting the GPT/UEFI image previous created: {0}'
+        # a sparse or compressed image can't be updated in place
+        if cmdargs.update and (cmdargs.sparse or cmdargs.compress):
+            error('A sparse or compressed GPT/UEFI image can\'t be updated')
+            exit(-1)
+
+        if cmdargs.sparse and cmdargs.compress:
+            error('A sparse GPT/UEFI image can\'t be compressed')
+            exit(-1)
+
+        # updates in place the existing GPT/UEFI image, if it's possible
+        if cmdargs.update and isfile(img_path) and \
+                gpt_img.update(tlb_infos, binaries_path, cmdargs.jobs):
+            info('GPT/UEFI Image {0} updated successfully !!!'
                  .format(img_path))
-            remove(img_path)
 
-        # calls function to write new GPT/UEFI image
-        gpt_img.write(tlb_infos, binaries_path)
+        else:
+            # removes the GTP image, if it already exists
+            if isfile(img_path):
+                info('Deleting the GPT/UEFI image previous created: {0}'
+                     .format(img_path))
+                remove(img_path)
+
+            # calls function to write new GPT/UEFI image
+            gpt_img.write(tlb_infos, binaries_path, cmdargs.sparse,
+                          cmdargs.jobs, cmdargs.compress,
+                          cmdargs.manifest or cmdargs.update)
+
+        # a sparse or compressed image can't be read back as a GPT/UEFI image
+        if cmdargs.sparse or cmdargs.compress:
+            exit(0)
 
     # checks if the GPT/UEFI image exists
     if not isfile(img_path):
         error('GPT/UEFI image not found: {0}'.format(img_path))
         exit(-1)
 
-    # reads the GPT/UEFI image to check it's valid, it uses CRC32
+    # writes the delta from an old image to the image
+    if cmdargs.diff:
+        old_path = realpath(normpath(normcase(cmdargs.diff)))
+        if not isfile(old_path) or not cmdargs.delta:
+            error('--diff needs an existing image and a --delta path')
+            exit(-1)
+
+        delta = ImageDelta()
+        ranges = delta.compare(old_path, img_path, cmdargs.jobs)
+        delta.write(old_path, img_path, cmdargs.delta)
+        info('Delta {0}: {1} ranges, {2} Bytes of data'
+             .format(cmdargs.delta, len(ranges),
+                     sum(length for _, length in ranges)))
+        exit(0)
+
+    # patches the image with a delta
+    if cmdargs.patch:
+        count = ImageDelta.apply(img_path, cmdargs.patch)
+        # the manifest describes the image before the patch
+        gpt_img._remove_manifest()
+        info('GPT/UEFI image {0} patched, {1} ranges written'
+             .format(img_path, count))
+        exit(0)
+
+    # checks the metadata, and optionally the partitions, of the image
+    if cmdargs.verify:
+        errors = gpt_img.verify(cmdargs.partitions, cmdargs.jobs)
+        for message in errors:
+            error(message)
+        if errors:
+            exit(-1)
+        info('GPT/UEFI image {0} is valid'.format(img_path))
+        exit(0)
+
+    # reads the GPT/UEFI image
     gpt_img.read()
 
     # processes the command show, to print information of the GPT/UEFI image
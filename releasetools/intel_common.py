@@ -17,14 +17,18 @@
 
 import tempfile
 import os
+import errno
+import hashlib
 import sys
 import subprocess
 import shlex
 import shutil
 import imp
+import zipfile
 
 sys.path.append("build/tools/releasetools")
 import common
+import vfat
 
 
 def load_device_mapping(path):
@@ -180,40 +184,146 @@ def ComputeBootloaderPatch(source_tfp_dir, target_tfp_dir, variant=None,
 
 def LoadBootloaderFiles(tfpdir, extra_files=None, variant=None, base_variant=None):
     out = {}
-    data = GetBootloaderImageFromTFP(tfpdir, extra_files=extra_files,
-                                     variant=variant, base_variant=base_variant)
-    image = common.File("bootloader.img", data).WriteToTemp()
-
-    # Extract the contents of the VFAT bootloader image so we
-    # can compute diffs on a per-file basis
-    esp_root = tempfile.mkdtemp(prefix="bootloader-")
-    common.OPTIONS.tempfiles.append(esp_root)
-    add_dir_to_path("/sbin")
-    subprocess.check_output(["mcopy", "-s", "-i", image.name, "::*", esp_root]);
-    image.close();
-
-    for dpath, dname, fnames in os.walk(esp_root):
-        for fname in fnames:
+    path = GetBootloaderImageFromTFP(tfpdir, extra_files=extra_files,
+                                     variant=variant, base_variant=base_variant,
+                                     as_path=True)
+
+    # Read the files of the VFAT bootloader image so we can compute
+    # diffs on a per-file basis
+    with vfat.VFATReader.open(path) as image:
+        for relpath, content in image.files():
             # Capsule update file -- gets consumed and deleted by the firmware
             # at first boot, shouldn't try to patch it
-            if (fname == "BIOSUPDATE.fv"):
+            if os.path.basename(relpath) == "BIOSUPDATE.fv":
                 continue
-            abspath = os.path.join(dpath, fname)
-            relpath = os.path.relpath(abspath, esp_root)
-            data = open(abspath).read()
-            out[relpath] = common.File("bootloader/" + relpath, data)
+            out[relpath] = common.File("bootloader/" + relpath, str(content))
 
     return out
 
 
-def GetBootloaderImageFromTFP(unpack_dir, autosize=False, extra_files=None, variant=None, base_variant=None):
+# Directory of the bootloader image cache, used by
+# GetBootloaderImageFromTFP when no cache_dir is given
+BOOTLOADER_CACHE_ENV = "BOOTLOADER_IMAGE_CACHE"
+
+# Part of the key of every cached image: bump it whenever vfat.py or
+# MakeVFATFilesystem change the images they produce
+BOOTLOADER_CACHE_VERSION = 1
+
+# Number of images kept in the cache, the least recently used ones
+# being deleted
+BOOTLOADER_CACHE_SIZE = 8
+
+
+def sha1_file(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def BootloaderCacheKey(bootloader_zip, provdata_zip, images, size, extra_files):
+    """Return the key of a bootloader image in the cache: a hash of all
+    its inputs, the File objects in images being the generated fastboot
+    and tdos images"""
+    h = hashlib.sha1()
+    h.update("version %d\n" % BOOTLOADER_CACHE_VERSION)
+    h.update("bootloader.zip %s\n" % sha1_file(bootloader_zip))
+    if provdata_zip:
+        h.update("provdata %s\n" % sha1_file(provdata_zip))
+    for image in images:
+        h.update("%s %s\n" % (image.name, image.sha1))
+    h.update("size %d\n" % size)
+    for fn_src, fn_dest in extra_files:
+        h.update("extra %s %s\n" % (fn_dest, sha1_file(fn_src)))
+    return h.hexdigest()
+
+
+def PruneBootloaderCache(cache_dir, keep=None):
+    """Delete all but the keep, by default BOOTLOADER_CACHE_SIZE, most
+    recently used images of the cache"""
+    if keep is None:
+        keep = BOOTLOADER_CACHE_SIZE
+    images = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith(".img") and os.path.isfile(path):
+            images.append((os.path.getmtime(path), path))
+    images.sort(reverse=True)
+    for mtime, path in images[keep:]:
+        try:
+            os.unlink(path)
+        except OSError:
+            # Already deleted by a concurrent build
+            pass
+
+
+def ReadCachedBootloaderImage(cache_path, as_path):
+    """Return a cached image like ReadBootloaderImage, or None if a
+    concurrent build pruned it. The returned path is a link of the caller,
+    which stays valid once the image is pruned from the cache."""
+    try:
+        os.utime(cache_path, None)
+        if not as_path:
+            return ReadBootloaderImage(cache_path, False)
+        path = tempfile.mktemp(dir=os.path.dirname(cache_path))
+        os.link(cache_path, path)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    common.OPTIONS.tempfiles.append(path)
+    return path
+
+
+def GetBootloaderImageFromTFP(unpack_dir, autosize=False, extra_files=None, variant=None, base_variant=None,
+        cache_dir=None, as_path=False):
+    """Build the VFAT bootloader image of a target files package and return
+    its content, or the path of the image file if as_path is set.
+
+    Images are kept in cache_dir, or in the directory named by the
+    BOOTLOADER_IMAGE_CACHE environment variable, under the hash of their
+    inputs so that an image already built is never built again. Only the
+    BOOTLOADER_CACHE_SIZE most recently used images are kept, a path
+    returned from the cache is never pruned while the build runs."""
     if extra_files == None:
         extra_files = []
 
+    provdata_name = None
     if variant:
         provdata_name = os.path.join(unpack_dir, "RADIO", "provdata_" + variant +".zip")
         if base_variant and (os.path.isfile(provdata_name) == False):
             provdata_name = os.path.join(unpack_dir, "RADIO", "provdata_" + base_variant +".zip")
+
+    fastboot = GetFastbootImage(unpack_dir)
+    tdos = GetTdosImage(unpack_dir)
+
+    if not autosize:
+        size = int(open(os.path.join(unpack_dir, "RADIO", "bootloader-size.txt")).read().strip())
+    else:
+        size = 0
+    bootloader_zip = os.path.join(unpack_dir, "RADIO", "bootloader.zip")
+
+    if cache_dir is None:
+        cache_dir = os.environ.get(BOOTLOADER_CACHE_ENV)
+    cache_path = None
+    if cache_dir:
+        key = BootloaderCacheKey(bootloader_zip, provdata_name,
+                                 [i for i in (fastboot, tdos) if i], size,
+                                 extra_files)
+        cache_path = os.path.join(cache_dir, key + ".img")
+        if os.path.exists(cache_path):
+            image = ReadCachedBootloaderImage(cache_path, as_path)
+            if image is not None:
+                print "Using cached bootloader image", cache_path
+                return image
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    if provdata_name:
         provdata, provdata_zip = common.UnzipTemp(provdata_name)
         cap_path = os.path.join(provdata,"capsule.fv")
         if os.path.exists(cap_path):
@@ -230,50 +340,68 @@ def GetBootloaderImageFromTFP(unpack_dir, autosize=False, extra_files=None, vari
                     print "Adding extra bootloader file", relpath
                     extra_files.append((fullpath, relpath))
 
-    bootloader = tempfile.NamedTemporaryFile(delete=False)
+    # Build the image next to its cache entry so that it can be renamed
+    # into place once complete
+    bootloader = tempfile.NamedTemporaryFile(dir=cache_dir or None, delete=False)
     filename = bootloader.name
     bootloader.close()
 
-    fastboot = GetFastbootImage(unpack_dir)
     if fastboot:
         fastboot_file = fastboot.WriteToTemp()
         extra_files.append((fastboot_file.name,"fastboot.img"))
 
-    tdos = GetTdosImage(unpack_dir)
     if tdos:
         tdos_file = tdos.WriteToTemp()
         extra_files.append((tdos_file.name,"tdos.img"))
 
-    if not autosize:
-        size = int(open(os.path.join(unpack_dir, "RADIO", "bootloader-size.txt")).read().strip())
-    else:
-        size = 0
-    MakeVFATFilesystem(os.path.join(unpack_dir, "RADIO", "bootloader.zip"),
-            filename, size=size, extra_files=extra_files)
-    bootloader = open(filename)
-    data = bootloader.read()
-    bootloader.close()
+    try:
+        MakeVFATFilesystem(bootloader_zip, filename, size=size,
+                extra_files=extra_files)
+    except:
+        os.unlink(filename)
+        raise
+    if cache_path:
+        # Publish a second link so that the image of this build survives
+        # its pruning from the cache by a concurrent build
+        link = tempfile.mktemp(dir=cache_dir)
+        os.link(filename, link)
+        os.rename(link, cache_path)
+        PruneBootloaderCache(cache_dir)
+
+    if as_path:
+        common.OPTIONS.tempfiles.append(filename)
+        return filename
+    data = ReadBootloaderImage(filename, False)
     os.unlink(filename)
     return data
 
 
+def ReadBootloaderImage(path, as_path):
+    if as_path:
+        return path
+    with open(path, "rb") as f:
+        return f.read()
+
+
 def MakeVFATFilesystem(root_zip, filename, title="ANDROIDIA", size=0, extra_size=0,
         extra_files=[]):
     """Create a VFAT filesystem image with all the files in the provided
     root zipfile. The size of the filesystem, if not provided by the
     caller, will be 101% the size of the containing files"""
 
-    root, root_zip = common.UnzipTemp(root_zip)
+    # Extra files replace the zip members, and the earlier extra files,
+    # of the same name
+    dests = {}
     for fn_src, fn_dest in extra_files:
-        fn_dest = os.path.join(root, fn_dest)
-        if not os.path.exists(os.path.dirname(fn_dest)):
-            os.makedirs(os.path.dirname(fn_dest))
-        shutil.copy(fn_src, fn_dest)
+        dests[os.path.normpath(fn_dest).strip("/")] = fn_src
+    extra_files = [(fn_src, fn_dest) for fn_dest, fn_src in sorted(dests.items())]
+    replaced = set(dests)
+    root = zipfile.ZipFile(root_zip)
 
     if size == 0:
-        for dpath, dnames, fnames in os.walk(root):
-            for f in fnames:
-                size += os.path.getsize(os.path.join(dpath, f))
+        size = sum(i.file_size for i in root.infolist()
+                   if i.filename.strip("/") not in replaced)
+        size += sum(os.path.getsize(fn_src) for fn_src, _ in extra_files)
 
         # Add 1% extra space, minimum 32K
         extra = size / 100
@@ -284,28 +412,19 @@ def MakeVFATFilesystem(root_zip, filename, title="ANDROIDIA", size=0, extra_size
     size += extra_size
 
     # Round the size of the disk up to 32K so that total sectors is
-    # a multiple of sectors per track (mtools complains otherwise)
+    # a multiple of sectors per track
     mod = size % (32 * 1024)
     if mod != 0:
         size = size + (32 * 1024) - mod
 
-    # mtools freaks out otherwise
-    if os.path.exists(filename):
-        os.unlink(filename)
-
-    add_dir_to_path("/sbin")
-    cmd = ["mkdosfs", "-n", title, "-C", filename, str(size / 1024)]
+    image = vfat.VFATWriter(size, title=title)
     try:
-        p = common.Run(cmd)
-    except Exception as exc:
-        print "Error: Unable to execute command: {}".format(' '.join(cmd))
-        raise exc
-    p.wait()
-    assert p.returncode == 0, "mkdosfs failed"
-    for f in os.listdir(root):
-        in_p = os.path.join(root, f)
-        out_p = os.path.relpath(in_p, root)
-        PutFatFile(filename, in_p, out_p)
+        image.add_zip(root, exclude=replaced)
+        for fn_src, fn_dest in extra_files:
+            image.add_local_file(fn_dest, fn_src)
+        image.write(filename)
+    finally:
+        root.close()
 
 
 def GetTdosImage(unpack_dir, info_dict=None):
@@ -479,33 +598,3 @@ def GetFastbootImage(unpack_dir, info_dict=None):
 
     return common.File("fastboot.img", data)
 
-
-def PutFatFile(fat_img, in_path, out_path):
-    cmd = ["mcopy", "-s", "-Q", "-i", fat_img, in_path,
-           "::" + out_path]
-    try:
-        p = common.Run(cmd)
-    except Exception as exc:
-        print "Error: Unable to execute command: {}".format(' '.join(cmd))
-        raise exc
-    p.wait()
-    assert p.returncode == 0, "couldn't insert %s into FAT image" % (in_path,)
-
-
-def add_dir_to_path(dir_name, end=True):
-    """
-    I add a directory to the PATH environment variable, if not already in the
-    path.  By default it gets added to the end of the PATH
-    """
-    dir_name = os.path.abspath(dir_name)
-    path_env_var = os.environ.get('PATH', "")
-    for path_dir in path_env_var.split(os.pathsep):
-        path_dir = os.path.abspath(path_dir)
-        if dir_name == path_dir:
-            return
-    if end:
-        path_env_var += ":" + dir_name
-    else:
-        path_env_var = dir_name + ":" + path_env_var
-    os.environ['PATH'] = path_env_var
-
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+
+from vfat import *
+
+def write_file(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as fp:
+        fp.write(data)
+
+def read_tree(root):
+    files = {}
+    for dpath, dnames, fnames in os.walk(root):
+        for f in fnames:
+            path = os.path.join(dpath, f)
+            files[os.path.relpath(path, root)] = open(path, 'rb').read()
+    return files
+
+def read_image(path):
+    with VFATReader.open(path) as reader:
+        return dict((p, str(data)) for p, data in reader.files())
+
+def round_trip(tmpdir, size, files, bits=None):
+    root = os.path.join(tmpdir, 'root')
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+    for path, data in files.iteritems():
+        write_file(os.path.join(root, path), data)
+
+    img = os.path.join(tmpdir, 'fat.img')
+    writer = VFATWriter(size)
+    writer.add_tree(root)
+    writer.write(img)
+    assert os.path.getsize(img) == size
+    if bits:
+        assert writer.fat_bits == bits
+    assert read_image(img) == files
+    return writer, img
+
+def test_types():
+    tmpdir = tempfile.mkdtemp(prefix='test_vfat')
+    try:
+        files = {
+            'EFI/BOOT/bootx64.efi': os.urandom(100000),
+            'loader/entries/android.conf': 'title Android\n',
+            'README': 'readme\n',
+        }
+        for size, bits in ((1024 * 1024, 12), (8 * 1024 * 1024, 16),
+                           (64 * 1024 * 1024, 16),
+                           (600 * 1024 * 1024, 32)):
+            writer, img = round_trip(tmpdir, size, files, bits)
+            with VFATReader.open(img) as reader:
+                assert reader.fat_bits == bits
+                assert reader.num_clusters == writer.num_clusters
+                # Contiguous files are not copied
+                assert isinstance(reader.read('efi/boot/BOOTX64.EFI'), buffer)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_names():
+    tmpdir = tempfile.mkdtemp(prefix='test_vfat')
+    try:
+        files = {
+            'lower.txt': 'short lower case name',
+            'UPPER.TXT': 'short upper case name',
+            'Mixed.Txt': 'mixed case name',
+            '.hidden': 'dot file',
+            'two.dots.here': 'two dots',
+            'with space': 'space',
+            'caf\xc3\xa9.bin': 'utf-8 name',
+            'x' * 255: 'longest name',
+            'empty': '',
+            'a long directory name/deeper/and deeper/file.dat': 'nested',
+            'a long directory name/empty file': '',
+        }
+        # Long names sharing the same short alias prefix
+        for i in xrange(20):
+            files['long file name %d.conf' % i] = str(i)
+        writer, img = round_trip(tmpdir, 1024 * 1024, files)
+
+        with VFATReader.open(img) as reader:
+            names = [e[0] for e in reader.entries(0)]
+            assert 'lower.txt' in names and 'UPPER.TXT' in names
+            assert str(reader.read('A LONG DIRECTORY NAME/Deeper/AND DEEPER/'
+                                   'FILE.DAT')) == 'nested'
+            assert len(reader.read('empty')) == 0
+            for path in ('missing', 'empty/file', 'a long directory name'):
+                try:
+                    reader.read(path)
+                    assert False, '%s read' % path
+                except FatError:
+                    pass
+
+        try:
+            VFATWriter(1024 * 1024).add_file('y' * 256, 0, None)
+            assert False, 'name too long'
+        except FatError:
+            pass
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_boundaries():
+    tmpdir = tempfile.mkdtemp(prefix='test_vfat')
+    try:
+        # The FAT12 entries of an odd number of clusters end in the middle
+        # of a byte, around the sector boundaries of the FAT
+        for first, last in ((700, 740), (1730, 1770)):
+            for sectors in xrange(first, last):
+                writer = VFATWriter(sectors * SECTOR_SIZE)
+                assert writer.fat_bits == 12
+                assert writer.fat_sectors * SECTOR_SIZE * 8 >= \
+                        (writer.num_clusters + 2) * 12
+                writer.pack_fat(writer.plan()[1])
+
+        # Every cluster used
+        for clusters in (681, 1705, FAT12_MAX_CLUSTERS):
+            size = SECTOR_SIZE * (clusters + 40)
+            while VFATWriter(size).num_clusters > clusters:
+                size -= SECTOR_SIZE
+            writer = VFATWriter(size)
+            capacity = writer.num_clusters * writer.cluster_size
+            round_trip(tmpdir, size, {'full': os.urandom(capacity)})
+            try:
+                round_trip(tmpdir, size, {'full': os.urandom(capacity + 1)})
+                assert False, 'image overflow'
+            except FatError:
+                pass
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_zip():
+    tmpdir = tempfile.mkdtemp(prefix='test_vfat')
+    try:
+        zip_path = os.path.join(tmpdir, 'bootloader.zip')
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('EFI/', '')
+            z.writestr('EFI/BOOT/bootx64.efi', 'efi' * 10000)
+            z.writestr('capsule.fv', 'old capsule')
+        local = os.path.join(tmpdir, 'capsule.fv')
+        write_file(local, 'new capsule')
+
+        img = os.path.join(tmpdir, 'fat.img')
+        writer = VFATWriter(1024 * 1024)
+        with zipfile.ZipFile(zip_path) as z:
+            writer.add_zip(z, exclude=['capsule.fv'])
+            writer.add_local_file('capsule.fv', local)
+            writer.add_file('fastboot.img', 5, lambda: io.BytesIO('12345'))
+            writer.write(img)
+        assert read_image(img) == {'EFI/BOOT/bootx64.efi': 'efi' * 10000,
+                                   'capsule.fv': 'new capsule',
+                                   'fastboot.img': '12345'}
+
+        # A file shorter than announced is an error
+        writer = VFATWriter(1024 * 1024)
+        writer.add_file('short', 10, lambda: io.BytesIO('12345'))
+        try:
+            writer.write(img)
+            assert False, 'short file written'
+        except FatError:
+            pass
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main():
+    test_types()
+    test_names()
+    test_boundaries()
+    test_zip()
+    print "OK"
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,744 @@
+#
+# Copyright (C) 2016 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process VFAT (FAT12/16/32 with long file names) image builder and
+reader.
+
+VFATWriter plans the whole file tree up front: every directory and file
+gets a contiguous run of clusters, the directories and the FAT chains
+are built in memory, and the image is written in one sequential pass,
+each file being streamed to its cluster offset.
+
+Image layout:
+
+  +------------------------------+
+  | reserved sectors             |  boot sector, and for FAT32 the
+  |                              |  FSInfo sector and the backup boot
+  |                              |  sector
+  +------------------------------+
+  | FAT #1, FAT #2               |
+  +------------------------------+
+  | root directory (FAT12/16)    |  FAT32 keeps it in cluster 2
+  +------------------------------+
+  | data clusters, from 2        |  directories and files, in tree
+  |                              |  order
+  +------------------------------+
+
+VFATReader reads the files of any FAT image, straight out of the image
+data, without extracting them.
+"""
+
+import array
+import mmap
+import os
+import struct
+import time
+import zlib
+
+SECTOR_SIZE = 512
+NUM_FATS = 2
+MEDIA = 0xf8
+ROOT_ENTRIES = 512
+DIR_ENTRY_SIZE = 32
+
+# Cluster count limits of each FAT type, from the Microsoft FAT
+# specification
+FAT12_MAX_CLUSTERS = 4084
+FAT16_MAX_CLUSTERS = 65524
+FAT32_MAX_CLUSTERS = 0x0ffffff5
+
+# Images from this size are FAT32, as mkdosfs does
+FAT32_MIN_SIZE = 512 * 1024 * 1024
+
+ATTR_READ_ONLY = 0x01
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LFN = 0x0f
+
+# Case flags of the short names, honored by Linux and UEFI, so that
+# lower case 8.3 names don't need long name entries
+CASE_LOWER_BASE = 0x08
+CASE_LOWER_EXT = 0x10
+
+LFN_CHARS = 13
+MAX_NAME_LENGTH = 255
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Characters allowed in short names besides letters and digits
+SHORT_NAME_CHARS = set("$%'-_@~`!(){}^#&")
+
+s_boot_common = struct.Struct("< 3s 8s H B H B H H B H H H I I")
+s_boot_fat16 = struct.Struct("< B B B I 11s 8s")
+s_boot_fat32 = struct.Struct("< I H H I H H 12s B B B I 11s 8s")
+s_fsinfo = struct.Struct("< I 480s I I I 12s I")
+s_dirent = struct.Struct("< 11s B B B H H H H H H H I")
+s_lfn = struct.Struct("< B 10s B B B 12s H 4s")
+
+
+class FatError(Exception):
+    pass
+
+
+def fat_datetime(mtime):
+    """Return the (date, time) of a directory entry for a timestamp"""
+    tm = time.localtime(max(mtime, 315532800))
+    year = min(max(tm.tm_year, 1980), 2107)
+    date = ((year - 1980) << 9) | (tm.tm_mon << 5) | tm.tm_mday
+    hms = (tm.tm_hour << 11) | (tm.tm_min << 5) | (tm.tm_sec / 2)
+    return date, hms
+
+
+def short_name_checksum(short_name):
+    """Checksum of a packed 8.3 name, stored in its long name entries"""
+    csum = 0
+    for c in short_name:
+        csum = (((csum & 1) << 7) + (csum >> 1) + ord(c)) & 0xff
+    return csum
+
+
+def _short_chars(s):
+    """Map a name part to valid short name characters. Return the
+    result and whether the mapping lost information."""
+    out = []
+    lossy = False
+    for c in s.upper():
+        if c == " " or c == ".":
+            lossy = True
+        elif c.isalnum() and ord(c) < 128 or c in SHORT_NAME_CHARS:
+            out.append(c)
+        else:
+            out.append("_")
+            lossy = True
+    return "".join(out), lossy
+
+
+def plain_short_name(name):
+    """Return (packed 8.3 name, case flags) if name can be stored as a
+    short entry alone, else None"""
+    if name in (".", ".."):
+        return name.ljust(11), 0
+    base, dot, ext = name.rpartition(".")
+    if not dot:
+        base, ext = name, ""
+    if not base or len(base) > 8 or len(ext) > 3:
+        return None
+    flags = 0
+    for part, flag in ((base, CASE_LOWER_BASE), (ext, CASE_LOWER_EXT)):
+        chars, lossy = _short_chars(part)
+        if lossy:
+            return None
+        if part != part.upper():
+            if part != part.lower():
+                return None
+            flags |= flag
+    packed = base.upper().ljust(8) + ext.upper().ljust(3)
+    if packed[0] == "\xe5":
+        packed = "\x05" + packed[1:]
+    return packed, flags
+
+
+def generated_short_name(name, used):
+    """Build a numbered 8.3 alias "BASE~N.EXT" for a long name, unique
+    among the packed short names in used"""
+    name = name.lstrip(". ")
+    base, dot, ext = name.rpartition(".")
+    if not dot:
+        base, ext = name, ""
+    base = _short_chars(base)[0] or "_"
+    ext = _short_chars(ext)[0][:3]
+    for n in xrange(1, 1000000):
+        tail = "~%d" % n
+        packed = (base[:8 - len(tail)] + tail).ljust(8) + ext.ljust(3)
+        if packed not in used:
+            return packed
+    raise FatError("no short name available for %s" % name)
+
+
+class Node(object):
+    """A file or a directory of the image"""
+
+    def __init__(self, name, is_dir, size=0, opener=None, mtime=None):
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.opener = opener
+        self.mtime = time.time() if mtime is None else mtime
+        self.children = []
+        self.by_name = {}
+        self.cluster = 0
+        self.num_clusters = 0
+
+    def child(self, name):
+        return self.by_name.get(name.upper())
+
+    def add(self, node):
+        if self.child(node.name):
+            raise FatError("duplicate entry %s" % node.name)
+        self.children.append(node)
+        self.by_name[node.name.upper()] = node
+        return node
+
+
+class VFATWriter(object):
+    """Build a VFAT image of a given size from files added with
+    add_file() or add_tree(), then write it with write()"""
+
+    def __init__(self, size, title="ANDROIDIA", volume_id=None):
+        self.total_sectors = size / SECTOR_SIZE
+        self.title = title.upper()[:11]
+        self.volume_id = volume_id
+        self.root = Node("", True)
+        self.root.mtime = 0
+        self.geometry()
+
+    def geometry(self):
+        """Choose the FAT type and the cluster size, and compute the
+        position of each region"""
+        total = self.total_sectors
+        if total * SECTOR_SIZE >= FAT32_MIN_SIZE:
+            candidates = [(32, 8 if total <= 16777216 else
+                           16 if total <= 33554432 else
+                           32 if total <= 67108864 else 64)]
+        else:
+            # Smallest clusters allowed for the size, FAT12 preferred
+            spc = 1 if total <= 8400 else 2 if total <= 32680 else \
+                4 if total <= 262144 else 8 if total <= 524288 else 16
+            candidates = []
+            while spc <= 128:
+                candidates.extend([(12, spc), (16, spc)])
+                spc *= 2
+
+        for bits, spc in candidates:
+            if self.try_geometry(bits, spc):
+                return
+        raise FatError("no FAT geometry for %d sectors" % total)
+
+    def try_geometry(self, bits, spc):
+        if bits == 32:
+            reserved = 32
+            root_sectors = 0
+        else:
+            reserved = 1
+            root_sectors = ROOT_ENTRIES * DIR_ENTRY_SIZE / SECTOR_SIZE
+
+        # The FAT size depends on the cluster count which depends on the
+        # FAT size: iterate until it's stable
+        fat_sectors = 1
+        while True:
+            data_sectors = (self.total_sectors - reserved -
+                            NUM_FATS * fat_sectors - root_sectors)
+            if data_sectors <= 0:
+                return False
+            clusters = data_sectors / spc
+            needed = (((clusters + 2) * bits + 7) / 8 + SECTOR_SIZE - 1) / \
+                SECTOR_SIZE
+            if needed <= fat_sectors:
+                break
+            fat_sectors = needed
+
+        if bits == 12 and clusters > FAT12_MAX_CLUSTERS:
+            return False
+        if bits == 16 and not (FAT12_MAX_CLUSTERS < clusters <=
+                               FAT16_MAX_CLUSTERS):
+            return False
+        if bits == 32 and not (FAT16_MAX_CLUSTERS < clusters <=
+                               FAT32_MAX_CLUSTERS):
+            return False
+
+        self.fat_bits = bits
+        self.sectors_per_cluster = spc
+        self.cluster_size = spc * SECTOR_SIZE
+        self.reserved_sectors = reserved
+        self.fat_sectors = fat_sectors
+        self.root_sectors = root_sectors
+        self.root_start = (reserved + NUM_FATS * fat_sectors) * SECTOR_SIZE
+        self.data_start = self.root_start + root_sectors * SECTOR_SIZE
+        self.num_clusters = clusters
+        return True
+
+    def cluster_offset(self, cluster):
+        return self.data_start + (cluster - 2) * self.cluster_size
+
+    def mkdir(self, path, mtime=None):
+        """Return the directory node of path, creating it and its parents
+        if needed"""
+        node = self.root
+        for name in [p for p in path.split("/") if p]:
+            child = node.child(name)
+            if child is None:
+                child = node.add(Node(name, True, mtime=mtime))
+            elif not child.is_dir:
+                raise FatError("%s is a file" % name)
+            node = child
+        return node
+
+    def add_file(self, path, size, opener, mtime=None):
+        """Add a file of size bytes at path. opener() returns a file
+        object reading its content when the image is written."""
+        dirname, _, name = path.strip("/").rpartition("/")
+        if not name or len(name) > MAX_NAME_LENGTH:
+            raise FatError("invalid file name %s" % path)
+        self.mkdir(dirname, mtime).add(Node(name, False, size, opener, mtime))
+
+    def add_local_file(self, path, src_path):
+        st = os.stat(src_path)
+        self.add_file(path, st.st_size, lambda: open(src_path, "rb"),
+                      st.st_mtime)
+
+    def add_tree(self, root):
+        """Add all the files and directories under a local directory"""
+        for dpath, dnames, fnames in os.walk(root):
+            dnames.sort()
+            rel = os.path.relpath(dpath, root)
+            if rel == ".":
+                rel = ""
+            for d in dnames:
+                self.mkdir(os.path.join(rel, d),
+                           os.path.getmtime(os.path.join(dpath, d)))
+            for f in sorted(fnames):
+                self.add_local_file(os.path.join(rel, f),
+                                    os.path.join(dpath, f))
+
+    def add_zip(self, zip_file, exclude=()):
+        """Add the members of an open ZipFile, except the paths in
+        exclude. Members are decompressed straight into the image when
+        it is written, so zip_file must stay open until then."""
+        for info in zip_file.infolist():
+            path = info.filename.strip("/")
+            if not path or path in exclude:
+                continue
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            if info.filename.endswith("/"):
+                self.mkdir(path, mtime)
+            else:
+                self.add_file(path, info.file_size,
+                              lambda info=info: zip_file.open(info), mtime)
+
+    def dir_entries(self, node):
+        """Return the number of 32 byte entries of a directory"""
+        count = 0 if node is self.root else 2
+        if node is self.root and self.title:
+            count += 1
+        for child in node.children:
+            count += 1
+            if plain_short_name(child.name) is None:
+                count += (len(child.name) + LFN_CHARS - 1) / LFN_CHARS
+        return count
+
+    def plan(self):
+        """Allocate a contiguous run of clusters to every directory and
+        file, in the order they are written. Return the list of nodes
+        with clusters, and the FAT."""
+        order = []
+        next_cluster = [2]
+
+        def allocate(node, size):
+            clusters = (size + self.cluster_size - 1) / self.cluster_size
+            if node.is_dir:
+                clusters = max(clusters, 1)
+            if not clusters:
+                return
+            node.cluster = next_cluster[0]
+            node.num_clusters = clusters
+            next_cluster[0] += clusters
+            order.append(node)
+
+        def visit(node):
+            for child in node.children:
+                if child.is_dir:
+                    allocate(child, self.dir_entries(child) * DIR_ENTRY_SIZE)
+                else:
+                    allocate(child, child.size)
+            for child in node.children:
+                if child.is_dir:
+                    visit(child)
+
+        if self.fat_bits == 32:
+            allocate(self.root, self.dir_entries(self.root) * DIR_ENTRY_SIZE)
+        elif self.dir_entries(self.root) > ROOT_ENTRIES:
+            raise FatError("too many entries in the root directory")
+        visit(self.root)
+
+        used = next_cluster[0] - 2
+        if used > self.num_clusters:
+            raise FatError("the files need %d clusters of %d bytes, only %d "
+                           "available" % (used, self.cluster_size,
+                                          self.num_clusters))
+
+        fat = array.array("I", [0]) * (self.num_clusters + 2)
+        eoc = (1 << min(self.fat_bits, 28)) - 1
+        fat[0] = (eoc & ~0xff) | MEDIA
+        fat[1] = eoc
+        for node in order:
+            last = node.cluster + node.num_clusters - 1
+            for c in xrange(node.cluster, last):
+                fat[c] = c + 1
+            fat[last] = eoc
+        return order, fat, used
+
+    def pack_fat(self, fat):
+        fat_size = self.fat_sectors * SECTOR_SIZE
+        if self.fat_bits == 12:
+            out = bytearray(fat_size)
+            for c in xrange(len(fat)):
+                pos = c * 3 / 2
+                if c & 1:
+                    out[pos] |= (fat[c] << 4) & 0xf0
+                    out[pos + 1] = fat[c] >> 4
+                else:
+                    out[pos] = fat[c] & 0xff
+                    out[pos + 1] = fat[c] >> 8
+            return str(out)
+        typecode = "H" if self.fat_bits == 16 else "I"
+        packed = array.array(typecode, fat)
+        if packed.itemsize != self.fat_bits / 8:
+            packed = array.array("L", fat)
+        return packed.tostring().ljust(fat_size, "\0")
+
+    def pack_dir(self, node):
+        """Return the entries of a directory"""
+        entries = []
+        date, hms = fat_datetime(node.mtime)
+        if node is self.root:
+            if self.title:
+                entries.append(s_dirent.pack(self.title.ljust(11),
+                                             ATTR_VOLUME_ID, 0, 0, hms, date,
+                                             date, 0, hms, date, 0, 0))
+        else:
+            parent = node.parent
+            parent_cluster = 0 if parent is self.root else parent.cluster
+            for name, cluster in ((".", node.cluster), ("..", parent_cluster)):
+                entries.append(s_dirent.pack(name.ljust(11), ATTR_DIRECTORY,
+                                             0, 0, hms, date, date,
+                                             cluster >> 16, hms, date,
+                                             cluster & 0xffff, 0))
+
+        used = set()
+        plain = {}
+        for child in node.children:
+            p = plain_short_name(child.name)
+            if p is not None:
+                plain[child] = p
+                used.add(p[0])
+
+        for child in node.children:
+            if child in plain:
+                short, flags = plain[child]
+                lfn = []
+            else:
+                short = generated_short_name(child.name, used)
+                used.add(short)
+                flags = 0
+                lfn = self.pack_lfn(child.name, short_name_checksum(short))
+
+            date, hms = fat_datetime(child.mtime)
+            attr = ATTR_DIRECTORY if child.is_dir else ATTR_ARCHIVE
+            size = 0 if child.is_dir else child.size
+            entries.extend(lfn)
+            entries.append(s_dirent.pack(short, attr, flags, 0, hms, date,
+                                         date, child.cluster >> 16, hms, date,
+                                         child.cluster & 0xffff, size))
+        return "".join(entries)
+
+    def pack_lfn(self, name, checksum):
+        """Return the long name entries of name, in on-disk order"""
+        units = name.decode("utf-8").encode("utf-16le")
+        count = (len(units) / 2 + LFN_CHARS - 1) / LFN_CHARS
+        units += "\0\0"
+        units = units.ljust(count * LFN_CHARS * 2, "\xff")
+        entries = []
+        for seq in xrange(count, 0, -1):
+            part = units[(seq - 1) * LFN_CHARS * 2:seq * LFN_CHARS * 2]
+            order = seq | (0x40 if seq == count else 0)
+            entries.append(s_lfn.pack(order, part[0:10], ATTR_LFN, 0,
+                                      checksum, part[10:22], 0, part[22:26]))
+        return entries
+
+    def pack_boot(self, free_clusters, next_free):
+        total = self.total_sectors
+        volume_id = self.volume_id
+        if volume_id is None:
+            volume_id = zlib.crc32(repr((self.title, total))) & 0xffffffff
+        label = (self.title or "NO NAME").ljust(11)
+
+        common = s_boot_common.pack(
+            "\xeb\x58\x90" if self.fat_bits == 32 else "\xeb\x3c\x90",
+            "MSWIN4.1", SECTOR_SIZE, self.sectors_per_cluster,
+            self.reserved_sectors, NUM_FATS,
+            0 if self.fat_bits == 32 else ROOT_ENTRIES,
+            total if total < 0x10000 else 0, MEDIA,
+            0 if self.fat_bits == 32 else self.fat_sectors,
+            32, 64, 0, total if total >= 0x10000 else 0)
+
+        if self.fat_bits == 32:
+            ext = s_boot_fat32.pack(self.fat_sectors, 0, 0, 2, 1, 6, "",
+                                    0x80, 0, 0x29, volume_id, label,
+                                    "FAT32   ")
+        else:
+            ext = s_boot_fat16.pack(0x80, 0, 0x29, volume_id, label,
+                                    ("FAT%d" % self.fat_bits).ljust(8))
+
+        boot = (common + ext).ljust(510, "\0") + "\x55\xaa"
+        if self.fat_bits != 32:
+            return boot
+
+        fsinfo = s_fsinfo.pack(0x41615252, "", 0x61417272, free_clusters,
+                               next_free, "", 0xaa550000)
+        # Sectors 0-2, and their backup at 6-8
+        region = boot + fsinfo + "\0" * 510 + "\x55\xaa"
+        return (region.ljust(6 * SECTOR_SIZE, "\0") + region).ljust(
+            self.reserved_sectors * SECTOR_SIZE, "\0")
+
+    def write(self, filename):
+        """Write the image in one sequential pass"""
+        self.link_parents(self.root)
+        order, fat, used = self.plan()
+        packed_fat = self.pack_fat(fat)
+
+        with open(filename, "wb") as fp:
+            fp.write(self.pack_boot(self.num_clusters - used, used + 2))
+            for _ in xrange(NUM_FATS):
+                fp.write(packed_fat)
+            if self.fat_bits != 32:
+                fp.write(self.pack_dir(self.root).ljust(
+                    self.root_sectors * SECTOR_SIZE, "\0"))
+
+            for node in order:
+                fp.seek(self.cluster_offset(node.cluster))
+                if node.is_dir:
+                    fp.write(self.pack_dir(node))
+                else:
+                    self.write_file(fp, node)
+
+            fp.truncate(self.total_sectors * SECTOR_SIZE)
+
+    def write_file(self, fp, node):
+        remaining = node.size
+        with node.opener() as src:
+            while remaining > 0:
+                data = src.read(min(remaining, COPY_CHUNK_SIZE))
+                if not data:
+                    break
+                fp.write(data)
+                remaining -= len(data)
+        if remaining:
+            raise FatError("%s is shorter than %d bytes" % (node.name,
+                                                            node.size))
+
+    def link_parents(self, node):
+        for child in node.children:
+            child.parent = node
+            if child.is_dir:
+                self.link_parents(child)
+
+
+class VFATReader(object):
+    """Read-only access to the files of a FAT12/16/32 image held in a
+    string or mapped with open(). File contents are returned as
+    read-only buffers of the image, without copying, when their clusters
+    are contiguous."""
+
+    def __init__(self, data):
+        self.data = data
+        self.mmap = None
+        self.fp = None
+        if len(data) < SECTOR_SIZE or data[510:512] != "\x55\xaa":
+            raise FatError("not a FAT image")
+
+        (_, _, bps, spc, reserved, num_fats, root_entries, total16, _,
+         fat_sectors, _, _, _, total32) = s_boot_common.unpack_from(data)
+        if not bps or not spc:
+            raise FatError("invalid boot sector")
+        if not fat_sectors:
+            fat_sectors, _, _, self.root_cluster = struct.unpack_from(
+                "<IHHI", data, s_boot_common.size)
+        total = total16 or total32
+        root_sectors = (root_entries * DIR_ENTRY_SIZE + bps - 1) / bps
+
+        self.cluster_size = bps * spc
+        self.fat_start = reserved * bps
+        self.root_start = (reserved + num_fats * fat_sectors) * bps
+        self.root_size = root_sectors * bps
+        self.data_start = self.root_start + self.root_size
+        self.num_clusters = (total * bps - self.data_start) / self.cluster_size
+        if self.num_clusters <= FAT12_MAX_CLUSTERS:
+            self.fat_bits = 12
+        elif self.num_clusters <= FAT16_MAX_CLUSTERS:
+            self.fat_bits = 16
+        else:
+            self.fat_bits = 32
+        if self.fat_bits != 32:
+            self.root_cluster = 0
+
+    @classmethod
+    def open(cls, filename):
+        """Map an image file"""
+        fp = open(filename, "rb")
+        try:
+            m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            fp.close()
+            raise
+        reader = cls(m)
+        reader.fp = fp
+        reader.mmap = m
+        return reader
+
+    def close(self):
+        if self.mmap:
+            self.mmap.close()
+            self.fp.close()
+        self.mmap = self.fp = self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def next_cluster(self, cluster):
+        if self.fat_bits == 12:
+            pos = self.fat_start + cluster * 3 / 2
+            value = struct.unpack_from("<H", self.data, pos)[0]
+            return value >> 4 if cluster & 1 else value & 0xfff
+        if self.fat_bits == 16:
+            return struct.unpack_from("<H", self.data,
+                                      self.fat_start + cluster * 2)[0]
+        return struct.unpack_from("<I", self.data,
+                                  self.fat_start + cluster * 4)[0] & 0x0fffffff
+
+    def extents(self, cluster, size=None):
+        """Return the (offset, length) runs of contiguous clusters of a
+        chain, limited to size bytes if given"""
+        end_of_chain = (1 << min(self.fat_bits, 28)) - 8
+        runs = []
+        count = 0
+        while 2 <= cluster < end_of_chain:
+            if cluster >= self.num_clusters + 2 or count > self.num_clusters:
+                raise FatError("invalid cluster chain")
+            offset = self.data_start + (cluster - 2) * self.cluster_size
+            if runs and runs[-1][0] + runs[-1][1] == offset:
+                runs[-1][1] += self.cluster_size
+            else:
+                runs.append([offset, self.cluster_size])
+            count += 1
+            cluster = self.next_cluster(cluster)
+
+        if size is None:
+            return runs
+        out = []
+        for offset, length in runs:
+            if size <= 0:
+                break
+            out.append((offset, min(length, size)))
+            size -= length
+        if size > 0:
+            raise FatError("cluster chain shorter than the file")
+        return out
+
+    def content(self, cluster, size):
+        """Return the content of a cluster chain as a buffer when it's
+        contiguous, as a string otherwise"""
+        if not size:
+            return buffer("")
+        runs = self.extents(cluster, size)
+        if len(runs) == 1:
+            return buffer(self.data, *runs[0])
+        return "".join(self.data[o:o + l] for o, l in runs)
+
+    def entries(self, cluster):
+        """Iterate over the (name, is_dir, cluster, size) entries of a
+        directory, cluster 0 being the root directory"""
+        if cluster == 0 and self.fat_bits == 32:
+            cluster = self.root_cluster
+        if cluster == 0:
+            runs = [(self.root_start, self.root_size)]
+        else:
+            runs = self.extents(cluster)
+
+        lfn = {}
+        for offset, length in runs:
+            for pos in xrange(offset, offset + length, DIR_ENTRY_SIZE):
+                entry = self.data[pos:pos + DIR_ENTRY_SIZE]
+                first = entry[0]
+                if first == "\0":
+                    return
+                if first == "\xe5":
+                    lfn = {}
+                    continue
+
+                attr = ord(entry[11])
+                if attr == ATTR_LFN:
+                    seq, part1, _, _, csum, part2, _, part3 = \
+                        s_lfn.unpack(entry)
+                    if seq & 0x40:
+                        lfn = {"csum": csum}
+                    lfn[seq & 0x3f] = part1 + part2 + part3
+                    continue
+
+                (short, attr, flags, _, _, _, _, hi, _, _, lo,
+                 size) = s_dirent.unpack(entry)
+                long_name = lfn
+                lfn = {}
+                if attr & ATTR_VOLUME_ID or short.startswith("."):
+                    continue
+
+                if long_name.get("csum") == short_name_checksum(short):
+                    del long_name["csum"]
+                    units = "".join(long_name[k] for k in sorted(long_name))
+                    name = units.decode("utf-16le").split(u"\0")[0]
+                    name = name.encode("utf-8")
+                else:
+                    if short[0] == "\x05":
+                        short = "\xe5" + short[1:]
+                    base, ext = short[:8].rstrip(), short[8:].rstrip()
+                    if flags & CASE_LOWER_BASE:
+                        base = base.lower()
+                    if flags & CASE_LOWER_EXT:
+                        ext = ext.lower()
+                    name = base + "." + ext if ext else base
+
+                yield (name, bool(attr & ATTR_DIRECTORY), (hi << 16) | lo,
+                       size)
+
+    def files(self, cluster=0, prefix=""):
+        """Lazily iterate over the (path, content) of all the files"""
+        for name, is_dir, child, size in self.entries(cluster):
+            path = prefix + name
+            if is_dir:
+                for f in self.files(child, path + "/"):
+                    yield f
+            else:
+                yield path, self.content(child, size)
+
+    def read(self, path):
+        """Return the content of the file at path, compared case
+        insensitively as FAT does"""
+        cluster = 0
+        names = [p for p in path.split("/") if p]
+        for i, name in enumerate(names):
+            for entry, is_dir, child, size in self.entries(cluster):
+                if entry.upper() == name.upper():
+                    break
+            else:
+                raise FatError("%s not found" % path)
+            if is_dir != (i < len(names) - 1):
+                raise FatError("%s not found" % path)
+            cluster = child
+        if not names:
+            raise FatError("%s is a directory" % path)
+        return self.content(cluster, size)
@@ -7,6 +7,12 @@ blobstore_deps += $(BOARD_DEVICE_MAPPING)
 blobstore_extra_args := --device-map $(BOARD_DEVICE_MAPPING)
 endif
 
+# Incremental builds rewrite the changed blobs in place instead of
+# writing a new blobstore, opt-in
+ifeq ($(BOARD_BLOBSTORE_INCREMENTAL),true)
+blobstore_output_args := --incremental
+endif
+
 # build_blobstore without an output parameter lists all the necessary
 # source blob files we need
 blobstore_deps += $(shell $(build_blobstore) \
@@ -15,7 +21,7 @@ blobstore_deps += $(shell $(build_blobstore) \
 
 $(INSTALLED_2NDBOOTLOADER_TARGET): $(blobstore_deps)
 	$(build_blobstore) --config $(BOARD_BLOBSTORE_CONFIG) \
-			$(blobstore_extra_args) --output $@
+			$(blobstore_extra_args) $(blobstore_output_args) --output $@
 else ifdef BOARD_DTB_FILE
 # Non-scalable SoFIA targets
 
@@ -21,7 +21,7 @@ $(foreach var,$(FLASHFILE_VARIANTS), \
 	$(call dist-for-goals,droidcore,$(ff_zip):$(notdir $(ff_zip))) \
 	$(call dist-for-goals,droidcore,$(ota_zip):$(notdir $(ota_zip))))
 
-$(INTEL_FACTORY_FLASHFILES_TARGET): $(BUILT_TARGET_FILES_PACKAGE) $(fftf) $(MKDOSFS) $(MCOPY)
+$(INTEL_FACTORY_FLASHFILES_TARGET): $(BUILT_TARGET_FILES_PACKAGE) $(fftf)
 	$(hide) mkdir -p $(dir $@)
 	$(eval y = $(subst -, ,$(basename $(@F))))
 	$(eval DEV = $(word 3, $(y)))
@@ -40,7 +40,7 @@ otapackage: $(INTEL_OTA_PACKAGES)
 else
 INTEL_FACTORY_FLASHFILES_TARGET := $(PRODUCT_OUT)/$(name).zip
 
-$(INTEL_FACTORY_FLASHFILES_TARGET): $(BUILT_TARGET_FILES_PACKAGE) $(fftf) $(MKDOSFS) $(MCOPY)
+$(INTEL_FACTORY_FLASHFILES_TARGET): $(BUILT_TARGET_FILES_PACKAGE) $(fftf)
 	$(hide) mkdir -p $(dir $@)
 	$(hide) $(fftf) $(BUILT_TARGET_FILES_PACKAGE) $@
 
@@ -1,29 +1,249 @@
 #!/usr/bin/python
 
+import shutil
+import tempfile
+
 from blobstore import *
+from blobstore import main as blobstore_main
 
-def test1():
-    db = BlobStore()
-    db.create('db.txt', 1024)
-    for i in xrange(1, 1024):
-        str = 'This is my blob:' + `i`
-        blobKey = 'key' + `i`
-        db.putBlob(str, len(str), blobKey, BLOBTYPES.BlobTypeDtb)
-        db.putBlob(str, len(str), blobKey, BLOBTYPES.BlobTypeOemVars)
-    db.close()
-    db = BlobStore()
-    db.load('db.txt')
-    # db.printInfo()
-    for i in xrange(1, 1024):
+def populate(tmpdir, count):
+    db = BlobStore(os.path.join(tmpdir, 'db.bin'))
+    for i in xrange(1, count):
         blobKey = 'key' + `i`
-        blob = db.getBlob(blobKey, BLOBTYPES.BlobTypeDtb)
-        print blob
-        db.getBlob(blobKey, BLOBTYPES.BlobTypeOemVars)
-        print blob
-    db.close()
+        for btype in (BLOB_TYPE_DTB, BLOB_TYPE_OEMVARS):
+            path = os.path.join(tmpdir, '%s-%d.txt' % (blobKey, btype))
+            with open(path, 'w') as fp:
+                fp.write('This is my blob:%d-%d' % (i, btype))
+            db.add(blobKey, btype, path)
+    return db
+
+def test1(version=VERSION):
+    tmpdir = tempfile.mkdtemp(prefix='test_blobstore')
+    try:
+        db = populate(tmpdir, 1024)
+        db.commit(version)
+
+        with BlobStoreReader(db.path) as reader:
+            for i in xrange(1, 1024):
+                blobKey = 'key' + `i`
+                for btype in (BLOB_TYPE_DTB, BLOB_TYPE_OEMVARS):
+                    blob = reader.get(blobKey, btype)
+                    assert str(blob) == 'This is my blob:%d-%d' % (i, btype)
+            assert reader.get('key0', BLOB_TYPE_DTB) is None
+            assert reader.get('key1', BLOB_TYPE_BOOTVARS) is None
+            assert len(list(reader)) == 2 * 1023
+            assert reader.version == version
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_mph():
+    test1(VERSION_MPH)
+
+    # Every lookup must hit on the first metablock
+    tmpdir = tempfile.mkdtemp(prefix='test_blobstore')
+    try:
+        db = populate(tmpdir, 300)
+        db.commit(VERSION_MPH)
+        with BlobStoreReader(db.path) as reader:
+            assert reader.hash_sz == 2 * 299
+            for key, btype in db.items:
+                mb, probes = reader.lookup(key, btype)
+                assert mb is not None and probes == 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_dedup():
+    tmpdir = tempfile.mkdtemp(prefix='test_blobstore')
+    try:
+        db = BlobStore(os.path.join(tmpdir, 'db.bin'))
+        for i in xrange(10):
+            path = os.path.join(tmpdir, 'oemvars-%d.txt' % i)
+            with open(path, 'w') as fp:
+                fp.write('same oemvars for everyone')
+            db.add('key%d' % i, BLOB_TYPE_OEMVARS, path)
+        db.commit()
+        assert db.bytes_saved == 9 * len('same oemvars for everyone')
+
+        with BlobStoreReader(db.path) as reader:
+            offsets = set(mb.data_offset for mb in reader.metablocks())
+            assert len(offsets) == 1
+            assert str(reader.get('key3', BLOB_TYPE_OEMVARS)) == \
+                    'same oemvars for everyone'
+    finally:
+        shutil.rmtree(tmpdir)
+
+def reference_hash(key, btype, sz):
+    # Per-character loop of the C loader
+    hash_val = 0
+    for c in key:
+        hash_val = (hash_val * 31 + ord(c)) % 2**32
+    hash_val = (hash_val * 31 + btype) % 2**32
+    return hash_val % sz
+
+def test_hash():
+    keys = []
+    for i in xrange(200):
+        key = 'brand%d/product%d/device%d' % (i % 3, i % 5, i)
+        keys.append((key, i % 3))
+    keys.append(('x' * (BLOB_KEY_LENGTH - 1), BLOB_TYPE_BOOTVARS))
+    keys.append(('nodelimiter', BLOB_TYPE_DTB))
+    keys.append(('', BLOB_TYPE_DTB))
+
+    hashes = hash_blob_keys(keys)
+    for sz in (1, 7, 401, 2**32 - 1):
+        reduced = reduce_hashes(hashes, sz)
+        for (key, btype), h in zip(keys, reduced):
+            assert h == reference_hash(key, btype, sz)
+            assert h == hash_blob_key(key, btype, sz)
+
+def test_sizing():
+    tmpdir = tempfile.mkdtemp(prefix='test_blobstore')
+    try:
+        db = populate(tmpdir, 500)
+        db.commit()
+        default_longest = max(db.histogram)
+
+        budget = s_hashitem.size * 4 * len(db.items)
+        db.commit(table_budget=budget)
+        assert max(db.histogram) <= default_longest
+        assert sum(db.histogram.values()) * s_hashitem.size <= budget
+        assert sum(l * n for l, n in db.histogram.items()) == len(db.items)
+
+        with BlobStoreReader(db.path) as reader:
+            assert reader.hash_sz == sum(db.histogram.values())
+            for key, btype in db.items:
+                mb, probes = reader.lookup(key, btype)
+                assert mb is not None and probes <= max(db.histogram)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def rewrite(path, data):
+    # Make sure the change is visible even with a coarse mtime
+    mtime = os.stat(path).st_mtime + 10
+    with open(path, 'w') as fp:
+        fp.write(data)
+    os.utime(path, (mtime, mtime))
+
+def test_incremental():
+    tmpdir = tempfile.mkdtemp(prefix='test_blobstore')
+    try:
+        db = populate(tmpdir, 100)
+        db.commit(incremental=True)
+        assert db.written == os.path.getsize(db.path)
+        assert os.path.exists(db.path + MANIFEST_SUFFIX)
+
+        # Nothing changed
+        db.commit(incremental=True)
+        assert db.written == 0
+
+        # Same size, different content: only that blob gets rewritten
+        path = db.items[('key7', BLOB_TYPE_DTB)]
+        rewrite(path, 'This is my blob:7-X')
+        db.commit(incremental=True)
+        assert db.written == len('This is my blob:7-X')
+        with BlobStoreReader(db.path) as reader:
+            assert str(reader.get('key7', BLOB_TYPE_DTB)) == \
+                    'This is my blob:7-X'
+            assert str(reader.get('key8', BLOB_TYPE_DTB)) == \
+                    'This is my blob:8-0'
+
+        # Different size moves everything after it
+        rewrite(path, 'This is my longer blob:7')
+        db.commit(incremental=True)
+        assert db.written == os.path.getsize(db.path)
+        with BlobStoreReader(db.path) as reader:
+            assert str(reader.get('key7', BLOB_TYPE_DTB)) == \
+                    'This is my longer blob:7'
+
+        # A store written by a non-incremental commit is rebuilt
+        db.commit()
+        db.commit(incremental=True)
+        assert db.written == os.path.getsize(db.path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_compress():
+    tmpdir = tempfile.mkdtemp(prefix='test_blobstore')
+    try:
+        db = BlobStore(os.path.join(tmpdir, 'db.bin'))
+        blobs = {}
+        for i in xrange(50):
+            data = ('oemvar%d=value\n' % i) * (i * 10)
+            path = os.path.join(tmpdir, 'oemvars-%d.txt' % i)
+            with open(path, 'w') as fp:
+                fp.write(data)
+            db.add('key%d' % i, BLOB_TYPE_OEMVARS, path)
+            blobs['key%d' % i] = data
+        # A blob spanning several read chunks is compressed as a stream
+        data = ''.join('oemvar%d=value\n' % i
+                       for i in xrange(COPY_CHUNK_SIZE / 5))
+        path = os.path.join(tmpdir, 'oemvars-large.txt')
+        with open(path, 'w') as fp:
+            fp.write(data)
+        db.add('large', BLOB_TYPE_OEMVARS, path)
+        blobs['large'] = data
+
+        try:
+            db.commit(compress=True)
+            assert False, "compression needs version 2"
+        except Exception:
+            pass
+
+        db.commit(VERSION_MPH, compress=True)
+        assert db.bytes_compressed > 0
+        assert os.path.getsize(db.path) < sum(len(d) for d in blobs.values())
+
+        with BlobStoreReader(db.path) as reader:
+            codecs = set()
+            for mb in reader.metablocks():
+                codecs.add(mb.codec)
+                assert mb.raw_size == len(blobs[mb.key])
+            assert CODEC_ZLIB in codecs or CODEC_LZ4 in codecs
+            # The empty blob isn't worth compressing
+            assert CODEC_NONE in codecs
+            for key, data in blobs.iteritems():
+                assert str(reader.get(key, BLOB_TYPE_OEMVARS)) == data
+            assert len(reader.cache) <= DECODE_CACHE_SIZE
+
+        # Incremental commits reuse the encodings from the manifest
+        db.commit(VERSION_MPH, incremental=True, compress=True)
+        db.commit(VERSION_MPH, incremental=True, compress=True)
+        assert db.written == 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_cli():
+    tmpdir = tempfile.mkdtemp(prefix='test_blobstore')
+    try:
+        db = populate(tmpdir, 10)
+        db.commit()
+        out = os.path.join(tmpdir, 'out')
+        assert blobstore_main([db.path, 'verify']) == 0
+        assert blobstore_main([db.path, 'get', 'key3', 'oemvars',
+                               '--output', out]) == 0
+        assert open(out).read() == 'This is my blob:3-1'
+        assert blobstore_main([db.path, 'get', 'key3', 'bootvars']) == 1
+
+        # Corrupt a metablock key so it can't be found any more
+        with open(db.path, 'r+b') as fp:
+            with BlobStoreReader(db.path) as reader:
+                mb = reader.metablocks().next()
+            fp.seek(mb.mb_offset)
+            fp.write('X')
+        assert blobstore_main(['--json', db.path, 'verify']) == 1
+    finally:
+        shutil.rmtree(tmpdir)
 
 def main():
+    test_hash()
     test1()
+    test_mph()
+    test_dedup()
+    test_sizing()
+    test_incremental()
+    test_compress()
+    test_cli()
+    print "OK"
 
 if __name__ == '__main__':
     main()
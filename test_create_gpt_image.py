@@ -0,0 +1,454 @@
+#!/usr/bin/python
+
+import gzip
+import os
+import re
+import shutil
+import tempfile
+from ConfigParser import SafeConfigParser
+
+from create_gpt_image import *
+
+IMG_SIZE = '16M'
+DISK_GUID = UUID('aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee').bytes_le
+
+INI = """[base]
+partitions = bootloader boot
+partitions += system data
+start_lba = 2048
+
+[partition.bootloader]
+label = android_bootloader
+len = 1
+type = esp
+guid = 11111111-2222-3333-4444-555555555501
+
+[partition.boot]
+label = android_boot
+len = 2
+type = boot
+guid = 11111111-2222-3333-4444-555555555502
+
+[partition.system]
+label = android_system
+len = 6
+type = linux
+guid = 11111111-2222-3333-4444-555555555503
+
+[partition.data]
+label = android_data
+len = -1
+type = linux
+guid = 11111111-2222-3333-4444-555555555504
+"""
+
+# Same layout, written with the ConfigParser features the tokenizer must
+# understand
+INI_FANCY = """# GPT layout
+[DEFAULT]
+type = linux
+prefix = 11111111-2222-3333-4444
+
+[base]
+partitions = bootloader
+  boot system
+partitions += data
+start_lba: 2048
+
+; the ESP
+[partition.bootloader]
+label = android_%(name)s
+name = bootloader
+len = 1 ; MiB
+type = esp
+guid = %(prefix)s-555555555501
+
+[partition.boot]
+LABEL = android_boot
+len = 2
+type = boot
+guid = %(prefix)s-555555555502
+rem a comment too
+
+[partition.system]
+label=android_system
+len=6
+guid=%(prefix)s-555555555503
+
+[partition.data]
+label = android_data
+len = -1
+guid = %(prefix)s-555555555504
+note = 100%%
+"""
+
+TBL = """partition_table=gpt
+add -b 2048 -s 2048 -t esp -u 11111111-2222-3333-4444-555555555501 -l android_bootloader
+add -b 4096 -s 4096 -t boot -u 11111111-2222-3333-4444-555555555502 -l android_boot
+add -b 8192 -s 12288 -t linux -u 11111111-2222-3333-4444-555555555503 -l android_system
+"""
+
+def reference_read_ini(path, block_size):
+    # SafeConfigParser based reader of create_gpt_image.py before the
+    # tokenizer
+    cfg = SafeConfigParser()
+    cfg.read(path)
+    partitions = cfg.get('base', 'partitions').split()
+    for l in open(path).read().split('\n'):
+        words = l.split()
+        if len(words) > 2 and words[0] == 'partitions' and words[1] == '+=':
+            partitions += words[2:]
+    try:
+        start_lba_prev = cfg.getint('base', 'start_lba')
+    except Exception:
+        start_lba_prev = 2048
+
+    result = []
+    for part in partitions:
+        begin = start_lba_prev
+        partname = 'partition.{0}'.format(part)
+        readlen = cfg.getint(partname, 'len')
+        if readlen > 0:
+            size = (readlen * 1024 * 1024) / block_size
+            start_lba_prev = begin + size
+        else:
+            size = readlen
+        result.append(TLB_INFO(begin, size, cfg.get(partname, 'type'),
+                               cfg.get(partname, 'guid'),
+                               cfg.get(partname, 'label')))
+    return result
+
+def reference_read_tbl(path):
+    re_parser = re.compile(r'^add\s-b\s(?P<begin>\w+)\s-s\s'
+                           '(?P<size>[\w$()-]+)\s-t\s'
+                           '(?P<type>\w+)\s-u\s'
+                           '(?P<uuid>[\w-]+)\s'
+                           '-l\s(?P<label>\w+)')
+    result = []
+    for line in open(path):
+        parsed_line = re_parser.match(line)
+        if parsed_line:
+            begin, size, ptype, uuid, label = parsed_line.groups()
+            result.append(TLB_INFO(int(begin), int(size), ptype, uuid, label))
+    return result
+
+def write_file(path, data):
+    with open(path, 'wb') as fp:
+        fp.write(data)
+    return path
+
+def rewrite(path, data):
+    # Make sure the change is visible even with a coarse mtime
+    mtime = os.stat(path).st_mtime + 10
+    write_file(path, data)
+    os.utime(path, (mtime, mtime))
+
+def make_sparse(path, size, writes):
+    with open(path, 'wb') as fp:
+        writer = SparseImageWriter(fp, size)
+        for offset, data in writes:
+            writer.write(offset, data)
+        writer.close()
+    return path
+
+def expand_sparse(path, out_path):
+    with open(path, 'rb') as fp:
+        reader = SparseImageReader(fp)
+        with open(out_path, 'wb') as out:
+            for offset, data in reader.chunks(1024 * 1024):
+                out.seek(offset)
+                out.write(data)
+            out.truncate(reader.size)
+
+def make_binaries(tmpdir):
+    binaries = dict((label, 'none') for label in GPTImage.ANDROID_PARTITIONS)
+    binaries['bootloader'] = write_file(os.path.join(tmpdir, 'bootloader.img'),
+                                        os.urandom(300 * 1024))
+    # A zero block in the middle, left as a hole in the image
+    binaries['boot'] = write_file(os.path.join(tmpdir, 'boot.img'),
+                                  os.urandom(8192) + '\0' * 65536 +
+                                  os.urandom(5000))
+    binaries['system'] = make_sparse(os.path.join(tmpdir, 'system.img'),
+                                     4 * 1024 * 1024,
+                                     [(0, os.urandom(10000)),
+                                      (1024 * 1024, '\x5a' * 8192),
+                                      (3 * 1024 * 1024, os.urandom(4096))])
+    return binaries
+
+def read_layout(img, tlb_path, cache_dir=None):
+    tlb_infos = TLBInfos(tlb_path)
+    tlb_infos.read_layout(img.size, img.block_size,
+                          img.gpt_header.entry_size,
+                          img.gpt_header.table_length, cache_dir)
+    return tlb_infos
+
+def build(tmpdir, name, binaries, manifest=False, **kwargs):
+    img = GPTImage(os.path.join(tmpdir, name), IMG_SIZE)
+    img.gpt_header.uuid = DISK_GUID
+    tlb_infos = read_layout(img, write_file(os.path.join(tmpdir, 'gpt.ini'),
+                                            INI))
+    img.write(tlb_infos, binaries, manifest=manifest, **kwargs)
+    return img
+
+def update(tmpdir, name, binaries):
+    img = GPTImage(os.path.join(tmpdir, name), IMG_SIZE)
+    tlb_infos = read_layout(img, os.path.join(tmpdir, 'gpt.ini'))
+    return img.update(tlb_infos, binaries)
+
+def content(path):
+    with open(path, 'rb') as fp:
+        return fp.read()
+
+def expect_exit(func, *args):
+    try:
+        func(*args)
+    except SystemExit:
+        return
+    assert False, "%s didn't fail" % func.__name__
+
+def test_raw():
+    tmpdir = tempfile.mkdtemp(prefix='test_create_gpt_image')
+    try:
+        binaries = make_binaries(tmpdir)
+        img = build(tmpdir, 'raw.img', binaries)
+        data = content(img.path)
+        assert len(data) == img.size
+        assert not os.path.exists(img.manifest_path())
+        assert img.verify() == []
+
+        # The binaries are at the offsets of their partitions
+        tlb_infos = read_layout(img, os.path.join(tmpdir, 'gpt.ini'))
+        expand_sparse(binaries['system'], os.path.join(tmpdir, 'system.raw'))
+        for tlb_part in tlb_infos:
+            bin_path = binaries[tlb_part.label[8:]]
+            if bin_path == 'none':
+                continue
+            if tlb_part.label == 'android_system':
+                bin_path = os.path.join(tmpdir, 'system.raw')
+            offset = tlb_part.begin * img.block_size
+            expected = content(bin_path)
+            assert data[offset:offset + len(expected)] == expected
+
+        # Only the data is allocated
+        assert os.stat(img.path).st_blocks * 512 < img.size / 2
+
+        # A corrupted partition table is reported
+        with open(img.path, 'r+b') as fp:
+            fp.seek(2 * img.block_size)
+            fp.write('X')
+        assert img.verify() != []
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_sparse():
+    tmpdir = tempfile.mkdtemp(prefix='test_create_gpt_image')
+    try:
+        binaries = make_binaries(tmpdir)
+        raw = build(tmpdir, 'raw.img', binaries)
+        sparse = build(tmpdir, 'sparse.img', binaries, sparse=True)
+        assert SparseImageReader.is_sparse(sparse.path)
+        assert os.path.getsize(sparse.path) < raw.size / 2
+        expand_sparse(sparse.path, os.path.join(tmpdir, 'expanded.img'))
+        assert content(os.path.join(tmpdir, 'expanded.img')) == \
+                content(raw.path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_compress():
+    tmpdir = tempfile.mkdtemp(prefix='test_create_gpt_image')
+    try:
+        if not (find_executable('pigz') or find_executable('gzip')):
+            return
+        binaries = make_binaries(tmpdir)
+        raw = build(tmpdir, 'raw.img', binaries)
+        compressed = build(tmpdir, 'raw.img.gz', binaries, compress='gzip')
+        assert gzip.open(compressed.path).read() == content(raw.path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_jobs():
+    tmpdir = tempfile.mkdtemp(prefix='test_create_gpt_image')
+    task_size = GPTImage.TASK_SIZE
+    try:
+        binaries = make_binaries(tmpdir)
+        serial = build(tmpdir, 'serial.img', binaries)
+        # Several tasks by binary
+        GPTImage.TASK_SIZE = 64 * 1024
+        parallel = build(tmpdir, 'parallel.img', binaries, jobs=4)
+        assert content(serial.path) == content(parallel.path)
+    finally:
+        GPTImage.TASK_SIZE = task_size
+        shutil.rmtree(tmpdir)
+
+def test_copier():
+    tmpdir = tempfile.mkdtemp(prefix='test_create_gpt_image')
+    try:
+        data = os.urandom(10000) + '\0' * 3 * FileCopier.HOLE_BLOCK_SIZE + \
+                os.urandom(3000)
+        src_path = write_file(os.path.join(tmpdir, 'src'), data)
+        for methods in [FileCopier.METHODS, ('readinto',)]:
+            copier = FileCopier()
+            copier.disabled.update(m for m in FileCopier.METHODS
+                                   if m not in methods)
+            dst_path = os.path.join(tmpdir, 'dst')
+            with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+                used = copier.copy(src, dst, 4096, len(data) - 100, 100)
+                dst.truncate(4096 + len(data) - 100)
+            assert content(dst_path) == '\0' * 4096 + data[100:]
+            assert used and set(used) <= set(methods)
+        # The fallback seeks over the zero blocks
+        assert used == ['readinto']
+        assert list(FileCopier.nonzero_runs(data)) == [(0, 12288),
+                                                       (20480, len(data))]
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_update():
+    tmpdir = tempfile.mkdtemp(prefix='test_create_gpt_image')
+    try:
+        binaries = make_binaries(tmpdir)
+        # No manifest, no update
+        build(tmpdir, 'a.img', binaries)
+        assert not update(tmpdir, 'a.img', binaries)
+
+        img = build(tmpdir, 'a.img', binaries, manifest=True)
+        assert os.path.exists(img.manifest_path())
+        assert update(tmpdir, 'a.img', binaries)
+
+        rewrite(binaries['boot'], os.urandom(4096))
+        rewrite(binaries['system'], content(make_sparse(
+            os.path.join(tmpdir, 'system2.img'), 4 * 1024 * 1024,
+            [(4096, os.urandom(4096))])))
+        assert update(tmpdir, 'a.img', binaries)
+        fresh = build(tmpdir, 'b.img', binaries)
+        assert content(img.path) == content(fresh.path)
+        assert img.verify(check_partitions=True) == []
+
+        # An image modified behind the manifest's back is rebuilt
+        with open(img.path, 'r+b') as fp:
+            fp.write('X')
+        assert not update(tmpdir, 'a.img', binaries)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_delta():
+    tmpdir = tempfile.mkdtemp(prefix='test_create_gpt_image')
+    try:
+        binaries = make_binaries(tmpdir)
+        old = build(tmpdir, 'old.img', binaries)
+        rewrite(binaries['bootloader'], os.urandom(200 * 1024))
+        new = build(tmpdir, 'new.img', binaries)
+
+        delta_path = os.path.join(tmpdir, 'delta')
+        delta = ImageDelta()
+        ranges = delta.compare(old.path, new.path, 2)
+        assert ranges and sum(length for _, length in ranges) < new.size / 4
+        delta.write(old.path, new.path, delta_path)
+
+        work = os.path.join(tmpdir, 'work.img')
+        shutil.copy(old.path, work)
+        assert ImageDelta.apply(work, delta_path) == len(ranges)
+        assert content(work) == content(new.path)
+
+        # The delta doesn't apply twice
+        expect_exit(ImageDelta.apply, work, delta_path)
+        assert content(work) == content(new.path)
+        assert not os.path.exists(ImageDelta.journal_path(work))
+
+        # A patch interrupted partway is restored then applied again
+        copy_range = ImageDelta.__dict__['_copy_range']
+        for writes in (0, len(ranges) - 1):
+            shutil.copy(old.path, work)
+            calls = [0]
+            def interrupted(cls, src_file, offset, length, digest,
+                            dst_file=None):
+                if dst_file is not None and \
+                        not dst_file.name.endswith('.tmp'):
+                    if calls[0] == writes:
+                        dst_file.write(src_file.read(length / 2))
+                        raise KeyboardInterrupt()
+                    calls[0] += 1
+                copy_range.__func__(cls, src_file, offset, length, digest,
+                                    dst_file)
+            ImageDelta._copy_range = classmethod(interrupted)
+            try:
+                ImageDelta.apply(work, delta_path)
+                assert False, 'patch not interrupted'
+            except KeyboardInterrupt:
+                pass
+            finally:
+                ImageDelta._copy_range = copy_range
+            assert content(work) != content(old.path)
+            assert os.path.exists(ImageDelta.journal_path(work))
+            assert ImageDelta.apply(work, delta_path) == len(ranges)
+            assert content(work) == content(new.path)
+            assert not os.path.exists(ImageDelta.journal_path(work))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_parse():
+    tmpdir = tempfile.mkdtemp(prefix='test_create_gpt_image')
+    try:
+        for data in (INI, INI_FANCY):
+            path = write_file(os.path.join(tmpdir, 'gpt.ini'), data)
+            tlb_infos = TLBInfos(path)
+            tlb_infos.read(512)
+            assert tlb_infos.format == 'ini'
+            assert list(tlb_infos) == reference_read_ini(path, 512)
+            assert list(tlb_infos) == reference_read_ini(
+                write_file(os.path.join(tmpdir, 'ref.ini'), INI), 512)
+
+        path = write_file(os.path.join(tmpdir, 'gpt.tbl'), TBL)
+        tlb_infos = TLBInfos(path)
+        tlb_infos.read(512)
+        assert tlb_infos.format == 'tbl'
+        assert list(tlb_infos) == reference_read_tbl(path)
+
+        # Invalid files are rejected
+        for data in (INI.replace('len = 2', 'len = two'),
+                     INI.replace('len = 2', 'len = %(unknown)s'),
+                     INI.replace('len = 2', 'len = 2%'),
+                     INI.replace('[base]', 'stray line\n[base]'),
+                     INI.replace('[partition.boot]', '[partition.other]')):
+            path = write_file(os.path.join(tmpdir, 'bad.ini'), data)
+            expect_exit(TLBInfos(path).read, 512)
+
+        # The resolved layout is cached
+        img = GPTImage(os.path.join(tmpdir, 'x.img'), IMG_SIZE)
+        path = write_file(os.path.join(tmpdir, 'gpt.ini'), INI_FANCY)
+        cache_dir = os.path.join(tmpdir, 'cache')
+        first = read_layout(img, path, cache_dir)
+        assert first[-1].size == 5 * 1024 * 1024 / 512
+        assert len(os.listdir(cache_dir)) == 1
+        second = read_layout(img, path, cache_dir)
+        assert list(first) == list(second)
+
+        # A corrupted cache entry is parsed again and replaced
+        cache_path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+        for data in ('{"format": "ini"', '[]', '{"format": "ini"}',
+                     '{"format": "ini", "partitions": null}',
+                     '{"format": "ini", "partitions": {"a": 1}}',
+                     '{"format": "ini", "partitions": [5]}',
+                     '{"format": "ini", "partitions": ["abcde"]}',
+                     '{"format": "ini", "partitions": [[1, 2, 3]]}',
+                     '{"format": "ini", "partitions": '
+                     '[[null, 2, "t", "u", "l"]]}'):
+            write_file(cache_path, data)
+            assert list(read_layout(img, path, cache_dir)) == list(first)
+            assert list(read_layout(img, path, cache_dir)) == list(first)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main():
+    test_parse()
+    test_raw()
+    test_sparse()
+    test_compress()
+    test_jobs()
+    test_copier()
+    test_update()
+    test_delta()
+    print "OK"
+
+if __name__ == '__main__':
+    main()